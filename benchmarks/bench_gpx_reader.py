@@ -0,0 +1,72 @@
+# Compare reading GPX tracks with tpov_gpx (lxml, streaming) and gpxpy
+# Each reader runs in a fresh process so that the peak memory of one run does not affect the next
+
+# Built-in modules
+import os, sys, argparse, tempfile, time, resource, multiprocessing, shutil
+from datetime import datetime, timedelta, timezone
+
+# Third-party modules
+import gpxpy
+from texttable import Texttable
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+from tpov_gpx import Track
+
+# Write a GPX track with `count` points at 10 Hz, similar to a GoPro recording
+def write_track (path, count):
+    start = datetime (2024, 1, 1, tzinfo = timezone.utc)
+    with open (path, "w") as f:
+        f.write ('<?xml version="1.0" encoding="UTF-8"?>\n<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="tpov">\n<trk><trkseg>\n')
+        for i in range (count):
+            time = (start + timedelta (seconds = i / 10)).strftime ("%Y-%m-%dT%H:%M:%S.%fZ")
+            f.write (f'<trkpt lat="{49.8 + i * 1e-6:.7f}" lon="{-97.2 + i * 1e-6:.7f}"><ele>{230 + (i % 100) / 10}</ele><time>{time}</time></trkpt>\n')
+        f.write ("</trkseg></trk>\n</gpx>\n")
+
+def read_tpov (path):
+    return len (Track.load (path))
+
+def read_gpxpy (path):
+    with open (path, "r") as f:
+        return len (tuple (gpxpy.parse (f).walk (True)))
+
+def measure (reader, path, queue):
+    start = time.perf_counter ()
+    count = reader (path)
+    queue.put ((time.perf_counter () - start, resource.getrusage (resource.RUSAGE_SELF).ru_maxrss, count))
+
+def run (reader, path):
+    queue = multiprocessing.Queue ()
+    process = multiprocessing.Process (target = measure, args = (reader, path, queue))
+    process.start ()
+    result = queue.get ()
+    process.join ()
+    return result
+
+parser = argparse.ArgumentParser (description = "Benchmark the tpov_gpx reader against gpxpy")
+parser.add_argument ("-n", "--sizes", type = int, nargs = "+", default = [10000, 100000, 1000000], help = "Number of track points of each test file")
+parser.add_argument ("--no-gpxpy", action = "store_true", help = "Only run the tpov_gpx reader (gpxpy is slow on large files)")
+
+def main (args):
+    table = Texttable (max_width = shutil.get_terminal_size ().columns)
+    table.set_deco (Texttable.HEADER)
+    table.set_cols_align (["r", "r", "l", "r", "r", "r"])
+    table.set_cols_dtype (["i", "t", "t", "t", "t", "t"])
+    table.header (["Points", "File (MB)", "Reader", "Time (s)", "Peak RSS (MB)", "Speedup"])
+    readers = {"tpov_gpx": read_tpov} if args.no_gpxpy else {"tpov_gpx": read_tpov, "gpxpy": read_gpxpy}
+    with tempfile.TemporaryDirectory () as tmp:
+        for size in args.sizes:
+            path = os.path.join (tmp, f"{size}.gpx")
+            write_track (path, size)
+            results = {k: run (v, path) for k, v in readers.items ()}
+            for k, (seconds, rss, count) in results.items ():
+                if count != size:
+                    raise ValueError (f"{k} read {count} points, expected {size}")
+                speedup = f"{results ['gpxpy'] [0] / seconds:.1f}x" if "gpxpy" in results else ""
+                # ru_maxrss is in kilobytes on Linux and bytes on macOS
+                rss = rss / (1 << 20) if sys.platform == "darwin" else rss / (1 << 10)
+                table.add_row ([size, f"{os.path.getsize (path) / 1e6:.1f}", k, f"{seconds:.2f}", f"{rss:.0f}", speedup])
+            os.remove (path)
+    print (table.draw ())
+
+if __name__ == "__main__":
+    main (parser.parse_args ())
@@ -0,0 +1,66 @@
+# Compare writing matched GPX tracks point by point (tpov_gpx) and through the gpxpy document
+# Each writer runs in a fresh process so that the peak memory of one run does not affect the next
+
+# Built-in modules
+import os, sys, argparse, tempfile, time, resource, multiprocessing, shutil, filecmp
+
+# Third-party modules
+from texttable import Texttable
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+from tpov_gpx import Track
+from bench_gpx_reader import write_track
+
+# Extensions similar to the output of SimpleTextDisplay
+fields = {f"tpov.{i}": "‌" for i in ("current", "left", "forward", "right", "left_exit", "forward_exit", "right_exit", "prev_stop", "next_stop", "transfers")}
+fields.update ({"tpov.inter_dash": "0", "tpov.stop_bar": "0.5"})
+
+def write (path, out, stream):
+    track = Track.load (path)
+    if not stream:
+        track.skeleton = None # Write through gpxpy
+    gpx = track.document ()
+    gpx.name = "tpov"
+    track.write (out, gpx, (fields for _ in range (len (track))))
+
+def measure (path, out, stream, queue):
+    start = time.perf_counter ()
+    write (path, out, stream)
+    queue.put ((time.perf_counter () - start, resource.getrusage (resource.RUSAGE_SELF).ru_maxrss))
+
+def run (path, out, stream):
+    queue = multiprocessing.Queue ()
+    process = multiprocessing.Process (target = measure, args = (path, out, stream, queue))
+    process.start ()
+    result = queue.get ()
+    process.join ()
+    return result
+
+parser = argparse.ArgumentParser (description = "Benchmark the tpov_gpx writer against gpxpy")
+parser.add_argument ("-n", "--sizes", type = int, nargs = "+", default = [10000, 100000], help = "Number of track points of each test file (gpxpy needs about 14 kB of memory per point)")
+
+def main (args):
+    table = Texttable (max_width = shutil.get_terminal_size ().columns)
+    table.set_deco (Texttable.HEADER)
+    table.set_cols_align (["r", "l", "r", "r", "r"])
+    table.set_cols_dtype (["i", "t", "t", "t", "t"])
+    table.header (["Points", "Writer", "Read + write (s)", "Peak RSS (MB)", "Output (MB)"])
+    with tempfile.TemporaryDirectory () as tmp:
+        for size in args.sizes:
+            path = os.path.join (tmp, f"{size}.gpx")
+            write_track (path, size)
+            outputs = {}
+            for name, stream in (("tpov_gpx", True), ("gpxpy", False)):
+                outputs [name] = os.path.join (tmp, f"{size}.{name}.gpx")
+                seconds, rss = run (path, outputs [name], stream)
+                # ru_maxrss is in kilobytes on Linux and bytes on macOS
+                rss = rss / (1 << 20) if sys.platform == "darwin" else rss / (1 << 10)
+                table.add_row ([size, name, f"{seconds:.2f}", f"{rss:.0f}", f"{os.path.getsize (outputs [name]) / 1e6:.1f}"])
+            if not filecmp.cmp (*outputs.values (), shallow = False):
+                raise ValueError (f"Outputs differ for {size} points")
+            for i in [path, *outputs.values ()]:
+                os.remove (i)
+    print (table.draw ())
+
+if __name__ == "__main__":
+    main (parser.parse_args ())
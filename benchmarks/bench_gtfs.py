@@ -0,0 +1,109 @@
+# Time each step of extracting a trip from a synthetic GTFS feed (see synthetic.py) with tpov_extract.py
+# The first run imports and indexes the feed, the second uses the index. Each run is in a fresh process to measure its peak memory
+# Results are saved as JSON so that they can be compared between commits with --compare
+
+# Built-in modules
+import os, sys, argparse, tempfile, json, time, resource, multiprocessing, builtins, contextlib, io, platform, zipfile
+from datetime import datetime, date
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+from tpov_profile import profiler
+from synthetic import write_gtfs
+from bench_match import commit, phase_times, compare
+
+# Answers to the prompts of from_gtfs: agency, route name, start time, number of trips to display and the trip
+def answers (args):
+    yield from ["0", "1", args.start, str (args.display), "0"]
+    raise ValueError ("Unexpected prompt")
+
+def extract (args, feed, queue, cache):
+    import tpov_extract, tpov_gtfs
+    tpov_gtfs.cache_dir = cache # Index of a zipped feed
+    prompts = answers (args)
+    builtins.input = lambda prompt = "": next (prompts)
+    profiler.enable (memory = args.memory)
+    with contextlib.redirect_stdout (io.StringIO ()):
+        with profiler.phase ("from_gtfs"):
+            trip, get_transfer = tpov_extract.from_gtfs (feed, transfer = True, shape = True, date = args.date)
+        with profiler.phase ("Transfers"):
+            get_transfer (trip)
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS, RUSAGE_CHILDREN includes the indexing processes
+    scale = 1 / (1 << 20) if sys.platform == "darwin" else 1 / (1 << 10)
+    profiler.set ("Peak RSS (MB)", round (resource.getrusage (resource.RUSAGE_SELF).ru_maxrss * scale))
+    profiler.set ("Peak RSS of subprocesses (MB)", round (resource.getrusage (resource.RUSAGE_CHILDREN).ru_maxrss * scale))
+    queue.put ((profiler.phases, profiler.counters, profiler.table ()))
+
+def run (args, feed, cache):
+    queue = multiprocessing.Queue ()
+    process = multiprocessing.Process (target = extract, args = (args, feed, queue, cache))
+    process.start ()
+    result = queue.get ()
+    process.join ()
+    if process.exitcode:
+        raise RuntimeError (f"Extraction failed with exit code {process.exitcode}")
+    return result
+
+parser = argparse.ArgumentParser (description = "Benchmark tpov_extract.py on a synthetic GTFS feed")
+parser.add_argument ("-r", "--routes", type = int, default = 100, help = "Number of routes")
+parser.add_argument ("-t", "--trips", type = int, default = 250, help = "Number of trips of each route")
+parser.add_argument ("-s", "--stops", type = int, default = 40, help = "Number of stops of each trip")
+parser.add_argument ("--duplicates", type = float, default = 0.1, help = "Fraction of weekday trips which are duplicated on another service")
+parser.add_argument ("--seed", type = int, default = 0, help = "Seed of the feed")
+parser.add_argument ("--start", default = "12:00", help = "Start time to search for trips")
+parser.add_argument ("--date", type = date.fromisoformat, help = "Only extract trips running on this date (YYYY-MM-DD), the feed runs in 2024")
+parser.add_argument ("--display", type = int, default = 5, help = "Number of trips to display")
+parser.add_argument ("--feed", metavar = "DIR", help = "Generate the feed in this directory, or use it if it exists (the index is removed before running)")
+parser.add_argument ("--zip", action = "store_true", help = "Extract from a zip file of the feed instead of the directory")
+parser.add_argument ("--memory", action = "store_true", help = "Record the peak memory of each step with tracemalloc (slows down processing)")
+parser.add_argument ("-o", "--output", metavar = "JSON", help = "Save the results, default is bench_gtfs.<commit>.json")
+parser.add_argument ("--compare", metavar = "JSON", help = "Results of a previous run to compare with")
+
+def main (args):
+    with tempfile.TemporaryDirectory () as tmp:
+        feed = args.feed or os.path.join (tmp, "gtfs")
+        if not os.path.exists (os.path.join (feed, "stop_times.txt")):
+            print (f"Generating {args.routes * args.trips * args.stops} stop_times...")
+            start = time.perf_counter ()
+            rows = write_gtfs (feed, args.routes, args.trips, args.stops, args.duplicates, seed = args.seed)
+            print (f"Generated {rows} stop_times in {time.perf_counter () - start:.1f} s")
+        for i in ("stop_times_sorted.txt", "stop_times_sorted.txt.pkl", "tpov_gtfs.sqlite"): # Index of any version
+            if os.path.exists (os.path.join (feed, i)):
+                os.remove (os.path.join (feed, i))
+        size = os.path.getsize (os.path.join (feed, "stop_times.txt"))
+        source = feed
+        if args.zip:
+            source = os.path.join (tmp, "gtfs.zip")
+            print ("Compressing the feed...")
+            with zipfile.ZipFile (source, "w", zipfile.ZIP_DEFLATED) as f:
+                for i in sorted (os.listdir (feed)):
+                    if i.endswith (".txt"):
+                        f.write (os.path.join (feed, i), i)
+
+        phases, counters = {}, {}
+        for name in ("Index", "Indexed"):
+            run_phases, run_counters, table = run (args, source, os.path.join (tmp, "cache"))
+            print (f"{name}:\n{table}\n")
+            phases.update ({f"{name}/{k}": v for k, v in phase_times (run_phases).items ()})
+            counters.update ({f"{name}/{k}": v for k, v in run_counters.items ()})
+
+    results = {
+        "commit": commit (),
+        "date": datetime.now ().isoformat (timespec = "seconds"),
+        "python": platform.python_version (),
+        "machine": platform.machine (),
+        "args": {k: str (v) if k == "date" else v for k, v in vars (args).items () if k not in ("output", "compare", "feed")},
+        "stop_times_size": size,
+        "phases": phases,
+        "counters": counters
+    }
+    output = args.output or f"bench_gtfs.{results ['commit'] or 'unknown'}.json"
+    with open (output, "w") as f:
+        json.dump (results, f, indent = 2)
+    print ("Saved results to", output)
+
+    if args.compare:
+        with open (args.compare, "r") as f:
+            print (compare (results, json.load (f)))
+
+if __name__ == "__main__":
+    main (parser.parse_args ())
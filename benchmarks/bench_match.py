@@ -0,0 +1,173 @@
+# Time each step of tpov_match.py on a synthetic road grid and track (see synthetic.py), without real map data
+# Results are saved as JSON so that they can be compared between commits with --compare
+
+# Built-in modules
+import os, sys, argparse, tempfile, json, shutil, subprocess, platform, contextlib, io
+from datetime import datetime
+
+# Third-party modules
+from texttable import Texttable
+
+sys.path.insert (0, os.path.dirname (os.path.dirname (os.path.abspath (__file__))))
+from tpov_match import load_map, match_gpx, map_matchers, stop_matchers, displays, gpx_snap, load_prior
+from tpov_gpx import Track
+from tpov_profile import profiler
+from synthetic import Grid
+
+def commit ():
+    try:
+        result = subprocess.run (["git", "rev-parse", "--short", "HEAD"], capture_output = True, cwd = os.path.dirname (os.path.abspath (__file__)))
+        return result.stdout.decode ().strip () or None
+    except FileNotFoundError:
+        return None
+
+# Phases keyed by their path ("match_gpx/Map matching"), repeated names are numbered
+def phase_times (phases):
+    times, stack = {}, []
+    for i in phases:
+        del stack [i ["depth"] : ]
+        stack.append (i ["name"])
+        key, n = "/".join (stack), 2
+        while key in times:
+            key, n = f"{'/'.join (stack)} #{n}", n + 1
+        times [key] = {"wall": i ["wall"], "cpu": i ["cpu"]}
+    return times
+
+def match_args (args, params, track, map_path, prior):
+    return dict (
+        track = track,
+        map_path = map_path,
+        start_id = None,
+        matcher_cls = map_matchers [params ["map_matcher"]],
+        use_rtree = params ["use_rtree"],
+        exit_filter = lambda way: eval (params ["exit_filter"], {"way": way}),
+        default_name = params ["default_name"],
+        forward_angle = params ["forward_angle"],
+        follow_link = params ["follow_link"],
+        process_divided = params ["process_divided"],
+        hw_priority = params ["hw_priority"],
+        matcher_params = params ["matcher_params"],
+        prior = prior,
+        corridor = params.get ("corridor", 150),
+        cache_path = track.path + ".match.pkl",
+        cache_params = {"seed": args.seed})
+
+# Turns of the route which were found at the same node and in the same direction
+def turns_found (grid, route, turns, dirs):
+    found = {(i [1], i [6]) for i in dirs}
+    return f"{sum ((grid.node (*route [i]), j) in found for i, j in turns)}/{len (turns)}"
+
+# Match in the corridor on a small grid with streets much further apart than the corridor,
+# so that intersections next to the route have neighbours outside the pruned map
+def long_segments (args, tmp, params):
+    grid = Grid (6, 1000)
+    map_path = os.path.join (tmp, "long." + args.format)
+    gpx_path = os.path.join (tmp, "long.gpx")
+    route, turns = grid.route (args.seed)
+    grid.write_osm (map_path)
+    indices = grid.write_track (gpx_path, route, args.hz, args.speed, args.noise, args.seed)
+    with open (os.path.join (tmp, "long.json"), "w") as f:
+        json.dump (grid.stops (route, indices, args.stop_every, args.hz), f)
+    with profiler.phase ("match_gpx (long segments)"):
+        dirs, *_ = match_gpx (**match_args (args, params, Track.load (gpx_path), map_path, load_prior (os.path.join (tmp, "long.json"))))
+    profiler.set ("Turns found (long segments)", turns_found (grid, route, turns, dirs))
+
+def run (args, tmp, params):
+    grid = Grid (args.size, args.spacing)
+    map_path = os.path.join (tmp, "grid." + args.format)
+    gpx_path = os.path.join (tmp, "track.gpx")
+    route, turns = grid.route (args.seed)
+    with profiler.phase ("Generate"):
+        grid.write_osm (map_path)
+        indices = grid.write_track (gpx_path, route, args.hz, args.speed, args.noise, args.seed)
+        stop_data = grid.stops (route, indices, args.stop_every, args.hz)
+        with open (os.path.join (tmp, "stops.json"), "w") as f:
+            json.dump (stop_data, f)
+
+    with profiler.phase ("Load map (OSM file)"):
+        load_map (map_path, params ["use_rtree"])
+    with profiler.phase ("Load map (pickle)"):
+        load_map (map_path, params ["use_rtree"])
+    with profiler.phase ("Load track"):
+        track = Track.load (gpx_path)
+    profiler.set ("Track points", len (track))
+
+    prior = load_prior (os.path.join (tmp, "stops.json")) if args.corridor else None
+    with profiler.phase ("match_gpx"):
+        dirs, path, map_con, _ = match_gpx (**match_args (args, params, track, map_path, prior))
+    with profiler.phase ("match_gpx (cached)"):
+        match_gpx (**match_args (args, params, track, map_path, prior))
+    profiler.set ("Turns found", turns_found (grid, route, turns, dirs))
+
+    for name, matcher in stop_matchers.items ():
+        with profiler.phase (f"Stop matching ({name})"):
+            stop_indices = matcher (track, stop_data, path, map_con, params.get ("stop_params", {}))
+    with profiler.phase ("Parse document"):
+        gpx = track.document ()
+    with profiler.phase ("Display"):
+        metadata, fields = displays [params ["display_params"] ["display"]] (track, dirs, params ["display_params"], stop_indices, stop_data)
+    if params ["snap_gpx"] is not False:
+        with profiler.phase ("Snap"):
+            gpx_snap (track, map_con, path, params ["snap_gpx"])
+    gpx.name = "tpov"
+    with profiler.phase ("Write GPX"):
+        track.write (os.path.join (tmp, "track.matched.gpx"), gpx, fields)
+    if args.corridor:
+        long_segments (args, tmp, params)
+
+def compare (results, previous):
+    table = Texttable (max_width = shutil.get_terminal_size ().columns)
+    table.set_deco (Texttable.HEADER)
+    table.set_cols_align (["l", "r", "r", "r"])
+    table.set_cols_dtype (["t", "t", "t", "t"])
+    table.header (["Phase", f"{previous ['commit']} (s)", f"{results ['commit']} (s)", "Change"])
+    for k in dict.fromkeys ([*previous ["phases"], *results ["phases"]]):
+        old, new = previous ["phases"].get (k, {}).get ("wall"), results ["phases"].get (k, {}).get ("wall")
+        change = f"{(new - old) / old:+.0%}" if old and new is not None else ""
+        table.add_row ([k, f"{old:.3f}" if old is not None else "", f"{new:.3f}" if new is not None else "", change])
+    return table.draw ()
+
+parser = argparse.ArgumentParser (description = "Benchmark tpov_match.py on a synthetic road grid and track")
+parser.add_argument ("-n", "--size", type = int, default = 20, help = "Number of streets and avenues of the grid")
+parser.add_argument ("--spacing", type = float, default = 200, help = "Distance between streets in metres")
+parser.add_argument ("--hz", type = float, default = 1, help = "Track points per second")
+parser.add_argument ("--speed", type = float, default = 10, help = "Speed of the track in m/s")
+parser.add_argument ("--noise", type = float, default = 5, help = "Standard deviation of the GPS noise in metres")
+parser.add_argument ("--stop-every", type = int, default = 3, help = "Place a stop after every n-th intersection of the route")
+parser.add_argument ("--seed", type = int, default = 0, help = "Seed of the route and noise")
+parser.add_argument ("--format", default = "osm.pbf", choices = ["osm", "osm.pbf", "opl"], help = "Format of the map file")
+parser.add_argument ("--corridor", action = "store_true", help = "Match in a corridor around the route shape like tpov_match.py with a __shape__, also checks a grid with long streets")
+parser.add_argument ("--params", default = os.path.join (os.path.dirname (os.path.dirname (os.path.abspath (__file__))), "match_params.json"), help = "Matching parameters")
+parser.add_argument ("-o", "--output", metavar = "JSON", help = "Save the results, default is bench_match.<commit>.json")
+parser.add_argument ("--compare", metavar = "JSON", help = "Results of a previous run to compare with")
+parser.add_argument ("-v", "--verbose", action = "store_true", help = "Show the output of tpov_match")
+
+def main (args):
+    with open (args.params, "r") as f:
+        params = json.load (f)
+    profiler.enable (memory = False) # tracemalloc would distort the times
+    with tempfile.TemporaryDirectory () as tmp:
+        with contextlib.redirect_stdout (sys.stdout if args.verbose else io.StringIO ()):
+            run (args, tmp, params)
+    print (profiler.table ())
+
+    results = {
+        "commit": commit (),
+        "date": datetime.now ().isoformat (timespec = "seconds"),
+        "python": platform.python_version (),
+        "machine": platform.machine (),
+        "args": {k: v for k, v in vars (args).items () if k not in ("output", "compare", "verbose")},
+        "phases": phase_times (profiler.phases),
+        "counters": profiler.counters
+    }
+    output = args.output or f"bench_match.{results ['commit'] or 'unknown'}.json"
+    with open (output, "w") as f:
+        json.dump (results, f, indent = 2)
+    print ("Saved results to", output)
+
+    if args.compare:
+        with open (args.compare, "r") as f:
+            print (compare (results, json.load (f)))
+
+if __name__ == "__main__":
+    main (parser.parse_args ())
@@ -0,0 +1,199 @@
+# Synthetic road grids, GPS tracks and stops for benchmarks, so that they can run without real map data
+# The grid has streets (rows, west to east) and avenues (columns, south to north), with one divided street of two one-way carriageways
+# Tracks drive from the south west to the north east corner, only going east or north so that there are no U-turns or loops
+# GTFS feeds have routes running along the streets and avenues of a grid of stops, see write_gtfs
+
+# Built-in modules
+import os, math, random
+from datetime import datetime, timedelta, timezone
+
+# Third-party modules
+import osmium
+
+class Grid:
+    def __init__ (self, size, spacing = 200, lat = 49.8, lon = -97.2):
+        self.size, self.spacing = size, spacing # Number of streets and avenues, distance between them in metres
+        self.lat, self.lon = lat, lon # South west corner
+        self.divided = size // 2 # Row of the divided street
+        self.dlat = spacing / 111320
+        self.dlon = spacing / (111320 * math.cos (math.radians (lat)))
+
+    # Node ID of an intersection, side is 1 for the westbound (north) and 2 for the eastbound (south) carriageway of the divided street
+    def node (self, row, col, side = 0):
+        return (row * self.size + col) * 3 + side + 1
+
+    def pos (self, row, col, side = 0):
+        offset = {0: 0, 1: 0.1, 2: -0.1} [side] * self.dlat # Carriageways are 10% of the spacing apart
+        return self.lat + row * self.dlat + offset, self.lon + col * self.dlon
+
+    def ways (self): # [(nodes, tags), ...]
+        ways = []
+        for row in range (self.size):
+            highway = "primary" if row % 3 == 0 else "residential"
+            if row == self.divided:
+                ways.append (([self.node (row, col, 2) for col in range (self.size)], {"highway": "primary", "name": "Divided Boulevard", "oneway": "yes"}))
+                ways.append (([self.node (row, col, 1) for col in reversed (range (self.size))], {"highway": "primary", "name": "Divided Boulevard", "oneway": "yes"}))
+            else:
+                ways.append (([self.node (row, col) for col in range (self.size)], {"highway": highway, "name": f"Street {row}"}))
+        for col in range (self.size):
+            nodes = []
+            for row in range (self.size):
+                nodes += [self.node (row, col, 2), self.node (row, col, 1)] if row == self.divided else [self.node (row, col)]
+            ways.append ((nodes, {"highway": "secondary" if col % 4 == 0 else "residential", "name": f"Avenue {col}"}))
+        if self.size > 2: # Unnamed one-way link between the first two streets, excluded as an exit by the default exit_filter
+            ways.append (([self.node (0, 1), self.node (1, 2)], {"highway": "secondary_link", "oneway": "yes"}))
+        return ways
+
+    # Write the grid to an OSM file, the format is chosen from the extension (.osm, .osm.pbf, .opl)
+    # .o5m can be read but not written by osmium, convert the .osm file with osmconvert if needed
+    def write_osm (self, path):
+        writer = osmium.SimpleWriter (path)
+        try:
+            for row in range (self.size):
+                for col in range (self.size):
+                    for side in ((1, 2) if row == self.divided else (0,)):
+                        lat, lon = self.pos (row, col, side)
+                        writer.add_node (osmium.osm.mutable.Node (id = self.node (row, col, side), location = (lon, lat), version = 1))
+            for i, (nodes, tags) in enumerate (self.ways (), 1):
+                writer.add_way (osmium.osm.mutable.Way (id = i, nodes = nodes, tags = tags, version = 1))
+        finally:
+            writer.close ()
+
+    # Random route from the south west to the north east corner, [(row, col, side), ...] and the turns [(route index, "left" | "right"), ...]
+    def route (self, seed = 0):
+        moves = ["east", "north"] * (self.size - 1)
+        random.Random (seed).shuffle (moves)
+        route, turns, row, col = [(0, 0, 0)], [], 0, 0
+        for i, move in enumerate (moves):
+            if i and move != moves [i - 1]: # Turn at the current intersection
+                turns.append ((len (route) - 1, "left" if move == "north" else "right"))
+            if move == "north":
+                if row == self.divided: # Leave the divided street from the westbound carriageway
+                    route.append ((row, col, 1))
+                row += 1
+            else:
+                col += 1
+            route.append ((row, col, 2 if row == self.divided else 0)) # Drive east on the eastbound carriageway
+        return route, turns
+
+    # Write a noisy GPS track along the route at `hz` points per second, returns the index of the track point at each route node
+    def write_track (self, path, route, hz = 1, speed = 10, noise = 5, seed = 0):
+        rng = random.Random (seed)
+        start = datetime (2024, 1, 1, 12, tzinfo = timezone.utc)
+        points, indices = [], []
+        for a, b in zip (route, route [1:]):
+            (lat1, lon1), (lat2, lon2) = self.pos (*a), self.pos (*b)
+            length = math.hypot ((lat2 - lat1) * 111320, (lon2 - lon1) * 111320 * math.cos (math.radians (lat1)))
+            count = max (1, round (length / speed * hz))
+            indices.append (len (points))
+            for i in range (count):
+                points.append ((lat1 + (lat2 - lat1) * i / count + rng.gauss (0, noise / 111320),
+                                lon1 + (lon2 - lon1) * i / count + rng.gauss (0, noise / 111320 / math.cos (math.radians (lat1)))))
+        indices.append (len (points))
+        points.append (self.pos (*route [-1]))
+        with open (path, "w") as f:
+            f.write ('<?xml version="1.0" encoding="UTF-8"?>\n<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="tpov">\n<trk><trkseg>\n')
+            for i, (lat, lon) in enumerate (points):
+                time = (start + timedelta (seconds = i / hz)).strftime ("%Y-%m-%dT%H:%M:%S.%fZ")
+                f.write (f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>230.0</ele><time>{time}</time></trkpt>\n')
+            f.write ("</trkseg></trk>\n</gpx>\n")
+        return indices
+
+    # Stops in the format of tpov_extract.py at every `every` route nodes, 20 m after the intersection, timed from the track
+    def stops (self, route, indices, every = 3, hz = 1):
+        start = datetime (2024, 1, 1, 12)
+        stops = []
+        for i in range (0, len (route) - 1, every):
+            (lat1, lon1), (lat2, lon2) = self.pos (*route [i]), self.pos (*route [i + 1])
+            ratio = min (20 / self.spacing, 0.5)
+            time = start + timedelta (seconds = (indices [i] + (indices [i + 1] - indices [i]) * ratio) / hz)
+            stops.append ({
+                "stop_id": str (len (stops)),
+                "stop_name": f"Stop {len (stops)}",
+                "stop_lat": lat1 + (lat2 - lat1) * ratio,
+                "stop_lon": lon1 + (lon2 - lon1) * ratio,
+                "__transfer__": ["Route 2"] if len (stops) % 4 == 1 else [],
+                "arrival_time": time.strftime ("%H:%M:%S"),
+                "departure_time": time.strftime ("%H:%M:%S")
+            })
+        return {
+            "__sourcetype__": "GTFS",
+            "route_id": "1",
+            "route_long_name": "Synthetic Route",
+            "agency_name": "tpov",
+            "__shape__": [list (self.pos (*i)) [::-1] for i in route], # [lon, lat] like GTFS shapes
+            "__stops__": stops
+        }
+
+# Write a GTFS feed to `directory` with `routes` routes of `trips` trips serving `stops` stops each, stop_times.txt has routes * trips * stops rows
+# Trips run on weekdays, Saturdays or Sundays (calendar.txt) with holidays in calendar_dates.txt, and `duplicates` of them are copies
+# of another trip on a second weekday service, like the duplicated trips of feeds merged from several schedule periods
+# Rows of stop_times.txt are grouped by trip in a random order of trips, hours are not zero-padded, as in many real feeds
+def write_gtfs (directory, routes = 100, trips = 100, stops = 40, duplicates = 0.1, spacing = 300, seed = 0):
+    rng = random.Random (seed)
+    grid = Grid (max (stops, math.isqrt (routes * stops)) + 1, spacing)
+    os.makedirs (directory, exist_ok = True)
+    path = lambda name: os.path.join (directory, name)
+
+    with open (path ("agency.txt"), "w") as f:
+        f.write ("agency_id,agency_name,agency_url,agency_timezone\n")
+        f.write ("1,Synthetic Transit,https://example.com,America/Winnipeg\n2,Synthetic Express,https://example.com/express,America/Winnipeg\n")
+    with open (path ("calendar.txt"), "w") as f:
+        f.write ("service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n")
+        for service, days in (("WK", "1,1,1,1,1,0,0"), ("WK2", "1,1,1,1,1,0,0"), ("SA", "0,0,0,0,0,1,0"), ("SU", "0,0,0,0,0,0,1")):
+            f.write (f"{service},{days},20240101,20241231\n")
+    with open (path ("calendar_dates.txt"), "w") as f: # Holidays run on the Sunday service
+        f.write ("service_id,date,exception_type\n")
+        for date in ("20240101", "20240520", "20240701", "20240902", "20241225"):
+            f.write (f"WK,{date},2\nWK2,{date},2\nSU,{date},1\n")
+
+    # Routes run east or north along a street or avenue of the grid, starting at a random stop
+    lines = []
+    with open (path ("routes.txt"), "w") as f, open (path ("shapes.txt"), "w") as shapes:
+        f.write ("route_id,agency_id,route_short_name,route_long_name,route_type\n")
+        shapes.write ("shape_id,shape_pt_lat,shape_pt_lon,shape_pt_sequence\n")
+        for i in range (routes):
+            north, fixed, first = rng.random () < 0.5, rng.randrange (grid.size), rng.randrange (grid.size - stops + 1)
+            line = [(j, fixed) if north else (fixed, j) for j in range (first, first + stops)]
+            lines.append (line)
+            f.write (f"{i},{i % 10 // 9 + 1},{i + 1},{'Avenue' if north else 'Street'} {fixed} Line,3\n") # Every 10th route is run by the second agency
+            for j in range (len (line) * 4 - 3): # 3 shape points between stops
+                (lat1, lon1), (lat2, lon2) = grid.pos (*line [j // 4]), grid.pos (*line [min (j // 4 + 1, len (line) - 1)])
+                shapes.write (f"{i},{lat1 + (lat2 - lat1) * (j % 4) / 4:.6f},{lon1 + (lon2 - lon1) * (j % 4) / 4:.6f},{j + 1}\n")
+    with open (path ("stops.txt"), "w") as f:
+        f.write ("stop_id,stop_name,stop_lat,stop_lon\n")
+        for row, col in sorted ({j for i in lines for j in i}):
+            lat, lon = grid.pos (row, col)
+            f.write (f"{row}-{col},Street {row} @ Avenue {col},{lat:.6f},{lon:.6f}\n")
+
+    # Trips of each route are spread between 05:00 and 25:00, stops are 60 to 150 seconds apart
+    schedule = []
+    with open (path ("trips.txt"), "w") as f:
+        f.write ("route_id,service_id,trip_id,trip_headsign,shape_id\n")
+        for i, line in enumerate (lines):
+            headsign = f"To Street {line [-1] [0]} @ Avenue {line [-1] [1]}"
+            for j in range (trips):
+                service = ("WK", "WK", "WK", "SA", "SU") [j % 5]
+                start = 5 * 3600 + j * 20 * 3600 // trips
+                schedule.append ((f"{i}-{j}", line, start))
+                f.write (f"{i},{service},{i}-{j},{headsign},{i}\n")
+                if service == "WK" and rng.random () < duplicates:
+                    schedule.append ((f"{i}-{j}-2", line, start))
+                    f.write (f"{i},WK2,{i}-{j}-2,{headsign},{i}\n")
+    rng.shuffle (schedule)
+    rows = 0
+    with open (path ("stop_times.txt"), "w") as f:
+        f.write ("trip_id,arrival_time,departure_time,stop_id,stop_sequence\n")
+        for trip, line, start in schedule:
+            gaps = random.Random (f"{seed}-{trip.removesuffix ('-2')}") # Duplicates have the same times as the original trip
+            time, rows = start, rows + len (line)
+            block = []
+            for k, (row, col) in enumerate (line):
+                clock = f"{time // 3600}:{time // 60 % 60:02d}:{time % 60:02d}"
+                block.append (f"{trip},{clock},{clock},{row}-{col},{k + 1}\n")
+                time += gaps.randint (60, 150)
+            f.writelines (block)
+    return rows
+
+if __name__ == "__main__":
+    raise SystemExit ("This file contains functions used by other programs. It should not be run directly.")
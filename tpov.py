@@ -20,7 +20,11 @@ parser = argparse.ArgumentParser (
     formatter_class = argparse.RawDescriptionHelpFormatter,
     epilog = """"""
 )
+parser.add_argument ("--trace", metavar = "JSON", help = "Save the time taken by each command and its steps in Chrome trace event format (open in chrome://tracing or https://ui.perfetto.dev)")
 args = parser.parse_args ()
+trace = args.trace and os.path.abspath (args.trace) # Commands may change the working directory
+if trace:
+    profiler.enable (memory = False)
 
 if not os.path.exists (proj_path ("tpov_commands.json")):
     raise FileNotFoundError ("Commands file not found")
@@ -64,16 +68,22 @@ cmds = json.loads (cmds) ["cmds"]
 choicetable (["Commands"], ((i, ) for i in cmds))
 cmds = choice (cmds, "Choose commands to run: ", 1)
 
-for i in cmds:
-    print (f"Running command {i}")
-    if i.startswith ("tpov_"):
-        try:
-            tpov_commands [i.split () [0] [5 : ]] (i.split (None, 1) [1])
-        except Exception as e:
-            print (f"Error running command {i}")
-            raise e
-        except SystemExit as e:
-            print (f"Command {i} exited.")
-            raise e
-    else:
-        cmd = subprocess.run (shlex.split (i), stdout = sys.stdout, stderr = sys.stderr)
\ No newline at end of file
+try:
+    for i in cmds:
+        print (f"Running command {i}")
+        if i.startswith ("tpov_"):
+            try:
+                with profiler.phase (i.split () [0], "command", command = i):
+                    tpov_commands [i.split () [0] [5 : ]] (i.split (None, 1) [1])
+            except Exception as e:
+                print (f"Error running command {i}")
+                raise e
+            except SystemExit as e:
+                print (f"Command {i} exited.")
+                raise e
+        else:
+            with profiler.phase (os.path.basename (shlex.split (i) [0]), "subprocess", command = i):
+                cmd = subprocess.run (shlex.split (i), stdout = sys.stdout, stderr = sys.stderr)
+finally:
+    if trace:
+        profiler.save_trace (trace)
\ No newline at end of file
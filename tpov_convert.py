@@ -21,7 +21,8 @@ def main (args):
         o5m_file = os.path.splitext (map_file) [0] + ".temp.o5m" # Temporary file
         sys.stdout.flush () # Force print to display before running subprocess
         sys.stderr.flush ()
-        osmconvert = subprocess.run (["osmconvert", map_file, "-o=" + o5m_file], stdout = sys.stdout, stderr = sys.stderr)
+        with profiler.phase ("osmconvert", "subprocess", file = map_file):
+            osmconvert = subprocess.run (["osmconvert", map_file, "-o=" + o5m_file], stdout = sys.stdout, stderr = sys.stderr)
         osmconvert.check_returncode ()
     else:
         o5m_file = map_file
@@ -30,7 +31,8 @@ def main (args):
     output_file = os.path.splitext (map_file) [0] + ".filtered.o5m"
     sys.stdout.flush ()
     sys.stderr.flush ()
-    osmfilter = subprocess.run (["osmfilter", o5m_file, "--parameter-file=" + filter_file, "-o=" + output_file], stdout = sys.stdout, stderr = sys.stderr)
+    with profiler.phase ("osmfilter", "subprocess", file = o5m_file):
+        osmfilter = subprocess.run (["osmfilter", o5m_file, "--parameter-file=" + filter_file, "-o=" + output_file], stdout = sys.stdout, stderr = sys.stderr)
     osmfilter.check_returncode ()
     print (f"Saved filtered .o5m file as {output_file}")
 
@@ -0,0 +1,48 @@
+# Built-in modules
+import os, argparse
+
+from tpov_functions import *
+from tpov_gpx import Track, expand_fields
+
+# Write every tpov.* field at every point of a GPX file written with tpov_match.py --delta
+def expand (gpx_path):
+    track = Track.load (gpx_path)
+    gpx = track.document ()
+    encoding = [i for i in gpx.metadata_extensions if i.tag == "tpov.__encoding__"]
+    if not encoding or encoding [0].text != "delta":
+        raise SystemExit (f"{gpx_path} is not delta encoded, nothing to expand.")
+    gpx.metadata_extensions.remove (encoding [0])
+
+    # Take the fields out of the points and write them again, expanded
+    if track.skeleton is None: # Written through gpxpy
+        fields = [{i.tag: i.text or "" for i in j.extensions} for j in track.points]
+        for i in track.points:
+            i.extensions = []
+    else:
+        extensions, track.extensions = track.extensions, {}
+        fields = (dict (extensions.get (i, [])) for i in range (len (track)))
+
+    gpx_out = os.path.abspath (os.path.splitext (gpx_path) [0] + ".expanded.gpx")
+    track.write (gpx_out, gpx, expand_fields (fields))
+    print ("Saved expanded file to", gpx_out)
+
+parser = argparse.ArgumentParser (
+    description = "Expand delta encoded tpov.* fields",
+    formatter_class = argparse.RawDescriptionHelpFormatter,
+    epilog = """\
+tpov_match.py --delta only writes each tpov.* field at the points where its value changes.
+This program writes every field at every point again, which is required by programs
+that do not understand the encoding (e.g. gopro-dashboard-overlay).
+"""
+)
+parser.add_argument ("gpx", help = "The delta encoded gpx file to expand")
+
+def main (args):
+    expand (args.gpx)
+
+def script (args):
+    import shlex
+    main (parser.parse_args (shlex.split (args)))
+
+if __name__ == "__main__":
+    main (parser.parse_args ())
@@ -1,8 +1,10 @@
 # Built-in modules:
-import os, bisect, json, csv, argparse, pickle, subprocess, re, hashlib, time, threading
+import os, bisect, json, argparse, re, hashlib, time, threading
+from datetime import date, timedelta
 from zoneinfo import ZoneInfo
 
 from tpov_functions import *
+from tpov_gtfs import GTFSStore, pad_time
 
 global _stop_fields # {source: ([display fields], [field keys])}
 _stop_fields = {
@@ -30,19 +32,9 @@ core_tags = {
     "Stop": ("stop_id", "stop_name", "stop_lat", "stop_lon", "__transfer__")
 }
 
-def stripped_DictReader (f, fieldnames = None):
-    for i in csv.DictReader (f, fieldnames = fieldnames):
-        yield {k.strip (): v.strip () for k, v in i.items ()}
-
-def from_gtfs (gtfs_dir, transfer = True, shape = False):
-    # Third-party modules:
-    from tqdm import tqdm
-
-    orig = os.getcwd () # Save original working directory
-    os.chdir (gtfs_dir)
-
-    with open ("agency.txt", encoding = "utf-8-sig") as f:
-        agency = tuple (stripped_DictReader (f))
+def from_gtfs (gtfs_path, transfer = True, shape = False, date = None): # date (datetime.date) restricts trips to the services running on it
+    with GTFSStore (gtfs_path) as store: # Directory or zip file, imports the feed if it changed since the last extraction
+        agency = store.agencies ()
         if len (agency) > 1:
             choicetable (
                 ["Name", "URL"],
@@ -52,184 +44,137 @@ def from_gtfs (gtfs_dir, transfer = True, shape = False):
         else:
             agency = agency [0]
     
-    route_name = input ("Enter the route short_name or long_name: ").lower ()
-    if not route_name:
-        raise ValueError ("Route name cannot be empty.")
-
-    print ("Searching for route...")
-    route, route_names = [], {}
-    with open ("routes.txt", encoding = "utf-8-sig") as f:
-        for i in stripped_DictReader (f):
-            if route_name in (i ["route_short_name"].lower (), i ["route_long_name"].lower ()) and ("agency_id" not in i or i ["agency_id"] == agency ["agency_id"]):
-                route.append (i)
-            route_names [i ["route_id"]] = i ["route_short_name"] if i ["route_short_name"] else i ["route_long_name"]
-    route_ids = set (i ["route_id"] for i in route)
-    if not route:
-        print (f"Route '{route_name}' not found.")
-        raise SystemExit
-    elif len (route) > 1:
-        keys = tuple (route [0].keys ())
+        route_name = input ("Enter the route short_name or long_name: ").lower ()
+        if not route_name:
+            raise ValueError ("Route name cannot be empty.")
+
+        print ("Searching for route...")
+        with profiler.phase ("Read routes"):
+            route = store.find_routes (route_name, agency.get ("agency_id"))
+            route_ids = set (i ["route_id"] for i in route)
+            if not route:
+                print (f"Route '{route_name}' not found.")
+                raise SystemExit
+            elif len (route) > 1:
+                keys = tuple (route [0].keys ())
+                choicetable (
+                    keys,
+                    ([i [j] for j in keys] for i in route)
+                )
+                print (f"Multiple routes with name '{route_name}' found. All routes will be included in the search for trips.")
+                route = next (choice (route, "Select which route's information to use for metadata: ", 1, 1))
+            else:
+                route = route [0]
+
+        start_time = input ("Enter the time the vehicle left the first stop in HH(:mm)(:ss) format, or a path to the recording video: ")
+        previous = None # Services of the day before the video, their trips after midnight run on the date of the video
+        if os.path.exists (start_time):
+            start, _ = video_time (start_time, True) # Return datetime object
+            start = start.astimezone (ZoneInfo (agency ["agency_timezone"]))
+            start_time = start.strftime ("%H:%M:%S")
+            print (f"Extracted start time from video: {start_time}")
+            if date is None:
+                date = start.date ()
+                previous = store.services (date - timedelta (days = 1))
+
+        if date:
+            services = store.services (date)
+            if services is None:
+                print ("The feed has no calendar, trips of all dates are included.")
+            else:
+                print (f"{len (services)} services run on {date.isoformat ()}, only their trips are included.")
+        else:
+            services = None
+
+        print ("Searching for trips...")
+        with profiler.phase ("Read trips"):
+            trip_ids, dup = store.trips (route_ids, services = services) # Without duplicates
+            print (f"{len (trip_ids) + dup} trips found.")
+            print (f"Removed {dup} duplicate trips, {len (trip_ids)} remaining.")
+            late = store.trips (route_ids, services = previous, after = "24:00:00") [0] if previous else [] # Only trips leaving after midnight
+
+        print ("Reading stop information...")
+        with profiler.phase ("Read stop_times"):
+            stop_times = store.stop_times (i ["trip_id"] for i in trip_ids + late)
+            for i in trip_ids + late:
+                i ["__stops__"] = stop_times [i ["trip_id"]]
+                for j in i ["__stops__"]:
+                    # Convert departure_time from H:mm:ss to HH:mm:ss if necessary
+                    j ["departure_time"] = pad_time (j ["departure_time"])
+
+        # Trips of the previous service day which leave after midnight, e.g. 25:10:00 for a video starting at 01:10:00
+        if late:
+            print (f"{len (late)} trips of {(date - timedelta (days = 1)).isoformat ()} leaving after midnight included.")
+        late_ids = {id (i) for i in late}
+        trip_ids += late
+        if not trip_ids:
+            raise ValueError (f"No trips of route '{route_name}' found{' on ' + date.isoformat () if services is not None else ''}.")
+
+        def departure (trip): # Departure time of the first stop, 24 hours earlier for trips of the previous service day
+            time = trip ["__stops__"] [0] ["departure_time"]
+            return f"{int (time [ : 2]) - 24:02d}{time [2 : ]}" if id (trip) in late_ids else time
+
+        # Sort by departure_time of first stop
+        trip_ids.sort (key = departure)
+
+        num_trips = int (input (f"Enter the number of trips to display: "))
+        trip = bisect.bisect_left (trip_ids, start_time, key = departure)
+        if trip + num_trips // 2 >= len (trip_ids):
+            trips_display = trip_ids [-num_trips : ]
+        elif trip < (num_trips + 1) // 2:
+            trips_display = trip_ids [ : num_trips]
+        else:
+            trips_display = trip_ids [trip - (num_trips + 1) // 2 : trip + num_trips // 2]
+
+        print ("Searching for stop information...")
+        with profiler.phase ("Search stops"):
+            stops = store.stops (set (j ["stop_id"] for i in trips_display for j in i ["__stops__"]))
+
+            linehash = {}
+            for i in trips_display:
+                h = hashlib.md5 ()
+                for j in i ["__stops__"]:
+                    j.update (stops [j ["stop_id"]])
+                    h.update (j ["stop_id"].encode ())
+                linehash [i ["trip_id"]] = h.hexdigest ()
+
+        # Final format of trips_display:
+        # [{fields from trips.txt, "__stops__": [{fields from stop_times.txt + fields from stops.txt}, ...]}, ...]
+
         choicetable (
-            keys,
-            ([i [j] for j in keys] for i in route)
+            ["Headsign", "From", "To", "Depart", "Arrive", "Trip ID", "Stops Hash"],
+            ([
+                i ["trip_headsign"] if "trip_headsign" in i else f"{route ['route_short_name']} {route ['route_long_name']}",
+                i ["__stops__"] [0] ["stop_name"],
+                i ["__stops__"] [-1] ["stop_name"],
+                i ["__stops__"] [0] ["departure_time"],
+                i ["__stops__"] [-1] ["departure_time"],
+                i ["trip_id"],
+                linehash [i ["trip_id"]]
+            ] for i in trips_display)
         )
-        print (f"Multiple routes with name '{route_name}' found. All routes will be included in the search for trips.")
-        route = next (choice (route, "Select which route's information to use for metadata: ", 1, 1))
-    else:
-        route = route [0]
-
-    print ("Searching for trips...")
-    trip_names = {}
-    with open ("trips.txt", encoding = "utf-8-sig") as f:
-        trip_ids = []
-        for i in stripped_DictReader (f):
-            if i ["route_id"] in route_ids:
-                trip_ids.append (i)
-            trip_names [i ["trip_id"]] = route_names [i ["route_id"]]
-    del route_names # Free up memory
-
-    print (f"{len (trip_ids)} trips found.")
-    if not (os.path.exists ("stop_times_sorted.txt") and os.path.exists ("stop_times_sorted.txt.pkl")): # Index stop_times for faster lookup
-        with open ("stop_times.txt", encoding = "utf-8-sig") as f:
-            header = iter (csv.reader (f)).__next__ ()
-            ti, ss = header.index ("trip_id") + 1, header.index ("stop_sequence") + 1
-        
-        with open ("stop_times_sorted.txt", "w") as f:
-            writer = csv.writer (f)
-            writer.writerow (header)
-        # Reopen file as subprocess seem to reset the file pointer
-        with open ("stop_times_sorted.txt", "a") as f:
-            print ("Sorting stop_times (this may take a while)...")
-            sort = subprocess.run (f"LC_ALL=C cat -u stop_times.txt | tail -n +2 | sort -t , -k {ti},{ti} -k {ss},{ss}n", shell = True, stdout = f)
-
-        lines = subprocess.run (["wc", "-l", "stop_times_sorted.txt"], capture_output = True)
-        lines.check_returncode ()
-        lines = int (lines.stdout.decode ().split () [0])
-        line_cnt = tqdm (total = lines, desc = "Indexing stop_times", mininterval = 0.5)
-        ti -= 1 # Convert to 0-based index
-        with open ("stop_times_sorted.txt", encoding = "utf-8-sig") as f: # May be able to be optimized using csv module
-            f.readline () # Skip header
-            indices, last_id, fileptr, si = {}, None, f.tell (), header.index ("stop_id")
-            line, transfers = f.readline (), {}
-            h, linehash, dups, num_trips = hashlib.md5 (), set (), 0, 0
-            while line:
-                line_cnt.update ()
-                line = line.strip ().split (",") # CSV format
-                if line [ti] != last_id: # New trip_id
-                    h = h.hexdigest ()
-                    if h in linehash:
-                        dups += 1
-                    else:
-                        indices [line [ti]] = fileptr
-                        linehash.add (h)
-                    h = hashlib.md5 ()
-                    last_id = line [ti]
-                    num_trips += 1
-
-                h.update (",".join (i for j, i in enumerate (line) if j != ti and j != ss).encode ()) # Only check useful fields for duplicates
-                transfers.setdefault (line [si], set ()).add (trip_names [line [ti]]) # Map route_short_name to stop
-                fileptr = f.tell () # Save file pointer at beginning of line
-                line = f.readline ()
-            line_cnt.close ()
-
-            with open ("stop_times_sorted.txt.pkl", "wb") as f:
-                pickle.dump ((indices, transfers), f)
-            print (f"Sorted and indexed {num_trips} trips, {len (indices)} unique, {dups} duplicates.")
-
-    print ("Reading stop information...")
-    with open ("stop_times_sorted.txt.pkl", "rb") as f:
-        indices, transfers = pickle.load (f)
-    dup = len (trip_ids)
-    trip_ids = [i for i in trip_ids if i ["trip_id"] in indices] # Remove duplicates
-    print (f"Removed {dup - len (trip_ids)} duplicate trips, {len (trip_ids)} remaining.")
-
-    with open ("stop_times_sorted.txt", encoding = "utf-8-sig") as f:
-        header = tuple (i.strip () for i in iter (csv.reader (f)).__next__ ())
-        for i in trip_ids:
-            f.seek (indices [i ["trip_id"]]) # Seek to file pointer of trip_id
-            line = stripped_DictReader (f, fieldnames = header)
-            for j in line:
-                if j ["trip_id"] != i ["trip_id"]:
-                    break
-                # Convert departure_time from H:mm:ss to HH:mm:ss if necessary
-                j ["departure_time"] = ("0" + j ["departure_time"].strip ()) [-8 : ]
-                i.setdefault ("__stops__", []).append (j)
-
-    start_time = input ("Enter the time the vehicle left the first stop in HH(:mm)(:ss) format, or a path to the recording video: ")
-    if os.path.exists (start_time):
-        start, _ = video_time (start_time, True) # Return datetime object
-        start_time = start.astimezone (ZoneInfo (agency ["agency_timezone"])).strftime ("%H:%M:%S")
-        print (f"Extracted start time from video: {start_time}")
-
-    # Sort by departure_time of first stop
-    trip_ids.sort (key = lambda x: x ["__stops__"] [0] ["departure_time"])
-
-    num_trips = int (input (f"Enter the number of trips to display: "))
-    trip = bisect.bisect_left (trip_ids, start_time, key = lambda x: x ["__stops__"] [0] ["departure_time"])
-    if trip + num_trips // 2 >= len (trip_ids):
-        trips_display = trip_ids [-num_trips : ]
-    elif trip < (num_trips + 1) // 2:
-        trips_display = trip_ids [ : num_trips]
-    else:
-        trips_display = trip_ids [trip - (num_trips + 1) // 2 : trip + num_trips // 2]
-
-    stops = {} # set (j ["stop_id"] for i in trips_display for j in i ["__stops__"])
-    print ("Searching for stop information...")
-    for i in trips_display:
-        for j in i ["__stops__"]:
-            stops [j ["stop_id"]] = None
-    with open ("stops.txt", encoding = "utf-8-sig") as f:
-        for i in stripped_DictReader (f):
-            if i ["stop_id"] in stops:
-                stops [i ["stop_id"]] = i
-
-    linehash = {}
-    for i in trips_display:
-        h = hashlib.md5 ()
-        for j in i ["__stops__"]:
-            j.update (stops [j ["stop_id"]])
-            h.update (j ["stop_id"].encode ())
-        linehash [i ["trip_id"]] = h.hexdigest ()
-
-    # Final format of trips_display:
-    # [{fields from trips.txt, "__stops__": [{fields from stop_times.txt + fields from stops.txt}, ...]}, ...]
+        trip = next (choice (trips_display, "Select one trip: ", 1, 1))
 
-    choicetable (
-        ["Headsign", "From", "To", "Depart", "Arrive", "Trip ID", "Stops Hash"],
-        ([
-            i ["trip_headsign"] if "trip_headsign" in i else f"{route ['route_short_name']} {route ['route_long_name']}",
-            i ["__stops__"] [0] ["stop_name"],
-            i ["__stops__"] [-1] ["stop_name"],
-            i ["__stops__"] [0] ["departure_time"],
-            i ["__stops__"] [-1] ["departure_time"],
-            i ["trip_id"],
-            linehash [i ["trip_id"]]
-        ] for i in trips_display)
-    )
-    trip = next (choice (trips_display, "Select one trip: ", 1, 1))
+        trip.update (route)
+        trip.update (agency)
+        trip ["__sourcetype__"] = "GTFS"
+        # As only one of route_short_name or route_long_name is required, fill in the other if empty
+        if not trip ["route_short_name"]:
+            trip ["route_short_name"] = trip ["route_long_name"]
+        elif not trip ["route_long_name"]:
+            trip ["route_long_name"] = trip ["route_short_name"]
 
-    trip.update (route)
-    trip.update (agency)
-    trip ["__sourcetype__"] = "GTFS"
-    # As only one of route_short_name or route_long_name is required, fill in the other if empty
-    if not trip ["route_short_name"]:
-        trip ["route_short_name"] = trip ["route_long_name"]
-    elif not trip ["route_long_name"]:
-        trip ["route_long_name"] = trip ["route_short_name"]
+        if shape:
+            with profiler.phase ("Read shape"):
+                trip ["__shape__"] = store.shape (trip ["shape_id"])
 
-    if shape:
-        shape = []
-        with open ("shapes.txt", encoding = "utf-8-sig") as f:
-            for i in stripped_DictReader (f):
-                if i ["shape_id"] == trip ["shape_id"]:
-                    shape.append (([float (i ["shape_pt_lon"]), float (i ["shape_pt_lat"])], int (i ["shape_pt_sequence"])))
-        trip ["__shape__"] = [i [0] for i in sorted (shape, key = lambda x: x [1])] # Sort by sequence
-
-    os.chdir (orig) # Restore original working directory
+        if transfer: # Routes serving the stops of the trip, read before the store is closed
+            with profiler.phase ("Read transfers"):
+                transfers = {i ["stop_id"]: store.transfers (i ["stop_id"], previous if id (trip) in late_ids else services) for i in trip ["__stops__"]}
 
     def get_transfer (_trip):
         for i in _trip ["__stops__"]:
-            transfer = transfers [i ["stop_id"]]
+            transfer = set (transfers [i ["stop_id"]])
             transfer.discard (_trip ["route_short_name"]) # Exclude the current route
             transfer.discard (_trip ["route_long_name"])
             i ["__transfer__"] = sorted (transfer)
@@ -935,7 +880,7 @@ parser = argparse.ArgumentParser (
     epilog = """\
 Currently supported data sources and required parameters:
 Source      Parameter         Example
-GTFS        GTFS directory    /path/to/gtfs (unzipped)
+GTFS        GTFS feed         /path/to/gtfs or /path/to/gtfs.zip
 OSM         Relation ID       1234567
 BAIDU       Seckey            a1b2c3... ('none' to exclude)
 12306       None              N/A
@@ -968,6 +913,7 @@ parser.add_argument ("output", help = "Output filepath to write extracted data t
 parser.add_argument ("-c", "--core-only", action = "store_true", help = "Only save core tags (see below for details)")
 parser.add_argument ("-t", "--no-transfer", action = "store_false", help = "Exclude the __transfer__ tag")
 parser.add_argument ("-s", "--no-shape", action = "store_false", help = "Exclude the __shape__ tag")
+parser.add_argument ("-d", "--date", type = date.fromisoformat, help = "GTFS only: only include trips running on this date (YYYY-MM-DD), defaults to the date of the video if a video is given as the start time")
 
 def main (args):
     try:
@@ -976,7 +922,12 @@ def main (args):
         print (f"Data source '{args.source}' not supported. Run with -h for help.")
         raise SystemExit
 
-    trip, get_transfer = source (args.parameter, transfer = args.no_transfer, shape = args.no_shape)
+    if source is from_gtfs:
+        trip, get_transfer = source (args.parameter, transfer = args.no_transfer, shape = args.no_shape, date = args.date)
+    elif args.date:
+        raise SystemExit ("--date is only supported for GTFS.")
+    else:
+        trip, get_transfer = source (args.parameter, transfer = args.no_transfer, shape = args.no_shape)
     sel_stops (trip, open (args.output, "w"), args.core_only, get_transfer)
 
 def script (args):
@@ -1,13 +1,15 @@
 # This file contains functions used by other programs. It should not be run directly.
 
 # Built-in modules
-import shutil, os, subprocess
+import shutil, os, subprocess, hashlib
 from datetime import datetime, timedelta
 
 # Third-party modules
 from texttable import Texttable
 import dateutil.parser
 
+from tpov_profile import profiler
+
 def renamedict (d, assignments: dict, default: str | None = None):
     if isinstance (default, str):
         for k in assignments.keys ():
@@ -88,11 +90,23 @@ def choicetable (header, data):
 def proj_path (file): # Return the path of the file in the project directory
     return os.path.join (os.path.dirname (os.path.abspath (__file__)), file)
 
+def file_hash (path, chunk_size = 1 << 20): # Return the SHA-256 hex digest of a file, read in chunks to limit memory use
+    h = hashlib.sha256 ()
+    with open (path, "rb") as f:
+        for chunk in iter (lambda: f.read (chunk_size), b""):
+            h.update (chunk)
+    return h.hexdigest ()
+
+def file_stat (path): # Return the size and modification time (ns) of a file, a cheap check of whether it changed
+    stat = os.stat (path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
 def iso_time (time): # Convert a datetime object to an ISO 8601 string
     return time.isoformat ().replace ("+00:00", "Z")
 
 def video_time (file, return_object = False): # Use exiftool to get the start and end timestamps of a video
-    exif = subprocess.run (["exiftool", "-api", "largefilesupport=1", "-DateTimeOriginal", "-ModifyDate", "-Duration#", "-d", "%Y-%m-%dT%H:%M:%SZ", file], capture_output = True)
+    with profiler.phase ("exiftool", "subprocess", file = file):
+        exif = subprocess.run (["exiftool", "-api", "largefilesupport=1", "-DateTimeOriginal", "-ModifyDate", "-Duration#", "-d", "%Y-%m-%dT%H:%M:%SZ", file], capture_output = True)
     exif.check_returncode ()
     exif = {i.split (":", 1) [0].strip (): i.split (":", 1) [1].strip () for i in exif.stdout.decode ().split ("\n") if i}
 
@@ -113,7 +127,8 @@ def video_time (file, return_object = False): # Use exiftool to get the start an
     return start, end
 
 def set_video_time (file, start, end): # Use exiftool to set the start and end timestamps of a video
-    exif = subprocess.run (["exiftool", "-api", "largefilesupport=1", "-overwrite_original", "-DateTimeOriginal=" + start, "-FileModifyDate=" + start, "-ModifyDate=" + end, file])
+    with profiler.phase ("exiftool", "subprocess", file = file):
+        exif = subprocess.run (["exiftool", "-api", "largefilesupport=1", "-overwrite_original", "-DateTimeOriginal=" + start, "-FileModifyDate=" + start, "-ModifyDate=" + end, file])
     exif.check_returncode ()
 
 if __name__ == "__main__":
@@ -0,0 +1,284 @@
+# This file contains functions used by other programs. It should not be run directly.
+
+# Built-in modules
+import os, uuid
+from datetime import timezone
+
+# Third-party modules
+import gpxpy, gpxpy.geo, gpxpy.gpxfield
+import numpy as np
+import lxml.etree
+
+chunk_size = 1 << 16 # Points buffered as Python objects before being converted into arrays
+
+def utc_time (time): # Timezone aware or naive (assumed UTC) datetime to datetime64, None to NaT
+    if time is None:
+        return np.datetime64 ("NaT")
+    return np.datetime64 ((time.astimezone (timezone.utc) if time.tzinfo else time).replace (tzinfo = None), "us")
+
+def parse_times (strings): # GPX time strings to UTC datetime64, as parsed by gpxpy
+    stripped = [s.strip ().removesuffix ("Z") if s else "NaT" for s in strings]
+    if not any ("+" in s or "-" in s [10 : ] for s in stripped): # No UTC offsets, let NumPy parse them
+        try:
+            return np.array (stripped, dtype = "datetime64[us]")
+        except ValueError:
+            pass
+    return np.array ([utc_time (gpxpy.gpxfield.parse_time (s.strip ()) if s else None) for s in strings], dtype = "datetime64[us]")
+
+def xml_float (value): # Format a float like gpxpy
+    result = str (value)
+    if "e" in result: # Scientific notation is not allowed in GPX
+        return format (value, ".10f").rstrip ("0").rstrip (".")
+    return result
+
+def distance_2d (lat1, lon1, lat2, lon2): # Distance in metres like gpxpy.geo.distance without elevation, on NumPy arrays
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays (*(np.asarray (i, dtype = float) for i in (lat1, lon1, lat2, lon2)))
+    result = np.hypot (lat1 - lat2, (lon1 - lon2) * np.cos (np.radians (lat1))) * gpxpy.geo.ONE_DEGREE
+    far = (np.abs (lat1 - lat2) > .2) | (np.abs (lon1 - lon2) > .2) # gpxpy uses the haversine formula for distant points
+    if far.any ():
+        lat1, lon1, lat2, lon2 = (np.radians (i [far]) for i in (lat1, lon1, lat2, lon2))
+        a = np.sin ((lat1 - lat2) / 2) ** 2 + np.sin ((lon1 - lon2) / 2) ** 2 * np.cos (lat1) * np.cos (lat2)
+        result [far] = 2 * np.arcsin (np.sqrt (a)) * gpxpy.geo.EARTH_RADIUS
+    return result
+
+# Douglas-Peucker simplification of a line, returns the indices of the points to keep
+# No removed point is further than tolerance metres from the simplified line, each step measures all points of a part at once
+def simplify_line (lat, lon, tolerance):
+    if len (lat) < 3 or tolerance <= 0:
+        return np.arange (len (lat))
+    y = np.asarray (lat) * gpxpy.geo.ONE_DEGREE # Metres on a local equirectangular projection
+    x = np.asarray (lon) * gpxpy.geo.ONE_DEGREE * np.cos (np.radians (np.mean (lat)))
+    keep = np.zeros (len (lat), dtype = bool)
+    keep [0] = keep [-1] = True
+    parts = [(0, len (lat) - 1)]
+    while parts:
+        start, end = parts.pop ()
+        if end - start < 2:
+            continue
+        # Distance of the points between start and end from the segment between them
+        c, d = x [end] - x [start], y [end] - y [start]
+        a, b = x [start + 1 : end] - x [start], y [start + 1 : end] - y [start]
+        len_sq = c * c + d * d
+        param = np.clip ((a * c + b * d) / len_sq, 0, 1) if len_sq else 0
+        dist = np.hypot (a - param * c, b - param * d)
+        index = int (dist.argmax ())
+        if dist [index] > tolerance:
+            index += start + 1
+            keep [index] = True
+            parts.extend (((start, index), (index, end)))
+    return np.flatnonzero (keep)
+
+# Stream the track points of a GPX file into arrays with lxml, without building the whole document
+# Returns lat, lon, ele, time columns, the index of the first point of each track segment,
+# the document without its track points if every point only has lat, lon, ele, a UTC time and text extensions (None otherwise),
+# and the extensions as {point index: [(tag, text), ...]}
+def read_gpx (path):
+    size = max (chunk_size, os.path.getsize (path) // 100) # Rough guess of the number of points, grown if needed
+    columns = {"lat": np.empty (size), "lon": np.empty (size), "ele": np.empty (size), "time": np.empty (size, dtype = "datetime64[us]")}
+    buffer = {k: [] for k in columns}
+    count, seg_start, simple, extensions = 0, [], True, {}
+
+    def flush ():
+        nonlocal count
+        new = len (buffer ["lat"])
+        if count + new > len (columns ["lat"]):
+            for k, v in columns.items ():
+                columns [k] = np.resize (v, max (2 * len (v), count + new))
+        columns ["lat"] [count : count + new] = buffer ["lat"]
+        columns ["lon"] [count : count + new] = buffer ["lon"]
+        columns ["ele"] [count : count + new] = buffer ["ele"]
+        columns ["time"] [count : count + new] = parse_times (buffer ["time"])
+        count += new
+        for v in buffer.values ():
+            v.clear ()
+
+    context = lxml.etree.iterparse (path, events = ("start", "end"), tag = ("{*}trkseg", "{*}trkpt"))
+    for event, element in context:
+        if element.tag.endswith ("trkseg"):
+            if event == "start":
+                seg_start.append (count + len (buffer ["lat"]))
+            else: # Remove the last point, the others are removed below
+                for i in element.findall ("{*}trkpt"):
+                    element.remove (i)
+            continue
+        if event == "start":
+            continue
+        buffer ["lat"].append (float (element.get ("lat")))
+        buffer ["lon"].append (float (element.get ("lon")))
+        ele = element.findtext ("{*}ele")
+        buffer ["ele"].append (float (ele) if ele and ele.strip () else np.nan)
+        buffer ["time"].append (element.findtext ("{*}time"))
+        if simple and (len (element.attrib) != 2 or (buffer ["time"] [-1] and not buffer ["time"] [-1].strip ().endswith ("Z"))):
+            simple = False
+        for i in element if simple else ():
+            if not isinstance (i.tag, str) or i.tag.rpartition ("}") [2] not in ("ele", "time", "extensions"):
+                simple = False # Other fields are only kept by gpxpy
+            elif i.tag.endswith ("extensions"):
+                # Only plain text extensions like the tpov.* fields are kept, gpxpy drops the default namespace from their tags
+                tags = [j.tag.removeprefix (f"{{{element.nsmap [None]}}}" if None in element.nsmap else "") if isinstance (j.tag, str) else "}" for j in i]
+                if any ("}" in j or len (k) or k.attrib for j, k in zip (tags, i)):
+                    simple = False
+                else:
+                    extensions [count + len (buffer ["lat"]) - 1] = [(j, k.text or "") for j, k in zip (tags, i)]
+        # Free parsed points to keep memory bounded
+        element.clear (keep_tail = True)
+        while (previous := element.getprevious ()) is not None and previous.tag == element.tag:
+            element.getparent ().remove (previous)
+        if len (buffer ["lat"]) >= chunk_size:
+            flush ()
+    flush ()
+    skeleton = lxml.etree.tostring (context.root).decode () if simple else None
+    return (columns ["lat"] [ : count], columns ["lon"] [ : count], columns ["ele"] [ : count], columns ["time"] [ : count],
+            np.array (seg_start, dtype = np.int64), skeleton, extensions if simple else {})
+
+# Only keep the fields of each point whose value differs from the previous point
+def delta_fields (fields):
+    previous = {}
+    for i in fields:
+        yield {k: v for k, v in i.items () if previous.get (k) != v}
+        previous = i
+
+# Undo delta_fields, the fields of each point are {tag: text, ...}
+def expand_fields (fields):
+    current = {}
+    for i in fields:
+        current.update (i)
+        yield current.copy ()
+
+# Track points of a GPX file as NumPy columns, read once and shared by all processing steps
+# Times are stored in UTC (NaT if missing), elevations are NaN if missing
+# The gpxpy document (gpx) and its track points (points) are only parsed when needed
+# The columns are authoritative, points moved with set_point before the document is parsed are moved in it too
+# If skeleton (the document without track points) is available, the track is written from the columns
+# and the existing point extensions in extensions ({point index: [(tag, text), ...]})
+class Track:
+    def __init__ (self, lat, lon, ele, time, seg_start = None, skeleton = None, extensions = None, path = None, gpx = None):
+        self.lat, self.lon, self.ele, self.time = lat, lon, ele, time
+        self.seg_start = np.zeros (1, dtype = np.int64) if seg_start is None else seg_start
+        self.skeleton, self.extensions = skeleton, {} if extensions is None else extensions
+        self.path, self._gpx, self._points = path, gpx, None
+        self.moved = set () # Points moved with set_point
+
+    @classmethod
+    def from_gpx (cls, gpx, path = None): # Track of a parsed gpxpy document
+        points = tuple (gpx.walk (True))
+        count = len (points)
+        seg_start = np.cumsum ([0] + [len (j.points) for i in gpx.tracks for j in i.segments]) [ : -1]
+        return cls (np.fromiter ((i.latitude for i in points), dtype = float, count = count),
+                    np.fromiter ((i.longitude for i in points), dtype = float, count = count),
+                    np.fromiter ((np.nan if i.elevation is None else i.elevation for i in points), dtype = float, count = count),
+                    np.array ([utc_time (i.time) for i in points], dtype = "datetime64[us]"),
+                    seg_start.astype (np.int64), None, None, path, gpx)
+
+    @classmethod
+    def load (cls, path):
+        return cls (*read_gpx (path), path = path)
+
+    @property
+    def gpx (self): # gpxpy document, parsed on first use
+        if self._gpx is None:
+            with open (self.path, "r") as f:
+                self._gpx = gpxpy.parse (f)
+        return self._gpx
+
+    @property
+    def points (self): # Track points of the gpxpy document in order
+        if self._points is None:
+            self._points = tuple (self.gpx.walk (True))
+            if len (self._points) != len (self):
+                raise ValueError (f"gpxpy read {len (self._points)} track points from {self.path}, expected {len (self)}")
+            for i in self.moved:
+                self._points [i].latitude, self._points [i].longitude = float (self.lat [i]), float (self.lon [i])
+        return self._points
+
+    def __len__ (self):
+        return len (self.lat)
+
+    def time_at (self, index): # Timezone aware datetime of a point
+        return self.time [index].item ().replace (tzinfo = timezone.utc)
+
+    def search_times (self): # Times in microseconds made non-decreasing for binary searches, missing times count as the previous time
+        return np.maximum.accumulate (np.where (np.isnat (self.time), np.iinfo (np.int64).min // 2, self.time.astype (np.int64)))
+
+    def coords (self, start = 0): # [(lat, lon, time), ...] from point `start`, as passed to the map matchers
+        return list (zip (self.lat [start : ].tolist (), self.lon [start : ].tolist (), self.time [start : ].tolist ()))
+
+    def bounds (self): # (min_lat, max_lat, min_lon, max_lon)
+        return self.lat.min (), self.lat.max (), self.lon.min (), self.lon.max ()
+
+    def set_point (self, index, lat, lon): # Move a point in both the columns and the document
+        self.lat [index], self.lon [index] = lat, lon
+        self.moved.add (index)
+        if self._points is not None:
+            self._points [index].latitude, self._points [index].longitude = lat, lon
+
+    def set_points (self, indices, lat, lon): # Move several points (arrays) in both the columns and the document
+        self.lat [indices], self.lon [indices] = lat, lon
+        self.moved.update (indices.tolist ())
+        if self._points is not None:
+            for i, j, k in zip (indices.tolist (), np.asarray (lat).tolist (), np.asarray (lon).tolist ()):
+                self._points [i].latitude, self._points [i].longitude = j, k
+
+    def document (self): # gpxpy document to add metadata and waypoints to before calling write
+        if self.skeleton is None:
+            return self.gpx
+        return gpxpy.parse (self.skeleton)
+
+    # Write the track with the tpov extensions in fields (a dict for each point) to path
+    # Without a skeleton the whole document is built by gpxpy, otherwise points are written one by one in the same format
+    # With delta, fields are only written at points where their value changes
+    def write (self, path, gpx, fields, delta = False):
+        if delta:
+            fields = delta_fields (fields)
+        if self.skeleton is None:
+            for i, j in zip (self.points, fields):
+                for k, v in j.items ():
+                    ext = lxml.etree.Element (k)
+                    ext.text = v
+                    i.extensions.append (ext)
+            with open (path, "w") as f:
+                f.write (gpx.to_xml (version = "1.1"))
+            return
+
+        # Each segment gets a placeholder point which is replaced with its points
+        marker = uuid.uuid4 ().hex
+        segments = [j for i in gpx.tracks for j in i.segments]
+        if len (segments) != len (self.seg_start):
+            raise ValueError (f"Document has {len (segments)} track segments, expected {len (self.seg_start)}")
+        for j, i in enumerate (segments):
+            i.points = [gpxpy.gpx.GPXTrackPoint (0, 0, name = f"{marker}.{j}")]
+        xml = gpx.to_xml (version = "1.1")
+
+        fields = iter (fields)
+        seg_end = list (self.seg_start [1 : ]) + [len (self)]
+        with open (path, "w") as f:
+            written = 0
+            for j, (start, stop) in enumerate (zip (self.seg_start.tolist (), seg_end)):
+                name = xml.index (f"<name>{marker}.{j}</name>", written)
+                point = xml.rindex ("\n", 0, xml.rindex ("<trkpt", 0, name))
+                indent = xml [point + 1 : xml.index ("<trkpt", point)]
+                f.write (xml [written : point])
+                self.write_points (f, start, stop, fields, indent)
+                written = xml.index ("</trkpt>", name) + len ("</trkpt>")
+            f.write (xml [written : ])
+
+    def write_points (self, f, start, stop, fields, indent):
+        for chunk in range (start, stop, chunk_size):
+            end = min (chunk + chunk_size, stop)
+            times = np.datetime_as_string (self.time [chunk : end], unit = "us").tolist ()
+            for index, lat, lon, ele, time in zip (range (chunk, end), self.lat [chunk : end].tolist (), self.lon [chunk : end].tolist (), self.ele [chunk : end].tolist (), times):
+                point = [f'\n{indent}<trkpt lat="{xml_float (lat)}" lon="{xml_float (lon)}">']
+                if ele == ele: # Not NaN
+                    point.append (f"\n{indent}  <ele>{xml_float (ele)}</ele>")
+                if time != "NaT":
+                    point.append (f"\n{indent}  <time>{time.removesuffix ('.000000')}Z</time>")
+                extensions = self.extensions.get (index, []) + list (next (fields).items ())
+                if extensions:
+                    point.append (f"\n{indent}  <extensions>")
+                    point.extend (f"\n{indent}    <{k}>{v.strip ()}</{k}>" for k, v in extensions)
+                    point.append (f"\n{indent}  </extensions>")
+                point.append (f"\n{indent}</trkpt>")
+                f.write ("".join (point))
+
+if __name__ == "__main__":
+    raise SystemExit ("This file contains functions used by other programs. It should not be run directly.")
@@ -0,0 +1,420 @@
+# This file contains functions used by other programs. It should not be run directly.
+
+# Built-in modules
+import os, io, csv, json, sqlite3, hashlib, contextlib, itertools, multiprocessing, collections, zipfile, shutil
+
+# Third-party modules
+from tqdm import tqdm
+
+from tpov_functions import *
+
+def stripped_DictReader (f, fieldnames = None):
+    for i in csv.DictReader (f, fieldnames = fieldnames):
+        yield {k.strip (): v.strip () for k, v in i.items ()}
+
+feed_files = ("agency.txt", "routes.txt", "trips.txt", "stops.txt", "stop_times.txt", "shapes.txt", "calendar.txt", "calendar_dates.txt") # Files imported from a feed
+optional_files = ("shapes.txt", "calendar.txt", "calendar_dates.txt")
+transfer_files = ("routes.txt", "trips.txt", "stop_times.txt") # Files the routes serving each stop are found from
+index_chunk_size = 1 << 22 # Bytes of stop_times.txt parsed by each indexing task
+cache_dir = os.path.join (os.environ.get ("XDG_CACHE_HOME") or os.path.join (os.path.expanduser ("~"), ".cache"), "tpov", "gtfs") # Databases of zipped feeds
+
+# Rows of a CSV file in the byte ranges [[start, end], ...] of f (opened in binary mode) as dicts with the keys of header
+def read_rows (f, header, ranges):
+    for start, end in ranges:
+        f.seek (start)
+        for i in csv.reader (io.StringIO (f.read (end - start).decode (), newline = "")):
+            if i:
+                yield {k: v.strip () for k, v in zip (header, i)}
+
+# Rows of several trips {trip_id: [[start, end], ...]} as {trip_id: [row, ...]}, the ranges are read in file order
+# so that members of a zip file, which can only be read forward without decompressing them again from the start, are read once
+def read_trips (f, header, trip_ranges):
+    rows = {k: [] for k in trip_ranges}
+    for start, end, trip in sorted ((*j, k) for k, v in trip_ranges.items () for j in v):
+        rows [trip] += read_rows (f, header, [[start, end]])
+    return rows
+
+# MD5 of the fields of the rows of a trip in stop_sequence order, except trip_id and stop_sequence, to find duplicate trips
+def trip_hash (rows): # [(stop_sequence, fields), ...]
+    h = hashlib.md5 ()
+    for _, i in sorted (rows):
+        h.update (i.encode () + b"\n")
+    return h.hexdigest ()
+
+# departure_time in HH:MM:SS format, so that times can be compared as strings (GTFS allows H:MM:SS before 10:00:00)
+def pad_time (time):
+    return ("0" + time.strip ()) [-8 : ]
+
+# Index the lines of stop_times.txt in data, which starts at offset start of the file and ends at the end of a line
+# Returns the byte ranges {trip_id: [[start, end], ...]}, the hashes {trip_id: trip_hash}, the stops of each trip {trip_id: [stop_id, ...]}
+# and the departure_time of the first stop of each trip {trip_id: departure_time}
+def _index_range (header, start, data):
+    ti, ss, si, di = (header.index (i) for i in ("trip_id", "stop_sequence", "stop_id", "departure_time"))
+    end, lines = start + len (data), data.split (b"\n")
+    offsets = list (itertools.accumulate ((len (i) + 1 for i in lines), initial = start)) # Offset of the beginning of each line
+    reader = csv.reader (i.decode () for i in lines) # Quoted fields may contain commas or span several lines
+    ranges, rows, line = {}, {}, 0
+    for i in reader:
+        row_start, line = offsets [line], reader.line_num
+        if not i: # Empty line
+            continue
+        row_end, trip = min (offsets [line], end), i [ti].strip ()
+        if trip not in ranges:
+            ranges [trip], rows [trip] = [[row_start, row_end]], []
+        elif ranges [trip] [-1] [1] == row_start: # Extend the range if the trip continues
+            ranges [trip] [-1] [1] = row_end
+        else:
+            ranges [trip].append ([row_start, row_end])
+        rows [trip].append ((int (i [ss]), ",".join (j.strip () for k, j in enumerate (i) if k != ti and k != ss), i [si].strip (), i [di]))
+    for i in rows.values ():
+        i.sort ()
+    return (ranges, {k: trip_hash ([i [ : 2] for i in v]) for k, v in rows.items ()}, {k: [i [2] for i in v] for k, v in rows.items ()},
+            {k: pad_time (v [0] [3]) for k, v in rows.items ()})
+
+# Tables of a GTFS feed in an indexed SQLite database, imported once and updated when files of the feed change
+# The database of a feed directory is tpov_gtfs.sqlite in it, the database of a zipped feed is in cache_dir named after the path and the CRCs of its files
+# Rows are stored as JSON with the columns needed for lookups, so that all fields of the feed are kept
+# stop_times.txt is too large to copy, the database holds the byte ranges of the rows of each trip in it (in the uncompressed member of a zip file)
+class GTFSStore:
+    version = 5 # Increase when the schema or the import changes to import feeds again
+
+    # Tables imported from each file of the feed, only the tables of the files which changed are imported again
+    tables = {
+        "agency.txt": ("agency",),
+        "routes.txt": ("routes",),
+        "trips.txt": ("trips",),
+        "stops.txt": ("stops",),
+        "shapes.txt": ("shapes",),
+        "calendar.txt": ("calendar",),
+        "calendar_dates.txt": ("calendar_dates",),
+        "stop_times.txt": ("stop_times", "patterns")
+    }
+    schema = {
+        "agency": "CREATE TABLE agency (agency_id TEXT, data TEXT)",
+        "routes": "CREATE TABLE routes (route_id TEXT, agency_id TEXT, short_name TEXT, long_name TEXT, data TEXT)",
+        "trips": "CREATE TABLE trips (trip_id TEXT, route_id TEXT, service_id TEXT, data TEXT)",
+        "stops": "CREATE TABLE stops (stop_id TEXT PRIMARY KEY, data TEXT)",
+        "shapes": "CREATE TABLE shapes (shape_id TEXT, sequence INTEGER, lon REAL, lat REAL)",
+        "calendar": "CREATE TABLE calendar (service_id TEXT, days TEXT, start_date TEXT, end_date TEXT)",
+        "calendar_dates": "CREATE TABLE calendar_dates (service_id TEXT, date TEXT, exception_type INTEGER)",
+        "stop_times": "CREATE TABLE stop_times (trip_id TEXT PRIMARY KEY, ranges TEXT, hash TEXT, pattern INTEGER, departure TEXT) WITHOUT ROWID", # departure of the first stop
+        "patterns": "CREATE TABLE patterns (pattern INTEGER PRIMARY KEY, stop_ids TEXT)", # Stops of trips in stop_sequence order
+        "transfers": "CREATE TABLE transfers (stop_id TEXT, route_name TEXT, service_id TEXT, PRIMARY KEY (stop_id, route_name, service_id)) WITHOUT ROWID"
+    }
+
+    def __init__ (self, gtfs_path): # Feed directory or zip file
+        self.source = os.path.abspath (gtfs_path)
+        if os.path.isdir (self.source):
+            self.zip = None
+            self.path = os.path.join (self.source, "tpov_gtfs.sqlite")
+            # Files are only hashed again if their size or modification time changed since they were imported
+            imported = json.loads ((self.meta (self.path) or {}).get ("files", "{}")) if os.path.exists (self.path) else {}
+            with profiler.phase ("Hash feed"):
+                self.files = {}
+                for i in feed_files:
+                    if os.path.exists (os.path.join (self.source, i)):
+                        stat = file_stat (os.path.join (self.source, i))
+                        same = {k: v for k, v in imported.get (i, {}).items () if k != "hash"} == stat
+                        self.files [i] = {"hash": imported [i] ["hash"] if same else file_hash (os.path.join (self.source, i)), **stat}
+                        profiler.count ("Hashed feed files", not same)
+        elif zipfile.is_zipfile (self.source):
+            self.zip = zipfile.ZipFile (self.source)
+            # Files may be in a directory of the zip file, the one closest to the top is used
+            self.members = {}
+            for i in sorted (self.zip.infolist (), key = lambda x: -x.filename.count ("/")):
+                if not i.is_dir ():
+                    self.members [i.filename.rsplit ("/", 1) [-1]] = i
+            self.files = {i: {"hash": f"{self.members [i].CRC:08x}", "size": self.members [i].file_size} for i in feed_files if i in self.members} # Stored in the zip file
+            # Named after the path and the CRCs of the files instead of the hash of the zip file, which would be read completely on every extraction
+            os.makedirs (cache_dir, exist_ok = True)
+            self.path = os.path.join (cache_dir, hashlib.sha256 (json.dumps ([self.source, self.files], sort_keys = True).encode ()).hexdigest () + ".sqlite")
+        else:
+            raise ValueError (f"{gtfs_path} is not a GTFS directory or zip file.")
+        for i in feed_files:
+            if i not in self.files and i not in optional_files:
+                raise FileNotFoundError (f"{i} not found in {self.source}.")
+        # A zipped feed which was updated has a new database, the database of its previous version is updated instead of importing it again
+        base = self.path if os.path.exists (self.path) or self.zip is None else self.previous ()
+        changed = self.changed (base)
+        if changed is None:
+            print ("Importing GTFS feed (this may take a while)...")
+            with profiler.phase ("Import feed"):
+                self.build (None, feed_files)
+        elif changed or base != self.path:
+            print (f"Updating GTFS feed, changed files: {', '.join (changed) or 'none'}...")
+            with profiler.phase ("Update feed"):
+                self.build (base, changed)
+        elif self.zip is None and imported != self.files: # Files were touched without changing, save their times so that they are not hashed again
+            with contextlib.closing (sqlite3.connect (self.path)) as db:
+                db.execute ("UPDATE meta SET value = ? WHERE key = 'files'", (json.dumps (self.files),))
+                db.commit ()
+        profiler.set ("Changed feed files", len (feed_files) if changed is None else len (changed))
+        self.db = sqlite3.connect (self.path)
+        self.stop_times_file = self.open ("stop_times.txt", binary = True)
+        self.stop_times_header = tuple (i.strip () for i in next (csv.reader ([self.stop_times_file.readline ().decode ("utf-8-sig")])))
+
+    def open (self, name, binary = False): # File of the feed, members of a zip file are decompressed while reading
+        if self.zip is None:
+            return open (os.path.join (self.source, name), "rb") if binary else open (os.path.join (self.source, name), encoding = "utf-8-sig")
+        f = self.zip.open (self.members [name])
+        return f if binary else io.TextIOWrapper (f, encoding = "utf-8-sig")
+
+    def size (self, name): # Uncompressed size of a file of the feed
+        return os.path.getsize (os.path.join (self.source, name)) if self.zip is None else self.members [name].file_size
+
+    @staticmethod
+    def meta (path): # Metadata of a database, None if it is incomplete or not a database
+        with contextlib.closing (sqlite3.connect (path)) as db:
+            try:
+                return dict (db.execute ("SELECT key, value FROM meta"))
+            except sqlite3.DatabaseError:
+                return None
+
+    def previous (self): # Database of another version of a zipped feed at the same path in cache_dir, None if there is none
+        for i in os.listdir (cache_dir):
+            if i.endswith (".sqlite") and (self.meta (os.path.join (cache_dir, i)) or {}).get ("source") == self.source:
+                return os.path.join (cache_dir, i)
+        return None
+
+    # Files of the feed whose hash or size changed since the database at path was imported from it, None if it must be imported again
+    # The modification times of the files of a directory are ignored, files whose time changed were hashed again
+    def changed (self, path):
+        meta = self.meta (path) if path is not None and os.path.exists (path) else None
+        if meta is None or meta.get ("version") != str (self.version):
+            return None
+        files = json.loads (meta ["files"])
+        key = lambda x: x and (x ["hash"], x ["size"])
+        return [i for i in feed_files if key (files.get (i)) != key (self.files.get (i))]
+
+    # Import the changed files into a copy of the database at base (a new database if None), the database is replaced when the import is complete
+    def build (self, base, changed):
+        temp = self.path + ".tmp"
+        if os.path.exists (temp):
+            os.remove (temp)
+        if base is not None:
+            shutil.copyfile (base, temp)
+        with contextlib.closing (sqlite3.connect (temp)) as db:
+            db.executescript ("""
+                PRAGMA journal_mode = OFF;
+                PRAGMA synchronous = OFF;
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            """)
+            for name in changed:
+                for i in self.tables [name]:
+                    db.execute (f"DROP TABLE IF EXISTS {i}")
+                    db.execute (self.schema [i])
+                if name in self.files: # Optional files which were removed leave their tables empty
+                    with profiler.phase (f"Import {name}"):
+                        getattr (self, "import_" + name.removesuffix (".txt")) (db)
+            if set (changed) & set (transfer_files):
+                with profiler.phase ("Find transfers"):
+                    self.import_transfers (db)
+            db.executemany ("INSERT OR REPLACE INTO meta VALUES (?, ?)", (("version", str (self.version)), ("files", json.dumps (self.files)), ("source", self.source)))
+            db.commit ()
+            if base is not None: # Free the pages of the tables which were replaced
+                db.execute ("VACUUM")
+        os.replace (temp, self.path)
+        if base is not None and base != self.path: # Previous version of a zipped feed
+            os.remove (base)
+
+    def import_agency (self, db):
+        with self.open ("agency.txt") as f:
+            db.executemany ("INSERT INTO agency VALUES (?, ?)", ((i.get ("agency_id"), json.dumps (i)) for i in stripped_DictReader (f)))
+
+    def import_routes (self, db):
+        with self.open ("routes.txt") as f:
+            db.executemany ("INSERT INTO routes VALUES (?, ?, ?, ?, ?)", (
+                (i ["route_id"], i.get ("agency_id"), i ["route_short_name"].lower (), i ["route_long_name"].lower (), json.dumps (i))
+                for i in stripped_DictReader (f)))
+        db.executescript ("""
+            CREATE INDEX routes_route_id ON routes (route_id);
+            CREATE INDEX routes_short_name ON routes (short_name);
+            CREATE INDEX routes_long_name ON routes (long_name);
+        """)
+
+    def import_trips (self, db):
+        with self.open ("trips.txt") as f:
+            db.executemany ("INSERT INTO trips VALUES (?, ?, ?, ?)", ((i ["trip_id"], i ["route_id"], i ["service_id"], json.dumps (i)) for i in stripped_DictReader (f)))
+        db.executescript ("""
+            CREATE INDEX trips_trip_id ON trips (trip_id);
+            CREATE INDEX trips_route_id ON trips (route_id);
+        """)
+
+    def import_stops (self, db):
+        with self.open ("stops.txt") as f:
+            db.executemany ("INSERT OR REPLACE INTO stops VALUES (?, ?)", ((i ["stop_id"], json.dumps (i)) for i in stripped_DictReader (f)))
+
+    def import_shapes (self, db):
+        with self.open ("shapes.txt") as f:
+            db.executemany ("INSERT INTO shapes VALUES (?, ?, ?, ?)", (
+                (i ["shape_id"], int (i ["shape_pt_sequence"]), float (i ["shape_pt_lon"]), float (i ["shape_pt_lat"]))
+                for i in stripped_DictReader (f)))
+        db.execute ("CREATE INDEX shapes_shape_id ON shapes (shape_id, sequence)")
+
+    def import_calendar (self, db):
+        with self.open ("calendar.txt") as f:
+            db.executemany ("INSERT INTO calendar VALUES (?, ?, ?, ?)", (
+                (i ["service_id"], "".join (i [j] for j in ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")), i ["start_date"], i ["end_date"])
+                for i in stripped_DictReader (f)))
+
+    def import_calendar_dates (self, db):
+        with self.open ("calendar_dates.txt") as f:
+            db.executemany ("INSERT INTO calendar_dates VALUES (?, ?, ?)", ((i ["service_id"], i ["date"], int (i ["exception_type"])) for i in stripped_DictReader (f)))
+        db.execute ("CREATE INDEX calendar_dates_date ON calendar_dates (date)")
+
+    # Routes serving each stop on each service, from the stops of the trips of each route
+    # Trips with the same stops share a pattern, so that transfers can be found again without reading stop_times.txt when only routes or trips change
+    def import_transfers (self, db):
+        db.execute ("DROP TABLE IF EXISTS transfers")
+        db.execute (self.schema ["transfers"])
+        route_names = {k: i ["route_short_name"] if i ["route_short_name"] else i ["route_long_name"]
+                       for k, i in ((k, json.loads (v)) for k, v in db.execute ("SELECT route_id, data FROM routes ORDER BY rowid"))}
+        served = {(pattern, route_names [route], service) for pattern, route, service in db.execute (
+            "SELECT stop_times.pattern, trips.route_id, trips.service_id FROM stop_times JOIN trips ON stop_times.trip_id = trips.trip_id")}
+        patterns = {k: json.loads (v) for k, v in db.execute ("SELECT pattern, stop_ids FROM patterns")}
+        db.executemany ("INSERT OR IGNORE INTO transfers VALUES (?, ?, ?)", ((stop, name, service) for pattern, name, service in served for stop in patterns [pattern]))
+
+    # Save the byte ranges, the hash of the rows and the stop pattern of each trip in stop_times.txt
+    # The file is split into chunks which are parsed in parallel
+    def import_stop_times (self, db):
+        for i in ("stop_times_sorted.txt", "stop_times_sorted.txt.pkl"): # Index of earlier versions
+            if self.zip is None and os.path.exists (os.path.join (self.source, i)):
+                os.remove (os.path.join (self.source, i))
+
+        # Chunks are read in this process, so that a member of a zip file is decompressed once, and parsed in parallel
+        def chunks ():
+            with self.open ("stop_times.txt", binary = True) as f:
+                line = f.readline ()
+                yield [i.strip () for i in next (csv.reader ([line.decode ("utf-8-sig")]))]
+                start = len (line)
+                while data := f.read (index_chunk_size) + f.readline (): # Chunks end at the end of a line
+                    yield start, data
+                    start += len (data)
+
+        with profiler.phase ("Index stop_times"):
+            tasks = chunks ()
+            header, size = next (tasks), self.size ("stop_times.txt")
+            processes = max (1, min (len (os.sched_getaffinity (0)) if hasattr (os, "sched_getaffinity") else os.cpu_count (), size // index_chunk_size))
+            profiler.set ("Indexing processes", processes)
+            progress = tqdm (total = size, desc = "Indexing stop_times", unit = "B", unit_scale = True, mininterval = 0.5)
+            ranges, hashes, trip_patterns, patterns, departures, split = {}, {}, {}, {}, {}, set ()
+            with contextlib.ExitStack () as stack:
+                if processes > 1:
+                    pool = stack.enter_context (multiprocessing.Pool (processes))
+                    def results (): # Limit the chunks in memory, Pool.imap would read all of them ahead
+                        pending = collections.deque ()
+                        for start, data in tasks:
+                            pending.append ((len (data), pool.apply_async (_index_range, (header, start, data))))
+                            if len (pending) >= processes * 2:
+                                length, result = pending.popleft ()
+                                yield length, result.get ()
+                        for length, result in pending:
+                            yield length, result.get ()
+                else: # No need to copy data to another process
+                    results = lambda: ((len (data), _index_range (header, start, data)) for start, data in tasks)
+                for length, (chunk_ranges, chunk_hashes, chunk_stops, chunk_departures) in results ():
+                    for k, v in chunk_ranges.items ():
+                        if k in ranges: # Trip continues from an earlier chunk
+                            split.add (k)
+                            if ranges [k] [-1] [1] == v [0] [0]:
+                                ranges [k] [-1] [1] = v.pop (0) [1]
+                            ranges [k] += v
+                        else:
+                            ranges [k] = v
+                    hashes.update (chunk_hashes)
+                    departures.update (chunk_departures)
+                    for k, v in chunk_stops.items ():
+                        trip_patterns [k] = patterns.setdefault (tuple (v), len (patterns))
+                    progress.update (length)
+            progress.close ()
+            with self.open ("stop_times.txt", binary = True) as f: # Hash trips in several chunks again with all their rows
+                for k, v in read_trips (f, header, {i: ranges [i] for i in split}).items ():
+                    v.sort (key = lambda x: int (x ["stop_sequence"]))
+                    hashes [k] = trip_hash ([(int (i ["stop_sequence"]), ",".join (j for n, j in i.items () if n not in ("trip_id", "stop_sequence"))) for i in v])
+                    trip_patterns [k] = patterns.setdefault (tuple (i ["stop_id"] for i in v), len (patterns))
+                    departures [k] = pad_time (v [0] ["departure_time"])
+
+        with profiler.phase ("Find duplicate trips"): # Duplicates are removed when querying trips, as they may run on different services
+            dups = len (hashes) - len (set (hashes.values ()))
+        with profiler.phase ("Save stop_times index"):
+            db.executemany ("INSERT INTO stop_times VALUES (?, ?, ?, ?, ?)", ((k, json.dumps (v), hashes [k], trip_patterns [k], departures [k]) for k, v in ranges.items ()))
+            used = set (trip_patterns.values ()) # Patterns of the parts of split trips are not used
+            db.executemany ("INSERT INTO patterns VALUES (?, ?)", ((v, json.dumps (k)) for k, v in patterns.items () if v in used))
+        print (f"Indexed {len (ranges)} trips, {len (ranges) - dups} unique, {dups} duplicates, {len (used)} stop patterns.")
+        profiler.set ("Trips indexed", len (ranges))
+        profiler.set ("Duplicate trips", dups)
+
+    def agencies (self):
+        return [json.loads (i) for i, in self.db.execute ("SELECT data FROM agency ORDER BY rowid")]
+
+    # Routes with route_short_name or route_long_name equal to name (lower case), of the agency if the routes have an agency_id
+    def find_routes (self, name, agency_id = None):
+        return [json.loads (i) for i, in self.db.execute (
+            "SELECT data FROM routes WHERE (short_name = ?1 OR long_name = ?1) AND (agency_id IS NULL OR agency_id = ?2) ORDER BY rowid", (name, agency_id))]
+
+    # service_id of the services running on a date (datetime.date), None if the feed has no calendar
+    def services (self, date):
+        if not self.db.execute ("SELECT 1 FROM calendar UNION ALL SELECT 1 FROM calendar_dates LIMIT 1").fetchone ():
+            return None
+        day = date.strftime ("%Y%m%d")
+        services = {i for i, in self.db.execute (
+            "SELECT service_id FROM calendar WHERE start_date <= ?1 AND end_date >= ?1 AND substr (days, ?2, 1) = '1'", (day, date.weekday () + 1))}
+        for service, exception in self.db.execute ("SELECT service_id, exception_type FROM calendar_dates WHERE date = ?", (day,)):
+            if exception == 1: # Added for the date
+                services.add (service)
+            else: # Removed for the date
+                services.discard (service)
+        return services
+
+    # Trips of the routes in the order of trips.txt, only running on services and leaving the first stop at or after after (HH:MM:SS) if given,
+    # and the number of trips left out. Trips without stop_times and duplicates of another returned trip with an earlier trip_id are left out
+    def trips (self, route_ids, services = None, after = None):
+        route_ids = list (route_ids)
+        trips = [i [ : 3] for i in self.db.execute (
+            "SELECT trips.trip_id, trips.data, stop_times.hash, trips.service_id FROM trips LEFT JOIN stop_times ON trips.trip_id = stop_times.trip_id "
+            f"WHERE trips.route_id IN ({','.join ('?' * len (route_ids))}){' AND stop_times.departure >= ?' if after else ''} ORDER BY trips.rowid",
+            route_ids + ([after] if after else [])) if services is None or i [3] in services]
+        first = {}
+        for trip, _, h in trips:
+            if h is not None and (h not in first or trip < first [h]):
+                first [h] = trip
+        keep = set (first.values ())
+        return [json.loads (i [1]) for i in trips if i [0] in keep], len (trips) - len (keep)
+
+    def stop_times (self, trip_ids): # {trip_id: rows of stop_times.txt of the trip in stop_sequence order}
+        trip_ids, ranges = list (trip_ids), {}
+        for i in range (0, len (trip_ids), 500): # Limit the number of query parameters
+            chunk = trip_ids [i : i + 500]
+            ranges.update ((k, json.loads (v)) for k, v in self.db.execute (f"SELECT trip_id, ranges FROM stop_times WHERE trip_id IN ({','.join ('?' * len (chunk))})", chunk))
+        rows = read_trips (self.stop_times_file, self.stop_times_header, ranges)
+        return {i: sorted (rows.get (i, []), key = lambda x: int (x ["stop_sequence"])) for i in trip_ids}
+
+    def stops (self, stop_ids): # {stop_id: fields of stops.txt}
+        stop_ids = list (stop_ids)
+        result = {}
+        for i in range (0, len (stop_ids), 500): # Limit the number of query parameters
+            chunk = stop_ids [i : i + 500]
+            result.update ((k, json.loads (v)) for k, v in self.db.execute (f"SELECT stop_id, data FROM stops WHERE stop_id IN ({','.join ('?' * len (chunk))})", chunk))
+        return result
+
+    def transfers (self, stop_id, services = None): # Names of the routes serving a stop, only on services if given
+        return {name for name, service in self.db.execute ("SELECT route_name, service_id FROM transfers WHERE stop_id = ?", (stop_id,))
+                if services is None or service in services}
+
+    def shape (self, shape_id): # [[lon, lat], ...] in sequence order
+        return [[lon, lat] for lon, lat in self.db.execute ("SELECT lon, lat FROM shapes WHERE shape_id = ? ORDER BY sequence", (shape_id,))]
+
+    def close (self):
+        self.db.close ()
+        self.stop_times_file.close ()
+        if self.zip is not None:
+            self.zip.close ()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, *args):
+        self.close ()
+
+if __name__ == "__main__":
+    raise SystemExit ("This file contains functions used by other programs. It should not be run directly.")
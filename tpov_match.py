@@ -1,8 +1,9 @@
 # Built-in modules:
-import subprocess, struct, pickle, os, sys, math, json, argparse, shutil
+import subprocess, struct, pickle, os, sys, math, json, argparse, shutil, hashlib
 
 # Third-party modules:
 import osmium, gpxpy, jsonschema
+import numpy as np
 from tqdm import tqdm
 from texttable import Texttable
 from leuvenmapmatching.map.inmem import InMemMap
@@ -19,6 +20,8 @@ except ImportError:
         import xml.etree.ElementTree as etree
 
 from tpov_functions import *
+from tpov_gpx import Track, chunk_size, distance_2d, simplify_line
+from tpov_profile import profiler
 
 class lmmHandler (osmium.SimpleHandler):
     def __init__ (
@@ -28,7 +31,7 @@ class lmmHandler (osmium.SimpleHandler):
         super (lmmHandler, self).__init__ ()
         self.map_con = map_con
         self.stats = stats
-        self.node_cnt = tqdm (total = int (self.stats.get ("nodes", 0)), desc = "Reading nodes", mininterval = 0.5)
+        self.node_cnt = tqdm (total = int (self.stats.get ("nodes", 0)) or None, desc = "Reading nodes", mininterval = 0.5)
         self.tags = {}
     
     def node (self, n):
@@ -36,10 +39,10 @@ class lmmHandler (osmium.SimpleHandler):
         self.node_cnt.update ()
 
     def way (self, w):
-        if self.node_cnt:
+        if self.node_cnt is not None:
             self.node_cnt.close ()
             self.node_cnt = None
-            self.way_cnt = tqdm (total = int (self.stats.get ("ways", 0)), desc = "Reading ways", mininterval = 0.5)
+            self.way_cnt = tqdm (total = int (self.stats.get ("ways", 0)) or None, desc = "Reading ways", mininterval = 0.5)
         self.tags [w.id] = dict (w.tags)
         self.tags [w.id].setdefault ("highway", "unknown") # Default highway type
         if w.tags.get ("oneway") != "-1":
@@ -58,7 +61,7 @@ class startWayHandler (osmium.SimpleHandler):
     def __init__ (self, way_id, stats = {}):
         super (startWayHandler, self).__init__ ()
         self.way_id = way_id
-        self.way_cnt = tqdm (total = int (stats.get ("ways", 0)), desc = "Finding start way", mininterval = 0.5)
+        self.way_cnt = tqdm (total = int (stats.get ("ways", 0)) or None, desc = "Finding start way", mininterval = 0.5)
         self.nodes = None
     def way (self, w):
         if w.id == self.way_id:
@@ -67,31 +70,306 @@ class startWayHandler (osmium.SimpleHandler):
             raise self.WayFound ()
         self.way_cnt.update ()
 
+# Matched path stored as parallel arrays, converted once from leuvenmapmatching's lattice_best
+# Entry i is the edge l1 [i] -> l2 [i] matched to GPX point obs [i], emitting [i] is False for non-emitting states
+# Consecutive entries on the same edge form a run, run_start [r] to run_end [r] (exclusive)
+class MatchedPath:
+    def __init__ (self, l1, l2, obs, emitting):
+        self.l1 = np.asarray (l1, dtype = np.int64)
+        self.l2 = np.asarray (l2, dtype = np.int64)
+        self.obs = np.asarray (obs, dtype = np.int64)
+        self.emitting = np.asarray (emitting, dtype = bool)
+        self.index_runs ()
+
+    @classmethod
+    def from_lattice (cls, lattice_best):
+        if not lattice_best:
+            return cls ([], [], [], [])
+        return cls (*zip (*((i.edge_m.l1, i.edge_m.l2, i.obs, i.is_emitting ()) for i in lattice_best)))
+
+    def __len__ (self):
+        return len (self.l1)
+
+    def index_runs (self): # Must be called again after modifying the arrays
+        change = np.flatnonzero ((self.l1 [1 : ] != self.l1 [ : -1]) | (self.l2 [1 : ] != self.l2 [ : -1])) + 1
+        self.run_start = np.concatenate (([0], change)) if len (self) else change
+        self.run_end = np.concatenate ((change, [len (self)])) if len (self) else change
+
+    def run_of (self, index): # Run containing the entry at index
+        return int (np.searchsorted (self.run_start, index, side = "right")) - 1
+
+    def fill (self, start, stop, source): # Copy the entry at source into [start, stop)
+        for i in (self.l1, self.l2, self.obs, self.emitting):
+            i [start : stop] = i [source]
+
+    def nodes (self): # Unique nodes on the path
+        return np.unique (np.concatenate ((self.l1, self.l2)))
+
+# Get number of ways and nodes in the map
+def map_stats (map_path): # Only used for the totals of progress bars
+    try:
+        with profiler.phase ("osmconvert --out-statistics", "subprocess"):
+            stats = subprocess.run (["osmconvert", map_path, "--out-statistics"], capture_output = True)
+    except FileNotFoundError:
+        print ("osmconvert not found, progress bars will not show totals")
+        return {}
+    stats.check_returncode ()
+    return {i.split (": ") [0]: i.split (": ") [1] for i in stats.stdout.decode ().split ("\n") if i}
+
+# Map file to read, preferring the processed file (.filtered.o5m) if it exists
+def find_map (map_path):
+    if not os.path.exists (map_path):
+        raise FileNotFoundError ("Could not find map file.")
+    if os.path.exists (os.path.splitext (map_path) [0] + ".filtered.o5m"):
+        return os.path.splitext (map_path) [0] + ".filtered.o5m"
+    return map_path
+
+map_tile_size = 0.05 # Degrees, map pickles store nodes in chunks by tile so that only the tiles around a route are read
+map_chunk_size = 1 << 16 # Maximum number of nodes in each chunk of a map pickle
+
+# Key of the map tile of size degrees containing each (lat, lon) pair
+def tile_keys (coords, size):
+    coords = np.asarray (coords, dtype = float).reshape (-1, 2)
+    return (np.floor (coords [:, 0] / size).astype (np.int64) << 32) + np.floor (coords [:, 1] / size).astype (np.int64)
+
+# Save the map graph and tags as a pickle which can be read in chunks, so that only part of the map is kept in memory when loading it
+# The pickle is a header, chunks of nodes grouped by tile, the index of the chunks (offset, tile) and the offset of the index (64-bit)
+# Each chunk holds the nodes, the tags of the edges leaving them ({node: {edge: way}}), the chunks of their neighbours and the tags of those ways
+def save_map (path, map_con, tags):
+    data = map_con.serialize ()
+    graph = data.pop ("graph")
+    ids = np.fromiter (graph.keys (), dtype = np.int64, count = len (graph))
+    keys = tile_keys (np.fromiter ((j for i in graph.values () for j in i [0]), dtype = float, count = 2 * len (ids)), map_tile_size)
+    order = np.lexsort ((ids, keys))
+    ids, keys = ids [order], keys [order]
+    tiles = np.concatenate (([0], np.flatnonzero (keys [1 : ] != keys [ : -1]) + 1, [len (ids)])).tolist ()
+    chunks = [(i, min (i + map_chunk_size, end)) for start, end in zip (tiles, tiles [1 : ]) for i in range (start, end, map_chunk_size)]
+    chunk_of = dict (zip (ids.tolist (), np.repeat (np.arange (len (chunks)), [j - i for i, j in chunks]).tolist ()))
+
+    with open (path, "wb") as f:
+        pickle.dump ({"format": 2, "map": data, "tile_size": map_tile_size}, f)
+        index = []
+        for start, end in chunks:
+            nodes = {i: graph [i] for i in ids [start : end].tolist ()}
+            edges = {i: {k: tags [k] for k in (struct.pack ("<Q", i) + struct.pack ("<Q", j) for j in v [1]) if k in tags} for i, v in nodes.items ()}
+            links = {i: [chunk_of [j] for j in v [1]] for i, v in nodes.items ()}
+            ways = {j: tags [j] for i in edges.values () for j in i.values ()}
+            index.append ((f.tell (), int (keys [start])))
+            pickle.dump ((nodes, edges, links, ways), f)
+        offset = f.tell ()
+        pickle.dump (index, f)
+        f.write (struct.pack ("<Q", offset))
+
+# Read the chunks of a map pickle, only keeping the nodes in any of areas, their neighbours and the ways leaving them
+# Each area takes an array of (lat, lon) pairs and returns an array of booleans, and tiles (size) returns the keys of the tiles it overlaps
+# areas is None to read the whole map
+# Neighbour lists of the nodes in the areas are kept complete, so exits leading out of the areas are still counted at intersections
+# Neighbours outside the areas only keep their neighbours in the graph, so that walking along ways never leaves the graph
+def read_map (f, header, areas = None):
+    f.seek (-8, os.SEEK_END)
+    f.seek (struct.unpack ("<Q", f.read (8)) [0])
+    index = pickle.load (f)
+    def read_chunk (chunk):
+        f.seek (index [chunk] [0])
+        return pickle.load (f)
+
+    graph, tags = {}, {}
+    if areas is None:
+        for i in range (len (index)):
+            nodes, edges, _, ways = read_chunk (i)
+            graph.update (nodes)
+            for j in edges.values ():
+                tags.update (j)
+            tags.update (ways)
+        return InMemMap.deserialize ({**header ["map"], "graph": graph}), tags
+
+    ring, pending = set (), {} # Neighbours outside the areas, {chunk: IDs of neighbours to look for in it}
+    def add (nodes, edges, ways, i):
+        graph [i] = nodes [i]
+        tags.update (edges [i])
+        tags.update ((j, ways [j]) for j in edges [i].values ())
+    def add_ring (nodes, edges, ways, needed):
+        for i in needed.difference (graph):
+            add (nodes, edges, ways, i)
+            ring.add (i)
+
+    tiles = set ().union (*(i.tiles (header ["tile_size"]) for i in areas))
+    for chunk, (_, tile) in enumerate (index):
+        if tile not in tiles:
+            continue
+        nodes, edges, links, ways = read_chunk (chunk)
+        ids = np.fromiter (nodes.keys (), dtype = np.int64, count = len (nodes))
+        coords = np.fromiter ((j for i in nodes.values () for j in i [0]), dtype = float, count = 2 * len (ids)).reshape (-1, 2)
+        inside = np.zeros (len (ids), dtype = bool)
+        for i in areas:
+            inside |= i (coords)
+        for i in ids [inside].tolist ():
+            add (nodes, edges, ways, i)
+            for j, k in zip (nodes [i] [1], links [i]):
+                pending.setdefault (k, set ()).add (j)
+        add_ring (nodes, edges, ways, pending.pop (chunk, set ())) # Most neighbours are in the same chunk
+        del nodes, edges, links, ways
+    for chunk, needed in sorted (pending.items ()): # Neighbours in other tiles, or in chunks read before the nodes linking to them
+        if needed.difference (graph):
+            nodes, edges, _, ways = read_chunk (chunk)
+            add_ring (nodes, edges, ways, needed)
+            del nodes, edges, ways
+    for i in ring:
+        graph [i] = (graph [i] [0], [j for j in graph [i] [1] if j in graph])
+    return InMemMap.deserialize ({**header ["map"], "graph": graph}), tags
+
+# Load the map graph and tags, creating the map pickle from the OSM file if needed
+# areas (see read_map) only loads part of the map, the whole map is only read from the OSM file the first time
+def load_map (map_path, use_rtree = False, areas = None):
+    if os.path.exists (map_path + ".pkl"):
+        map_path = map_path + ".pkl"
+
+    if os.path.splitext (map_path) [1] != ".pkl":
+        print ("Loading map from OSM file...")
+        with profiler.phase ("map_stats"):
+            stats = map_stats (map_path)
+        with profiler.phase ("Read OSM file"):
+            handler = lmmHandler (InMemMap (map_path, use_latlon = True, index_edges = True, use_rtree = use_rtree), stats)
+            handler.apply_file (map_path)
+            map_con, tags = handler.map_con, handler.tags
+            del handler # Free memory
+        with profiler.phase ("Save map pickle"):
+            save_map (map_path + ".pkl", map_con, tags)
+        print (f"Saved pickle to {map_path}.pkl")
+        if areas is None:
+            profiler.set ("Map nodes", len (map_con.graph))
+            return map_con, tags
+        del map_con, tags
+        return load_map (map_path + ".pkl", use_rtree, areas)
+
+    with open (map_path, "rb") as f, profiler.phase ("Load map pickle"):
+        print ("Loading map from pickle... ", end = "", flush = True)
+        header = pickle.load (f)
+        if isinstance (header, dict):
+            map_con, tags = read_map (f, header, areas)
+        else: # Earlier versions saved the whole map as one object
+            map_con, tags = InMemMap.deserialize (header [0]), header [1]
+        print ("Done")
+    if not isinstance (header, dict):
+        with profiler.phase ("Save map pickle"):
+            print ("Converting map pickle to the current format... ", end = "", flush = True)
+            save_map (map_path + ".tmp", map_con, tags)
+            os.replace (map_path + ".tmp", map_path)
+            print ("Done")
+        if areas is not None:
+            del map_con, tags
+            return load_map (map_path, use_rtree, areas)
+    profiler.set ("Map nodes", len (map_con.graph))
+    return map_con, tags
+
+# Copy of map_con with only the given nodes and the edges between them, in the order of nodes
+def sub_map (map_con, nodes):
+    keep = set (nodes)
+    sub_con = map_con.serialize ()
+    sub_con ["graph"] = {i: (map_con.graph [i] [0], [j for j in map_con.graph [i] [1] if j in keep]) for i in nodes}
+    return InMemMap.deserialize (sub_con)
+
+# Reference line [(lat, lon), ...] from a match cache (.match.pkl) or stop data with a __shape__
+def load_prior (path):
+    if os.path.splitext (path) [1] == ".pkl":
+        with open (path, "rb") as f:
+            cached = pickle.load (f)
+        matched = MatchedPath (*cached ["path"])
+        line = np.concatenate ((matched.l1 [ : 1], matched.l2 [matched.run_start])) # Start node and the end node of each edge
+        return [tuple (cached ["nodes"] [i]) for i in line.tolist ()]
+    with open (path, "r") as f:
+        shape = json.load (f).get ("__shape__")
+    if not shape:
+        raise ValueError (f"{path} does not contain a __shape__. Extract the stop data without -s/--no-shape.")
+    return [(float (i [1]), float (i [0])) for i in shape] # __shape__ is in [lon, lat] order
+
+# Area within roughly `width` metres of the reference line, extended around track points which deviate from it
+# Coordinates are bucketed into a grid of `width` sized cells, a point is in the area if its cell or a neighbouring cell is covered
+# Calling it with an array of (lat, lon) pairs returns whether each is in the area
+class CorridorArea:
+    def __init__ (self, line, track, width):
+        self.scale = 111320 / width # Metres per degree of latitude (spherical Earth) in cells
+        self.lon_scale = self.scale * math.cos (math.radians (line [0] [0]))
+        offsets = np.array ([(i << 32) + j for i in (-1, 0, 1) for j in (-1, 0, 1)], dtype = np.int64)
+        def near (keys): # Keys of the cells and their neighbours
+            return np.unique ((keys [:, None] + offsets [None, :]).ravel ())
+
+        # Densify the line so that consecutive points are at most half a cell apart
+        line = np.asarray (line, dtype = float)
+        steps = np.ceil (2 * np.hypot ((line [1 : , 0] - line [ : -1, 0]) * self.scale, (line [1 : , 1] - line [ : -1, 1]) * self.lon_scale)).astype (np.int64)
+        steps = np.maximum (steps, 1)
+        seg = np.repeat (np.arange (len (steps)), steps)
+        frac = np.arange (len (seg)) - np.repeat (np.cumsum (steps) - steps, steps)
+        frac = (frac / np.repeat (steps, steps)) [:, None]
+        line = np.concatenate ((line [seg] + (line [seg + 1] - line [seg]) * frac, line [-1 : ]))
+
+        covered = near (self.cells (line))
+        track = self.cells (track)
+        deviating = ~np.isin (track, covered)
+        self.covered = np.union1d (covered, near (track [deviating]))
+        self.deviating = int (deviating.sum ()) # Number of deviating track points
+
+    def cells (self, coords): # Key of the cell containing each (lat, lon) pair
+        coords = np.asarray (coords, dtype = float).reshape (-1, 2)
+        return (np.floor (coords [:, 0] * self.scale).astype (np.int64) << 32) + np.floor (coords [:, 1] * self.lon_scale).astype (np.int64)
+
+    def __call__ (self, coords):
+        return np.isin (self.cells (coords), self.covered)
+
+    def tiles (self, size): # Keys of the tiles of size degrees (see tile_keys) overlapping the covered cells
+        lon = ((self.covered + (1 << 31)) & 0xffffffff) - (1 << 31) # Undo the packing of the cell keys
+        lat = (self.covered - lon) >> 32
+        lat = np.floor (np.stack ((lat / self.scale, (lat + 1) / self.scale)) / size).astype (np.int64)
+        lon = np.floor (np.stack ((lon / self.lon_scale, (lon + 1) / self.lon_scale)) / size).astype (np.int64)
+        return {(i << 32) + j for a, b, c, d in zip (*lat.tolist (), *lon.tolist ()) for i in range (a, b + 1) for j in range (c, d + 1)}
+
+# Nodes of map_con in the CorridorArea of the reference line, and the number of deviating track points
+def corridor_nodes (map_con, line, track, width):
+    area = CorridorArea (line, track, width)
+    ids = np.fromiter (map_con.graph.keys (), dtype = np.int64, count = len (map_con.graph))
+    coords = np.fromiter ((j for i in map_con.graph.values () for j in i [0]), dtype = float, count = 2 * len (ids))
+    return ids [area (coords)].tolist (), area.deviating
+
+# Encode coordinates with the Google encoded polyline algorithm (5 decimal places)
+# References: https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+def encode_polyline (lat, lon):
+    values = np.diff (np.round (np.column_stack ((lat, lon)) * 1e5).astype (np.int64), axis = 0, prepend = 0).ravel ()
+    values = np.where (values < 0, ~(values << 1), values << 1).tolist ()
+    result = []
+    for i in values:
+        while i >= 0x20:
+            result.append (chr ((0x20 | (i & 0x1f)) + 63))
+            i >>= 5
+        result.append (chr (i + 63))
+    return "".join (result)
+
 # Visualize each intersection and action (e.g. process_divided) in a HTML file with a map background
+# The path is simplified to within `simplify` metres and embedded as an encoded polyline
 class HTMLVisualizer:
-    def __init__ (self, lat, lon, template = None):
+    def __init__ (self, lat, lon, template = None, simplify = 1):
         if template is None:
             raise ValueError ("Template file not provided.")
         elif not os.path.exists (proj_path (template)):
             raise FileNotFoundError (f"Could not find {template}")
         with open (proj_path (template), "r") as f:
             self.template = f.read ()
-        self.lat, self.lon = lat, lon
+        self.lat, self.lon, self.simplify = lat, lon, simplify
         self.markers = {}
-        self.points = []
+        self.points = np.empty (0), np.empty (0)
         self.replacements = {
             r"%lat": lambda: str (self.lat),
             r"%lon": lambda: str (self.lon),
-            r"%markers": lambda: str (list (self.markers.values ())),
-            r"%points": lambda: str (self.points)
+            r"%markers": lambda: json.dumps (list (self.markers.values ()), separators = (",", ":")),
+            r"%points": lambda: json.dumps (encode_polyline (*self.points))
         }
     def add_marker (self, uid, lat, lon, text = ""):
         if uid in self.markers:
             self.markers [uid] ["text"] += f"<br><br>{text}"
         else:
             self.markers [uid] = {"lat": lat, "lon": lon, "text": text}
-    def add_point (self, lat, lon):
-        self.points.append ([lat, lon])
+    def add_points (self, lat, lon): # Arrays of coordinates
+        keep = simplify_line (lat, lon, self.simplify)
+        self.points = np.concatenate ((self.points [0], lat [keep])), np.concatenate ((self.points [1], lon [keep]))
     def write (self, path = os.path.abspath (proj_path ("visualization.html"))):
         page = self.template
         for i, j in self.replacements.items ():
@@ -101,9 +379,10 @@ class HTMLVisualizer:
         print (f"Visit file://{path} in a browser to view the visualization.")
 
 # Saves intersection and actions (e.g. process_divided) to a GPX file
+# The path is simplified to within `simplify` metres
 class GPXVisualizer:
-    def __init__ (self, lat, lon, template = None): # lat, lon, template are not used
-        self.markers = {}
+    def __init__ (self, lat, lon, template = None, simplify = 1): # lat, lon, template are not used
+        self.markers, self.simplify = {}, simplify
         self.gpx = gpxpy.gpx.GPX ()
         track = gpxpy.gpx.GPXTrack ()
         self.gpx.tracks.append (track)
@@ -114,8 +393,9 @@ class GPXVisualizer:
             self.markers [uid].description += f"<br><br>{text}"
         else:
             self.markers [uid] = gpxpy.gpx.GPXWaypoint (lat, lon, description = text)
-    def add_point (self, lat, lon):
-        self.segment.points.append (gpxpy.gpx.GPXTrackPoint (lat, lon))
+    def add_points (self, lat, lon): # Arrays of coordinates
+        keep = simplify_line (lat, lon, self.simplify)
+        self.segment.points.extend (gpxpy.gpx.GPXTrackPoint (i, j) for i, j in zip (lat [keep].tolist (), lon [keep].tolist ()))
     def write (self, path = os.path.abspath (proj_path ("visualization.gpx"))):
         for i in self.markers.values ():
             self.gpx.waypoints.append (i)
@@ -124,7 +404,7 @@ class GPXVisualizer:
         print (f"Load {path} in a GPX viewer to view the visualization.")
 
 def match_gpx (
-    gpx_path,
+    track, # Track loaded from the GPX file
     map_path,
     start_id,
     matcher_cls = SimpleMatcher, # Matcher class
@@ -136,44 +416,64 @@ def match_gpx (
     process_divided = None, # Divided road processing parameters
     hw_priority = {}, # Priority for highway types, default is 0
     matcher_params = {}, # Matcher parameters
-    visualize = False): # Visualization parameters
+    visualize = False, # Visualization parameters
+    prior = None, # Reference line [(lat, lon), ...] from a previous match or route shape, None to match on the full map
+    corridor = 150, # Width in metres of the matching corridor around prior
+    cache_path = None, # Path of the match cache sidecar, None to disable caching
+    cache_params = {}, # Parameters which affect the match result (used in the cache key)
+    rematch = False): # Ignore an existing match cache
 
-    with open (gpx_path, "r") as f:
-        gpx = gpxpy.parse (f)
-        points = tuple (gpx.walk (True))
     if visualize:
-        bounds = gpx.get_bounds ()
-        visualizer = visualizers [visualize ["visualizer"]] (bounds.min_latitude + (bounds.max_latitude - bounds.min_latitude) / 2,
-                                                             bounds.min_longitude + (bounds.max_longitude - bounds.min_longitude) / 2,
-                                                             visualize.get ("template"))
+        min_lat, max_lat, min_lon, max_lon = track.bounds ()
+        visualizer = visualizers [visualize ["visualizer"]] (float (min_lat + (max_lat - min_lat) / 2),
+                                                             float (min_lon + (max_lon - min_lon) / 2),
+                                                             visualize.get ("template"),
+                                                             visualize.get ("simplify", 1))
 
     # Add a dict of information about a node into a marker
+    markers = [] # Markers are always recorded so they can be replayed from the match cache
     def add_marker (node, info, title = "Marker", gpx_index = None):
+        nonlocal visualizer, map_con, markers
+        template = "<b>{title}</b><br>Node ID: {node}<br>Latitude: {lat}<br>Longitude: {lon}<br>{info}"
+        if gpx_index:
+            lat, lon = float (track.lat [gpx_index]), float (track.lon [gpx_index])
+        else:
+            lat, lon = map_con.graph [node] [0]
+        info = "<br>".join (f"{k}: {v}" for k, v in info.items ())
+        markers.append ((node, lat, lon, template.format (title = title, node = node, lat = lat, lon = lon, info = info)))
         if visualize:
-            nonlocal visualizer, map_con
-            template = "<b>{title}</b><br>Node ID: {node}<br>Latitude: {lat}<br>Longitude: {lon}<br>{info}"
-            if gpx_index:
-                lat, lon = points [gpx_index].latitude, points [gpx_index].longitude
-            else:
-                lat, lon = map_con.graph [node] [0]
-            info = "<br>".join (f"{k}: {v}" for k, v in info.items ())
-            visualizer.add_marker (node, lat, lon, template.format (title = title, node = node, lat = lat, lon = lon, info = info))
-
-    # Get number of ways and nodes in the map
-    def map_stats ():
-        stats = subprocess.run (["osmconvert", map_path, "--out-statistics"], capture_output = True)
-        stats.check_returncode ()
-        return {i.split (": ") [0]: i.split (": ") [1] for i in stats.stdout.decode ().split ("\n") if i}
-
-    if not os.path.exists (map_path):
-        raise FileNotFoundError ("Could not find map file.")
-    
-    # Test for processed file (.filtered.o5m)
-    if os.path.exists (os.path.splitext (map_path) [0] + ".filtered.o5m"):
-        map_path = os.path.splitext (map_path) [0] + ".filtered.o5m"
+            visualizer.add_marker (*markers [-1])
+
+    map_path = find_map (map_path)
+
+    if cache_path:
+        # Key the cache on the track, the source map file and all parameters which affect matching
+        # The map is keyed on its path, size and modification time, as hashing a large map would take longer than loading the cache
+        cache_key = hashlib.sha256 (json.dumps ({
+            "gpx": file_hash (track.path),
+            "map": {"path": os.path.abspath (map_path), **file_stat (map_path)},
+            "start": start_id,
+            # A match in the corridor may differ from a match on the full map, the prior is keyed on its coordinates so that editing the stops keeps the cache
+            "prior": hashlib.sha256 (json.dumps (prior).encode ()).hexdigest () if prior else None,
+            "params": cache_params,
+            "format": 2 # Increase when the cache format changes
+        }, sort_keys = True).encode ()).hexdigest ()
+        if not rematch and os.path.exists (cache_path):
+            with open (cache_path, "rb") as f, profiler.phase ("Load match cache"):
+                cached = pickle.load (f)
+            if cached ["key"] == cache_key:
+                print (f"Using cached match from {cache_path} (use --rematch to match again)")
+                map_con = InMemMap ("cache", use_latlon = True) # Only contains nodes on the matched path
+                for i, j in cached ["nodes"].items ():
+                    map_con.add_node (i, j)
+                if visualize:
+                    for i in cached ["markers"]:
+                        visualizer.add_marker (*i)
+                return cached ["directions"], MatchedPath (*cached ["path"]), map_con, visualizer if visualize else None
+            print ("Track, map or matching parameters changed since the last match, matching again...")
 
     if start_id:
-        handler = startWayHandler (int (start_id), map_stats ())
+        handler = startWayHandler (int (start_id), map_stats (map_path))
         try:
             handler.apply_file (map_path)
         except startWayHandler.WayFound:
@@ -181,51 +481,47 @@ def match_gpx (
         if handler.nodes is None:
             raise ValueError (f"Start way {start_id} not found in map file.")
 
-    if os.path.exists (map_path + ".pkl"):
-        map_path = map_path + ".pkl"
-
-    if os.path.splitext (map_path) [1] == ".pkl":
-        with open (map_path, "rb") as f:
-            print ("Loading map from pickle... ", end = "", flush = True)
-            map_con, tags = pickle.load (f)
-            map_con = InMemMap.deserialize (map_con)
-            print ("Done")
+    if prior:
+        # Only load the map around the prior path, with a margin of another corridor width for intersection processing
+        track_coords = np.column_stack ((track.lat, track.lon))
+        map_con, tags = load_map (map_path, use_rtree, [CorridorArea (prior, track_coords, corridor), CorridorArea (prior, track_coords, 2 * corridor)])
+        with profiler.phase ("Corridor"):
+            nodes, deviating = corridor_nodes (map_con, prior, track_coords, corridor)
+            print (f"Matching in a {corridor} m corridor around the prior path with {len (nodes)} of {len (map_con.graph)} loaded nodes, {deviating} points deviate from it")
+            match_con = sub_map (map_con, nodes) # Candidate edges are only searched in the corridor
     else:
-        print ("Loading map from OSM file...")
-        stats = map_stats ()
-        handler = lmmHandler (InMemMap (map_path, use_latlon = True, index_edges = True, use_rtree = use_rtree), stats)
-        handler.apply_file (map_path)
-        map_con, tags = handler.map_con, handler.tags
-        del handler # Free memory
-        with open (map_path + ".pkl", "wb") as f:
-            pickle.dump ((map_con.serialize (), tags), f)
-        print (f"Saved pickle to {map_path}.pkl")
+        map_con, tags = load_map (map_path, use_rtree)
+        match_con = map_con
 
     print (f"Running {matcher_cls.__name__}...")
-    if start_id:
-        start_con = map_con.serialize ()
-        start_graph = {}
-        for i in handler.nodes: # Hack to only keep start way nodes
-            start_graph [i] = (
-                start_con ["graph"] [i] [0],
-                [j for j in start_con ["graph"] [i] [1] if j in handler.nodes] # Remove neighbours not on the start way
-            )
-        start_con ["graph"] = start_graph
-        start_con = InMemMap.deserialize (start_con)
-        matcher = matcher_cls (start_con, **matcher_params)
-        _, lastidx = matcher.match ([(i.latitude, i.longitude, i.time) for i in points], tqdm = tqdm)
-        print (f"Matched {lastidx} points on start way {start_id}")
-        start_con.graph = map_con.graph # Restore original graph
-
-        if lastidx != matcher.lattice_best [-1].obs:
-            raise ValueError (f"Discrepancy between last matched index ({lastidx}) and last lattice index ({matcher.lattice_best [-1].obs}). Please report this error.")
-        match_points = [(i.latitude, i.longitude, i.time) for i in points [lastidx + 1 : ]]
-    else:
-        matcher = matcher_cls (map_con, **matcher_params)
-        match_points = [(i.latitude, i.longitude, i.time) for i in points]
-
-    _, lastidx = matcher.match(match_points, tqdm = tqdm)
-    if lastidx < len (points) - 1:
+    with profiler.phase ("Map matching"):
+        if start_id:
+            start_con = sub_map (map_con, handler.nodes) # Hack to only keep start way nodes
+            matcher = matcher_cls (start_con, **matcher_params)
+            _, lastidx = matcher.match (track.coords (), tqdm = tqdm)
+            print (f"Matched {lastidx} points on start way {start_id}")
+            start_con.graph = match_con.graph # Restore original graph
+
+            if lastidx != matcher.lattice_best [-1].obs:
+                raise ValueError (f"Discrepancy between last matched index ({lastidx}) and last lattice index ({matcher.lattice_best [-1].obs}). Please report this error.")
+            match_points = track.coords (lastidx + 1)
+        else:
+            matcher = matcher_cls (match_con, **matcher_params)
+            match_points = track.coords ()
+
+        _, lastidx = matcher.match(match_points, tqdm = tqdm)
+        if match_con is not map_con and lastidx < len (match_points) - 1:
+            print (f"Matching stopped at point {lastidx} in the corridor, matching again on the full map...")
+            profiler.count ("Corridor fallbacks")
+            map_con, tags = load_map (map_path, use_rtree)
+            matcher = matcher_cls (map_con, **matcher_params) # A new matcher, so that the rtree index covers the full map
+            _, lastidx = matcher.match (match_points, tqdm = tqdm)
+        del match_con
+    if profiler.enabled:
+        profiler.set ("Lattice columns", len (matcher.lattice))
+        profiler.set ("Lattice states", sum (len (j) for i in matcher.lattice.values () for j in i.o))
+        profiler.set ("Matched points", lastidx + 1)
+    if lastidx < len (track) - 1:
         if not lastidx: # No points matched - likely due to origin being too far from a road
             raise SystemExit ("No points matched. Try increasing max_dist_init in the matcher parameters or setting a start way.")
         last_l1, last_l2 = matcher.lattice_best [lastidx].edge_m.l1, matcher.lattice_best [lastidx].edge_m.l2
@@ -233,20 +529,25 @@ def match_gpx (
             f"Not all points were matched. Last matched {last_l1} -> {last_l2} at ({map_con.graph [last_l1] [0] [1]}, {map_con.graph [last_l1] [0] [0]})."
             "\nThis may be fixed by increasing max_dist and/or max_dist_init in the matcher parameters."
             "\nIn certain cases truncating the beginning of the GPX file may help, which can be done with this command:"
-            f"\n{sys.executable} {proj_path ('tpov_truncate.py')} {gpx_path} -t {iso_time (points [lastidx + 1].time)} {iso_time (points [-1].time)}"
+            f"\n{sys.executable} {proj_path ('tpov_truncate.py')} {track.path} -t {iso_time (track.time_at (lastidx + 1))} {iso_time (track.time_at (-1))}"
             "\nContinue processing (Y/n)? ").lower () != "y":
             raise SystemExit ("Processing cancelled.")
         add_marker (last_l1, {"Last Matched Way": f"{last_l1} -> {last_l2}"}, "Last Matched Node")
 
-    for i, j in zip (matcher.lattice_best, matcher.lattice_best [1 : ]):
-        if not (i.edge_m.l1 == j.edge_m.l1 and i.edge_m.l2 == j.edge_m.l2) and i.edge_m.l2 != j.edge_m.l1:
-            raise NotImplementedError (f"Path discontinuity at ({i.edge_m.l1}, {i.edge_m.l2}) -> ({j.edge_m.l1}, {j.edge_m.l2})")
+    path = MatchedPath.from_lattice (matcher.lattice_best)
+    del matcher # Free memory, all further processing uses path
+
+    # Consecutive edges must share a node
+    gaps = np.flatnonzero (path.l2 [path.run_start [1 : ] - 1] != path.l1 [path.run_start [1 : ]])
+    if len (gaps):
+        i, j = path.run_start [gaps [0] + 1] - 1, path.run_start [gaps [0] + 1]
+        raise NotImplementedError (f"Path discontinuity at ({path.l1 [i]}, {path.l2 [i]}) -> ({path.l1 [j]}, {path.l2 [j]})")
 
-    exit_name = tags [tags [struct.pack ("<Q", matcher.lattice_best [0].edge_m.l1) +
-                            struct.pack ("<Q", matcher.lattice_best [0].edge_m.l2)]].get ("name", default_name)
+    exit_name = tags [tags [struct.pack ("<Q", int (path.l1 [0])) +
+                            struct.pack ("<Q", int (path.l2 [0]))]].get ("name", default_name)
     last_name = exit_name
     # [gpx index, intersection node, current name, left name, forward name, right name, exit direction]
-    directions = [(0, matcher.lattice_best [0].edge_m.l1, exit_name, "", "", "", "")]
+    directions = [(0, int (path.l1 [0]), exit_name, "", "", "", "")]
 
     def node_heading (node2, node1):
         nonlocal map_con
@@ -258,37 +559,33 @@ def match_gpx (
                gpxpy.geo.Location (map_con.graph [node1] [0] [1], map_con.graph [node1] [0] [0]))
 
     # Find loops (either U-turns or matching errors)
-    curr_index = 0
-    curr_edge = (matcher.lattice_best [0].edge_m.l1, matcher.lattice_best [0].edge_m.l2)
-    # [(edge, start point, end point), ...] end point is exclusive
-    edges = []
-    for i in range (len (matcher.lattice_best)):
-        edge = (matcher.lattice_best [i].edge_m.l1, matcher.lattice_best [i].edge_m.l2)
-        if edge != curr_edge:
-            edges.append ((curr_edge, curr_index, i))
-            curr_edge, curr_index = edge, i
-    edges.append ((curr_edge, curr_index, len (matcher.lattice_best))) # Add last edge
-
-    # [[start point, end point, start node, end node, length in m, road name(s)], ...]
-    loops = []
-    for j, i in enumerate (edges [ : -1]):
-        length, length_m, names = 0, 0, []
-        while set (edges [j - length] [0]) == set (edges [j + length + 1] [0]) and j - length >= 0 and j + length + 1 < len (edges):
-            nodes = edges [j - length] [0] # two nodes of the edge
-            length_m += node_distance (*nodes)
-            names.append (tags [tags [struct.pack ("<Q", nodes [0]) + struct.pack ("<Q", nodes [1])]].get ("name", default_name))
-            length += 1
-        length -= 1 # Remove last iteration
-        if length >= 0:
-            loops.append ((
-                edges [j - length] [1],
-                edges [j + length + 1] [2],
-                edges [j - length] [0] [0],
-                edges [j] [0] [1],
-                format (length_m, ".4f"),
-                ", ".join (dict.fromkeys (names)), # Remove duplicates
-                edges [j] [2], # Middle point of the loop
-            ))
+    with profiler.phase ("Loop detection"):
+        # [(edge, start point, end point), ...] end point is exclusive
+        edges = [((i, j), k, l) for i, j, k, l in zip (
+            path.l1 [path.run_start].tolist (), path.l2 [path.run_start].tolist (), path.run_start.tolist (), path.run_end.tolist ())]
+
+        # [[start point, end point, start node, end node, length in m, road name(s)], ...]
+        loops = []
+        for j, i in enumerate (edges [ : -1]):
+            length, length_m, names = 0, 0, []
+            while set (edges [j - length] [0]) == set (edges [j + length + 1] [0]) and j - length >= 0 and j + length + 1 < len (edges):
+                nodes = edges [j - length] [0] # two nodes of the edge
+                length_m += node_distance (*nodes)
+                names.append (tags [tags [struct.pack ("<Q", nodes [0]) + struct.pack ("<Q", nodes [1])]].get ("name", default_name))
+                length += 1
+            length -= 1 # Remove last iteration
+            if length >= 0:
+                loops.append ((
+                    edges [j - length] [1],
+                    edges [j + length + 1] [2],
+                    edges [j - length] [0] [0],
+                    edges [j] [0] [1],
+                    format (length_m, ".4f"),
+                    ", ".join (dict.fromkeys (names)), # Remove duplicates
+                    edges [j] [2], # Middle point of the loop
+                ))
+    profiler.set ("Path edges", len (edges))
+    profiler.set ("Loops", len (loops))
 
     if loops:
         choicetable (
@@ -300,339 +597,400 @@ def match_gpx (
         for i in remove:
             if i [0] == 0:
                 midpoint = i [0] # Fill all edges from the back
-            elif i [1] == len (matcher.lattice_best):
+            elif i [1] == len (path):
                 midpoint = i [1] # Fill all edges from the front
             else:
                 midpoint = i [6] # Fill half from the front and half from the back
-            for j in range (i [0], midpoint):
-                matcher.lattice_best [j] = matcher.lattice_best [i [0] - 1]
-            for j in range (midpoint, i [1]):
-                matcher.lattice_best [j] = matcher.lattice_best [i [1]]
-
-    def divided_process (case, dest, orig, *, orig_id = None, orig_angle = None, lattice_index = None):
-        # Return true if action should be taken (e.g. ignore exit, add exit), false otherwise
-        nonlocal directions, map_con, tags, process_divided, matcher, default_name, add_marker
-        if case not in process_divided ["enabled_cases"]:
-            return False
-
-        if case == 1: # Case 1: Ignore short spur which leads to the opposite side of the divided road
-            if orig_id is None or orig_angle is None:
-                raise ValueError ("process_divided: orig_id and orig_angle must be provided for case 1")
-
-            dist = node_distance (dest, orig)
-            visited = [orig] # Visited nodes to ignore backtracking
-            names = {tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)}
-            while dist <= process_divided ["length"]:
-                exits = []
-                for j in map_con.graph [dest] [1]:
-                    if j in visited:
-                        continue
-                    way = tags [tags [struct.pack ("<Q", dest) + struct.pack ("<Q", j)]]
-                    if not process_divided ["apply_filter"] or exit_filter (way):
-                        exits.append (j)
-                if len (exits) != 1: # Not a spur which just leads to the opposite side
-                    break
-
-                orig, dest = dest, exits [0] # Move to next node
-                name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)
-                visited.append (orig)
-                angle = (node_heading (dest, orig) - orig_angle) % 360
-                angle_diff = abs (180 - angle)
-                if angle_diff <= process_divided ["angle"]:
-                    if not process_divided ["same_name"] or tags [orig_id].get ("name", default_name) == name:
-                        print (f"process_divided (1): Ignoring {', '.join (names)} {visited [0]} -> {orig} with angle {angle_diff:.4f} and length {dist:.4f}")
-                        add_marker (visited [0], {"Name(s)": ", ".join (names), "Angle": angle_diff, "Length": dist}, "process_divided (1)")
-                        return True
-
-                dist += node_distance (dest, orig)
-                names.add (name)
-            return False
-
-        elif case == 2: # Case 2: Ignore exit to the opposite side of the divided road at a turn
-            if directions [-1] [0] == 0: # Ignore first intersection
+            if i [0] < midpoint:
+                path.fill (i [0], midpoint, i [0] - 1)
+            if midpoint < i [1]:
+                path.fill (midpoint, i [1], i [1])
+        path.index_runs ()
+
+    # Plain lists are faster than arrays for the element-wise access below
+    with profiler.phase ("Intersections"):
+        l1, l2, obs, run_start = path.l1.tolist (), path.l2.tolist (), path.obs.tolist (), path.run_start.tolist ()
+
+        def divided_process (case, dest, orig, *, orig_id = None, orig_angle = None, lattice_index = None):
+            # Return true if action should be taken (e.g. ignore exit, add exit), false otherwise
+            nonlocal directions, map_con, tags, process_divided, default_name, add_marker
+            if case not in process_divided ["enabled_cases"]:
                 return False
-            prev = directions [-1] [1] # Previous intersection node
-            prev2 = matcher.lattice_best [directions [-1] [0] - 1].edge_m.l1 # Previous road
-
-            orig_name = tags [tags [struct.pack ("<Q", prev2) + struct.pack ("<Q", prev)]].get ("name", default_name)
-            dest_name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)
-            if process_divided ["same_name"] and orig_name != dest_name:
+            profiler.count (f"process_divided ({case}) calls")
+
+            if case == 1: # Case 1: Ignore short spur which leads to the opposite side of the divided road
+                if orig_id is None or orig_angle is None:
+                    raise ValueError ("process_divided: orig_id and orig_angle must be provided for case 1")
+
+                dist = node_distance (dest, orig)
+                visited = [orig] # Visited nodes to ignore backtracking
+                names = {tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)}
+                while dist <= process_divided ["length"]:
+                    exits = []
+                    for j in map_con.graph [dest] [1]:
+                        if j in visited:
+                            continue
+                        way = tags [tags [struct.pack ("<Q", dest) + struct.pack ("<Q", j)]]
+                        if not process_divided ["apply_filter"] or exit_filter (way):
+                            exits.append (j)
+                    if len (exits) != 1: # Not a spur which just leads to the opposite side
+                        break
+
+                    orig, dest = dest, exits [0] # Move to next node
+                    name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)
+                    visited.append (orig)
+                    angle = (node_heading (dest, orig) - orig_angle) % 360
+                    angle_diff = abs (180 - angle)
+                    if angle_diff <= process_divided ["angle"]:
+                        if not process_divided ["same_name"] or tags [orig_id].get ("name", default_name) == name:
+                            print (f"process_divided (1): Ignoring {', '.join (names)} {visited [0]} -> {orig} with angle {angle_diff:.4f} and length {dist:.4f}")
+                            add_marker (visited [0], {"Name(s)": ", ".join (names), "Angle": angle_diff, "Length": dist}, "process_divided (1)")
+                            return True
+
+                    dist += node_distance (dest, orig)
+                    names.add (name)
                 return False
 
-            orig_angle = node_heading (prev, prev2)
-            angle = (node_heading (dest, orig) - orig_angle) % 360
-            angle_diff = abs (180 - angle)
-            if angle_diff > process_divided ["angle"]:
-                return False
+            elif case == 2: # Case 2: Ignore exit to the opposite side of the divided road at a turn
+                if directions [-1] [0] == 0: # Ignore first intersection
+                    return False
+                prev = directions [-1] [1] # Previous intersection node
+                prev2 = l1 [directions [-1] [0] - 1] # Previous road
 
-            # If straight-line distance is larger than threshold, no need to check individual segments
-            rough_dist = node_distance (orig, prev)
-            if rough_dist > process_divided ["length"]:
-                return False
-            dist, last_node = 0, prev
-            for i in matcher.lattice_best [directions [-1] [0] : ]:
-                if i.edge_m.l2 != last_node:
-                    dist += node_distance (i.edge_m.l2, last_node)
-                    if dist > process_divided ["length"]:
-                        return False
-                    last_node = i.edge_m.l2
-                if i.edge_m.l2 == orig:
-                    print (f"process_divided (2): Ignoring {dest_name} {orig} -> {dest} with angle {angle_diff:.4f} and length {dist:.4f}")
-                    add_marker (orig, {"Name": dest_name, "Angle": angle_diff, "Length": dist}, "process_divided (2)")
-                    return True
-            print ("process_divided (2): Distance calculation reached the end of the path. Please report this error.")
-            return False # Should not reach here
-
-        elif case == 3: # Case 3: Add exit to [directions] for a far turn (e.g. left in right-hand traffic) onto a divided road
-            dest_angle = node_heading (dest, orig)
-            dest_name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)
-            prev = directions [-1] [1] # Previous intersection node
-            prev2 = matcher.lattice_best [directions [-1] [0] - 1].edge_m.l1 # Previous road
-            prev_l2 = matcher.lattice_best [directions [-1] [0]].edge_m.l2 # Next node of previous intersection
-
-            if len ({prev2, prev, orig, dest}) != 4: # Skip if any node is repeated (e.g. backtracking of a two-way road)
-                return False
+                orig_name = tags [tags [struct.pack ("<Q", prev2) + struct.pack ("<Q", prev)]].get ("name", default_name)
+                dest_name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)
+                if process_divided ["same_name"] and orig_name != dest_name:
+                    return False
 
-            orig_angle = node_heading (prev_l2, prev)
-            if abs (dest_angle - orig_angle) < process_divided ["angle"]: # Usually caused by backtracking of a two-way road becoming divided
-                return False
-
-            prev_angle = (node_heading (prev, prev2) - orig_angle) % 360
-            prev_angle = 180 - abs (180 - prev_angle)
-            if prev_angle > process_divided ["angle"]:
-                return False # Side road bend too sharp, usually caused by backtracking of a two-way road (may need to adjust angle threshold)
-
-            # If straight-line distance is larger than threshold, no need to check individual segments
-            rough_dist = node_distance (orig, prev)
-            if rough_dist > process_divided ["length"]:
-                return False # Too far to be a divided road
-
-            dist, last_node = 0, prev
-            for i in matcher.lattice_best [directions [-1] [0] : ]:
-                if i.edge_m.l2 != last_node:
-                    dist += node_distance (i.edge_m.l2, last_node)
-                    if dist > process_divided ["length"]:
-                        return False
-                    last_node = i.edge_m.l2
-                if i.edge_m.l2 == orig:
-                    break
-
-            for i in map_con.graph [prev] [1]:
-                if i in (orig, prev2, prev_l2):
-                    continue # Skip matched roads
-                prev_name = tags [tags [struct.pack ("<Q", prev) + struct.pack ("<Q", i)]].get ("name", default_name)
-                if process_divided ["same_name"] and prev_name != dest_name:
-                    continue
+                orig_angle = node_heading (prev, prev2)
+                angle = (node_heading (dest, orig) - orig_angle) % 360
+                angle_diff = abs (180 - angle)
+                if angle_diff > process_divided ["angle"]:
+                    return False
+
+                # If straight-line distance is larger than threshold, no need to check individual segments
+                rough_dist = node_distance (orig, prev)
+                if rough_dist > process_divided ["length"]:
+                    return False
+                dist, last_node = 0, prev
+                for i in run_start [path.run_of (directions [-1] [0]) : ]:
+                    if l2 [i] != last_node:
+                        dist += node_distance (l2 [i], last_node)
+                        if dist > process_divided ["length"]:
+                            return False
+                        last_node = l2 [i]
+                    if l2 [i] == orig:
+                        print (f"process_divided (2): Ignoring {dest_name} {orig} -> {dest} with angle {angle_diff:.4f} and length {dist:.4f}")
+                        add_marker (orig, {"Name": dest_name, "Angle": angle_diff, "Length": dist}, "process_divided (2)")
+                        return True
+                print ("process_divided (2): Distance calculation reached the end of the path. Please report this error.")
+                return False # Should not reach here
+
+            elif case == 3: # Case 3: Add exit to [directions] for a far turn (e.g. left in right-hand traffic) onto a divided road
+                dest_angle = node_heading (dest, orig)
+                dest_name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)
+                prev = directions [-1] [1] # Previous intersection node
+                prev2 = l1 [directions [-1] [0] - 1] # Previous road
+                prev_l2 = l2 [directions [-1] [0]] # Next node of previous intersection
+
+                if len ({prev2, prev, orig, dest}) != 4: # Skip if any node is repeated (e.g. backtracking of a two-way road)
+                    return False
+
+                orig_angle = node_heading (prev_l2, prev)
+                if abs (dest_angle - orig_angle) < process_divided ["angle"]: # Usually caused by backtracking of a two-way road becoming divided
+                    return False
+
+                prev_angle = (node_heading (prev, prev2) - orig_angle) % 360
+                prev_angle = 180 - abs (180 - prev_angle)
+                if prev_angle > process_divided ["angle"]:
+                    return False # Side road bend too sharp, usually caused by backtracking of a two-way road (may need to adjust angle threshold)
+
+                # If straight-line distance is larger than threshold, no need to check individual segments
+                rough_dist = node_distance (orig, prev)
+                if rough_dist > process_divided ["length"]:
+                    return False # Too far to be a divided road
+
+                dist, last_node = 0, prev
+                for i in run_start [path.run_of (directions [-1] [0]) : ]:
+                    if l2 [i] != last_node:
+                        dist += node_distance (l2 [i], last_node)
+                        if dist > process_divided ["length"]:
+                            return False
+                        last_node = l2 [i]
+                    if l2 [i] == orig:
+                        break
+
+                for i in map_con.graph [prev] [1]:
+                    if i in (orig, prev2, prev_l2):
+                        continue # Skip matched roads
+                    prev_name = tags [tags [struct.pack ("<Q", prev) + struct.pack ("<Q", i)]].get ("name", default_name)
+                    if process_divided ["same_name"] and prev_name != dest_name:
+                        continue
 
-                angle = (node_heading (prev, i) - dest_angle) % 360
-                angle = 180 - abs (180 - angle)
-                if angle > process_divided ["angle"]:
-                    continue
-                print (f"process_divided (3): Adding {prev_name} {prev} -> {i} with angles {prev_angle:4f}, {angle:.4f} and length {dist:.4f}")
-                add_marker (orig, {"Name": prev_name, "Prev_Angle": prev_angle, "Angle": angle, "Length": dist}, "process_divided (3)")
-                return prev_name
-            return False
-
-        elif case == 4: # Case 4: Ignore "intersection" when a divided road merges back into a two-way road
-            if lattice_index is None:
-                raise ValueError ("process_divided: lattice_index must be provided for case 4")
-
-            path_dest = matcher.lattice_best [lattice_index + 1].edge_m.l2 # Next path node after orig
-            if path_dest not in map_con.graph [orig] [1] or orig not in map_con.graph [path_dest] [1]:
-                return False # orig -> path_dest not a two-way road
-
-            prev = matcher.lattice_best [lattice_index].edge_m.l1 # Previous path node (may be not an intersection)
-            dest_name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)
-            orig_name = tags [tags [struct.pack ("<Q", prev) + struct.pack ("<Q", orig)]].get ("name", default_name)
-            path_name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", path_dest)]].get ("name", default_name)
-            if process_divided ["same_name"] and (orig_name != dest_name or orig_name != path_name): # Two sides of the divided road have different names
+                    angle = (node_heading (prev, i) - dest_angle) % 360
+                    angle = 180 - abs (180 - angle)
+                    if angle > process_divided ["angle"]:
+                        continue
+                    print (f"process_divided (3): Adding {prev_name} {prev} -> {i} with angles {prev_angle:4f}, {angle:.4f} and length {dist:.4f}")
+                    add_marker (orig, {"Name": prev_name, "Prev_Angle": prev_angle, "Angle": angle, "Length": dist}, "process_divided (3)")
+                    return prev_name
                 return False
 
-            exits = []
-            for i in map_con.graph [dest] [1]:
-                if i == orig:
-                    return False # dest is a two-way road
-                way = tags [tags [struct.pack ("<Q", dest) + struct.pack ("<Q", i)]]
-                if not process_divided ["apply_filter"] or exit_filter (way):
-                    exits.append (i)
-            if len (exits) > 1: # dest -> dest2 not a one-way road with no intersections 
-                return False
-            dest2 = exits [0] # Next path node after dest (may be not an intersection)
+            elif case == 4: # Case 4: Ignore "intersection" when a divided road merges back into a two-way road
+                if lattice_index is None:
+                    raise ValueError ("process_divided: lattice_index must be provided for case 4")
 
-            for i in matcher.lattice_best [lattice_index : : -1]:
-                if i.edge_m.l2 == prev:
-                    break
-            prev2 = i.edge_m.l1 # Second previous path node
-            if prev2 == orig: # U-turn at prev
-                return False
-            
-            exits = []
-            for i in map_con.graph [prev] [1]:
-                if i == prev2:
-                    return False # prev is a two-way road
-                way = tags [tags [struct.pack ("<Q", prev) + struct.pack ("<Q", i)]]
-                if not process_divided ["apply_filter"] or exit_filter (way):
-                    exits.append (i)
-            if len (exits) > 1: # prev -> orig not a one-way road with no intersections
-                return False
-            elif exits != [orig]: # Should not reach here
-                print (f"process_divided (4): Only exit from prev {prev} is not orig {orig}. Please report this error.")
-                return False
+                path_dest = l2 [lattice_index + 1] # Next path node after orig
+                if path_dest not in map_con.graph [orig] [1] or orig not in map_con.graph [path_dest] [1]:
+                    return False # orig -> path_dest not a two-way road
 
-            prev_angle = node_heading (prev, prev2)
-            dest_angle = (node_heading (dest2, dest) - prev_angle) % 360
-            angle_diff = abs (180 - dest_angle) # Angle difference between two sides of the divided road
-            if angle_diff > process_divided ["angle"]: # TODO: choose a more appropriate angle threshold
-                pass # return False
-
-            dist = node_distance (prev, dest)
-            dist2 = node_distance (prev2, dest2)
-            if dist > process_divided ["length"] and dist2 > process_divided ["length"]:
-                # Sample two node distances, not a divided road if both are too far
-                # May need a more sophisticated method to determine divided road (e.g. linear algebra)
-                return False 
-
-            print (f"process_divided (4): Ignoring {dest_name} {orig} -> {dest} with angle {angle_diff:.4f} and distance {dist:.4f} {dist2:.4f}")
-            add_marker (orig, {"Name": dest_name, "Angle": angle_diff, "Distance": dist, "Distance2": dist2}, "process_divided (4)")
-            return True
-
-        raise NotImplementedError (f"Divided road processing for case {case} not implemented.")
-    link_until = (None, -1) # (name, last index of link road)
-    def link_follow (index, way): # Return the name of the destination road
-        nonlocal matcher, tags, default_name, link_until, follow_link, add_marker
-        if index <= link_until [1]:
-            return link_until [0]
-
-        way = way.copy () # Avoid modifying the original
-        if way.get ("highway").endswith ("_link") and not way.get ("name"): # Link road without name
-            for l, k in enumerate (matcher.lattice_best [index + 1 : ]): # Start from next match
-                dest = tags [tags [struct.pack ("<Q", k.edge_m.l1) + struct.pack ("<Q", k.edge_m.l2)]]
-                if not dest.get ("highway").endswith ("_link"):
-                    link_until = (follow_link.replace ("%n", dest.get ("name", default_name)), index + l)
-                    print (f"follow_link: Followed link {matcher.lattice_best [index].edge_m.l1} -> {k.edge_m.l1} to {dest.get ('name', default_name)}")
-                    add_marker (matcher.lattice_best [index].edge_m.l1, {"Destination": dest.get ("name", default_name)}, "follow_link")
-                    return link_until [0]
-        return way.get ("name", default_name)
-
-    for j, i in enumerate (matcher.lattice_best [1 : ]):
-        orig = i.edge_m.l1
-        if orig == matcher.lattice_best [j].edge_m.l2:
-            dirs = ["", "", ""] # [left, forward, right]
-            orig_angle = node_heading (orig, matcher.lattice_best [j].edge_m.l1)
-            orig_id = tags [struct.pack ("<Q", matcher.lattice_best [j].edge_m.l1) + struct.pack ("<Q", orig)]
-            exits, min_angle, min_index = [], None, 0
-
-            for dest in map_con.graph [orig] [1]:
-                way = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]]
-                if dest == matcher.lattice_best [j].edge_m.l1:
-                    if dest != i.edge_m.l2:
-                        continue # Skip previous road
-                    add_marker (orig, {}, "Warning: Loop detected")
-                elif not (exit_filter (way) or dest == i.edge_m.l2):
-                    continue # Use filter to exclude certain exits not leading to the next road
-                elif process_divided and dest != i.edge_m.l2:
-                    if divided_process (1, dest, orig, orig_id = orig_id, orig_angle = orig_angle):
-                        continue
-                    elif divided_process (2, dest, orig):
-                        continue
-                    elif divided_process (4, dest, orig, lattice_index = j):
-                        continue
+                prev = l1 [lattice_index] # Previous path node (may be not an intersection)
+                dest_name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]].get ("name", default_name)
+                orig_name = tags [tags [struct.pack ("<Q", prev) + struct.pack ("<Q", orig)]].get ("name", default_name)
+                path_name = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", path_dest)]].get ("name", default_name)
+                if process_divided ["same_name"] and (orig_name != dest_name or orig_name != path_name): # Two sides of the divided road have different names
+                    return False
 
-                angle = (node_heading (dest, orig) - orig_angle) % 360
-                if angle > 180:
-                    angle -= 360 # Normalize angle to (-180, 180]
-                if dest == i.edge_m.l2:
-                    exit_angle = angle # Save exit angle for next segment
-                    exit_name = way.get ("name", default_name)
-                    if not follow_link is False:
-                        followed_name = link_follow (j + 1, way)
-                if orig_id == tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]:
-                    min_angle = angle # The same road is always treated as forward
-                exits.append ((angle, way))
-                last_dest = dest
-
-            if len (exits) == 0:
-                print (f"Warning: No exits found at node {orig}")
-                continue # Skip if no exits
-            elif len (exits) == 1:
-                dirs = None
-                if last_name != exit_name: # Road name change
-                    dirs = (j + 1, orig, exit_name, "", "", "", "")
-                    last_name = exit_name
-                name = divided_process (3, last_dest, orig)
-                if process_divided and name:
-                    if exits [0] [0] > forward_angle: # T-junction right
-                        dirs = (j + 1, orig, last_name, "", "", name, "right")
+                exits = []
+                for i in map_con.graph [dest] [1]:
+                    if i == orig:
+                        return False # dest is a two-way road
+                    way = tags [tags [struct.pack ("<Q", dest) + struct.pack ("<Q", i)]]
+                    if not process_divided ["apply_filter"] or exit_filter (way):
+                        exits.append (i)
+                if len (exits) > 1: # dest -> dest2 not a one-way road with no intersections 
+                    return False
+                dest2 = exits [0] # Next path node after dest (may be not an intersection)
+
+                for i in reversed (run_start [ : path.run_of (lattice_index) + 1]):
+                    if l2 [i] == prev:
+                        break
+                prev2 = l1 [i] # Second previous path node
+                if prev2 == orig: # U-turn at prev
+                    return False
+            
+                exits = []
+                for i in map_con.graph [prev] [1]:
+                    if i == prev2:
+                        return False # prev is a two-way road
+                    way = tags [tags [struct.pack ("<Q", prev) + struct.pack ("<Q", i)]]
+                    if not process_divided ["apply_filter"] or exit_filter (way):
+                        exits.append (i)
+                if len (exits) > 1: # prev -> orig not a one-way road with no intersections
+                    return False
+                elif exits != [orig]: # Should not reach here
+                    print (f"process_divided (4): Only exit from prev {prev} is not orig {orig}. Please report this error.")
+                    return False
+
+                prev_angle = node_heading (prev, prev2)
+                dest_angle = (node_heading (dest2, dest) - prev_angle) % 360
+                angle_diff = abs (180 - dest_angle) # Angle difference between two sides of the divided road
+                if angle_diff > process_divided ["angle"]: # TODO: choose a more appropriate angle threshold
+                    pass # return False
+
+                dist = node_distance (prev, dest)
+                dist2 = node_distance (prev2, dest2)
+                if dist > process_divided ["length"] and dist2 > process_divided ["length"]:
+                    # Sample two node distances, not a divided road if both are too far
+                    # May need a more sophisticated method to determine divided road (e.g. linear algebra)
+                    return False 
+
+                print (f"process_divided (4): Ignoring {dest_name} {orig} -> {dest} with angle {angle_diff:.4f} and distance {dist:.4f} {dist2:.4f}")
+                add_marker (orig, {"Name": dest_name, "Angle": angle_diff, "Distance": dist, "Distance2": dist2}, "process_divided (4)")
+                return True
+
+            raise NotImplementedError (f"Divided road processing for case {case} not implemented.")
+        link_until = (None, -1) # (name, last index of link road)
+        def link_follow (index, way): # Return the name of the destination road
+            nonlocal tags, default_name, link_until, follow_link, add_marker
+            if index <= link_until [1]:
+                return link_until [0]
+
+            way = way.copy () # Avoid modifying the original
+            if way.get ("highway").endswith ("_link") and not way.get ("name"): # Link road without name
+                for k in run_start [path.run_of (index) + 1 : ]: # Start from next edge
+                    dest = tags [tags [struct.pack ("<Q", l1 [k]) + struct.pack ("<Q", l2 [k])]]
+                    if not dest.get ("highway").endswith ("_link"):
+                        link_until = (follow_link.replace ("%n", dest.get ("name", default_name)), k - 1)
+                        print (f"follow_link: Followed link {l1 [index]} -> {l1 [k]} to {dest.get ('name', default_name)}")
+                        add_marker (l1 [index], {"Destination": dest.get ("name", default_name)}, "follow_link")
+                        return link_until [0]
+            return way.get ("name", default_name)
+
+        for j in run_start [1 : ]:
+            j -= 1 # Last entry before the edge changes
+            orig = l1 [j + 1]
+            if orig == l2 [j]:
+                dirs = ["", "", ""] # [left, forward, right]
+                orig_angle = node_heading (orig, l1 [j])
+                orig_id = tags [struct.pack ("<Q", l1 [j]) + struct.pack ("<Q", orig)]
+                exits, min_angle, min_index = [], None, 0
+
+                for dest in map_con.graph [orig] [1]:
+                    way = tags [tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]]
+                    if dest == l1 [j]:
+                        if dest != l2 [j + 1]:
+                            continue # Skip previous road
+                        add_marker (orig, {}, "Warning: Loop detected")
+                    elif not (exit_filter (way) or dest == l2 [j + 1]):
+                        continue # Use filter to exclude certain exits not leading to the next road
+                    elif process_divided and dest != l2 [j + 1]:
+                        if divided_process (1, dest, orig, orig_id = orig_id, orig_angle = orig_angle):
+                            continue
+                        elif divided_process (2, dest, orig):
+                            continue
+                        elif divided_process (4, dest, orig, lattice_index = j):
+                            continue
+
+                    angle = (node_heading (dest, orig) - orig_angle) % 360
+                    if angle > 180:
+                        angle -= 360 # Normalize angle to (-180, 180]
+                    if dest == l2 [j + 1]:
+                        exit_angle = angle # Save exit angle for next segment
+                        exit_name = way.get ("name", default_name)
+                        if not follow_link is False:
+                            followed_name = link_follow (j + 1, way)
+                    if orig_id == tags [struct.pack ("<Q", orig) + struct.pack ("<Q", dest)]:
+                        min_angle = angle # The same road is always treated as forward
+                    exits.append ((angle, way))
+                    last_dest = dest
+
+                if len (exits) == 0:
+                    print (f"Warning: No exits found at node {orig}")
+                    continue # Skip if no exits
+                elif len (exits) == 1:
+                    dirs = None
+                    if last_name != exit_name: # Road name change
+                        dirs = (j + 1, orig, exit_name, "", "", "", "")
+                        last_name = exit_name
+                    name = divided_process (3, last_dest, orig)
+                    if process_divided and name:
+                        if exits [0] [0] > forward_angle: # T-junction right
+                            dirs = (j + 1, orig, last_name, "", "", name, "right")
+                            exit_dir = "right"
+                        elif exits [0] [0] < -forward_angle: # T-junction left
+                            dirs = (j + 1, orig, last_name, name, "", "", "left")
+                            exit_dir = "left"
+                        else:
+                            name = False # No need to indicate straight exit
+                    if dirs:
+                        directions.append (dirs)
+                        if name: # Indicate process_divided (3) result
+                            add_marker (orig, {"Current": last_name, "Left": dirs [3], "Forward": dirs [4], "Right": dirs [5], "Exit": exit_dir}, "Intersection", gpx_index = obs [j + 1])
+                    continue
+                last_name = exit_name
+                if not follow_link is False:
+                    exit_name = followed_name
+                exits = {k: v for k, v in sorted (exits, key = lambda x: x [0])} # Keep sorted order in dict
+
+                if not min_angle:
+                    min_angle = min (exits.keys (), key = abs) # Minimum angle (slightest turn/straight)
+                if min_angle == exit_angle: # Check if forward direction is the exit
+                    if min_angle > forward_angle: # T-junction right
+                        dirs [2] = exit_name
                         exit_dir = "right"
-                    elif exits [0] [0] < -forward_angle: # T-junction left
-                        dirs = (j + 1, orig, last_name, name, "", "", "left")
+                    elif min_angle < -forward_angle: # T-junction left
+                        dirs [0] = exit_name
                         exit_dir = "left"
+                    else: # Straight
+                        dirs [1] = exit_name
+                        exit_dir = "forward"
+                elif min_angle > exit_angle: # Left turn
+                    dirs [0] = exit_name
+                    if min_angle > forward_angle: # T-junction
+                        min_index = -1 # Include min_angle exit in dir_calc
                     else:
-                        name = False # No need to indicate straight exit
-                if dirs:
-                    directions.append (dirs)
-                    if name: # Indicate process_divided (3) result
-                        add_marker (orig, {"Current": last_name, "Left": dirs [3], "Forward": dirs [4], "Right": dirs [5], "Exit": exit_dir}, "Intersection", gpx_index = i.obs)
-                continue
-            last_name = exit_name
-            if not follow_link is False:
-                exit_name = followed_name
-            exits = {k: v for k, v in sorted (exits, key = lambda x: x [0])} # Keep sorted order in dict
-
-            if not min_angle:
-                min_angle = min (exits.keys (), key = abs) # Minimum angle (slightest turn/straight)
-            if min_angle == exit_angle: # Check if forward direction is the exit
-                if min_angle > forward_angle: # T-junction right
+                        dirs [1] = exits [min_angle].get ("name", default_name)
+                    exit_dir = "left"
+                else: # Right turn
                     dirs [2] = exit_name
+                    if min_angle < -forward_angle: # T-junction
+                        min_index = 1 # Include min_angle exit in dir_calc
+                    else:
+                        dirs [1] = exits [min_angle].get ("name", default_name)
                     exit_dir = "right"
-                elif min_angle < -forward_angle: # T-junction left
-                    dirs [0] = exit_name
-                    exit_dir = "left"
-                else: # Straight
-                    dirs [1] = exit_name
-                    exit_dir = "forward"
-            elif min_angle > exit_angle: # Left turn
-                dirs [0] = exit_name
-                if min_angle > forward_angle: # T-junction
-                    min_index = -1 # Include min_angle exit in dir_calc
-                else:
-                    dirs [1] = exits [min_angle].get ("name", default_name)
-                exit_dir = "left"
-            else: # Right turn
-                dirs [2] = exit_name
-                if min_angle < -forward_angle: # T-junction
-                    min_index = 1 # Include min_angle exit in dir_calc
-                else:
-                    dirs [1] = exits [min_angle].get ("name", default_name)
-                exit_dir = "right"
-
-            min_index += tuple (exits.keys ()).index (min_angle) # Index of minimum angle
-            dir_calc = ((0, -90, tuple (exits.items ()) [ : min_index]), # left
-                        (2, 90, tuple (exits.items ()) [min_index + 1 : ])) # right
-
-            for index, target, exits in dir_calc:
-                if dirs [index] or not exits:
-                    continue # Skip if already set or no ways left
-                max_pri = -1
-                for angle, way in exits:
-                    pri = hw_priority.get (way ["highway"], 0)
-                    angle_diff = abs (angle - target)
-                    if pri > max_pri:
-                        candidate = (way, angle_diff)
-                        max_pri = pri
-                    elif pri == max_pri and angle_diff < candidate [1]:
-                        candidate = (way, angle_diff)
-                dirs [index] = candidate [0].get ("name", default_name)
-            # [gpx index, intersection node, current name, left name, forward name, right name, exit direction]
-            directions.append ((j + 1, orig, last_name, dirs [0], dirs [1], dirs [2], exit_dir))
-            add_marker (orig, {"Current": last_name, "Left": dirs [0], "Forward": dirs [1], "Right": dirs [2], "Exit": exit_dir}, "Intersection", gpx_index = i.obs)
-
-    directions = [tuple ((matcher.lattice_best [i [0]].obs, ) + i [1 : ]) for i in directions] # # Use gpx index instead of lattice index (which can contain non-emitting states)
-
-    return directions, matcher.lattice_best, map_con, visualizer if visualize else None
+
+                min_index += tuple (exits.keys ()).index (min_angle) # Index of minimum angle
+                dir_calc = ((0, -90, tuple (exits.items ()) [ : min_index]), # left
+                            (2, 90, tuple (exits.items ()) [min_index + 1 : ])) # right
+
+                for index, target, exits in dir_calc:
+                    if dirs [index] or not exits:
+                        continue # Skip if already set or no ways left
+                    max_pri = -1
+                    for angle, way in exits:
+                        pri = hw_priority.get (way ["highway"], 0)
+                        angle_diff = abs (angle - target)
+                        if pri > max_pri:
+                            candidate = (way, angle_diff)
+                            max_pri = pri
+                        elif pri == max_pri and angle_diff < candidate [1]:
+                            candidate = (way, angle_diff)
+                    dirs [index] = candidate [0].get ("name", default_name)
+                # [gpx index, intersection node, current name, left name, forward name, right name, exit direction]
+                directions.append ((j + 1, orig, last_name, dirs [0], dirs [1], dirs [2], exit_dir))
+                add_marker (orig, {"Current": last_name, "Left": dirs [0], "Forward": dirs [1], "Right": dirs [2], "Exit": exit_dir}, "Intersection", gpx_index = obs [j + 1])
+
+        directions = [tuple ((obs [i [0]], ) + i [1 : ]) for i in directions] # # Use gpx index instead of lattice index (which can contain non-emitting states)
+    profiler.set ("Nodes analysed", len (run_start) - 1)
+    profiler.set ("Intersections", len (directions) - 1)
+
+    if cache_path:
+        nodes = {i: map_con.graph [i] [0] for i in path.nodes ().tolist ()}
+        with open (cache_path, "wb") as f, profiler.phase ("Save match cache"):
+            pickle.dump ({
+                "key": cache_key,
+                "directions": directions,
+                "path": (path.l1, path.l2, path.obs, path.emitting),
+                "nodes": nodes,
+                "markers": markers
+            }, f)
+        print (f"Saved match cache to {cache_path}")
+
+    return directions, path, map_con, visualizer if visualize else None
+
+# tpov.* fields of each GPX point stored by column, with range assignment for the display functions
+# Text fields are index arrays into a table of their distinct values, number fields are float arrays (NaN is written as 0)
+# Iterating yields a dict of field strings for each point, in the order the fields were added
+class DisplayFields:
+    def __init__ (self, length):
+        self.length = length
+        self.tables, self.lookup, self.columns = {}, {}, {}
+
+    def add (self, key, default): # Add a text field with a default value for all points
+        self.tables [key], self.lookup [key] = [default], {default: 0}
+        self.columns [key] = np.zeros (self.length, dtype = np.int32)
+
+    def add_number (self, key):
+        self.columns [key] = np.full (self.length, np.nan)
+
+    def set (self, start, stop, key, value): # Set a text field for points start to stop (exclusive)
+        index = self.lookup [key].get (value)
+        if index is None:
+            index = self.lookup [key] [value] = len (self.tables [key])
+            self.tables [key].append (value)
+        self.columns [key] [max (0, start) : max (0, min (stop, self.length))] = index
+
+    def set_numbers (self, start, stop, key, values): # Set a number field for points start to stop (exclusive) from an array
+        self.columns [key] [start : stop] = values
+
+    def column (self, key, start = 0, stop = None): # Strings of a field for points start to stop
+        if key in self.tables:
+            table = self.tables [key]
+            return [table [i] for i in self.columns [key] [start : stop].tolist ()]
+        return ["0" if i != i else str (i) for i in self.columns [key] [start : stop].tolist ()]
+
+    def __len__ (self):
+        return self.length
+
+    def __iter__ (self):
+        keys = list (self.columns)
+        for start in range (0, self.length, 1 << 16): # Expand to strings in chunks
+            for i in zip (*(self.column (k, start, start + (1 << 16)) for k in keys)):
+                yield dict (zip (keys, i))
 
 def SimpleTextDisplay (
-        gpx,
+        track,
         dirs,
         params,
         stop_indices = [],
@@ -648,13 +1006,9 @@ def SimpleTextDisplay (
         "tpov.right_exit": "\u200c",
         "tpov.inter_dash": "0"
     }
-    fields, metadata = None, {}
+    fields, metadata = DisplayFields (len (track)), {}
     stop_data = stop_data.copy () # Do not modify original data
-
-    def range_set (start, stop, key, value):
-        nonlocal fields, gpx
-        for i in range (max (0, start), min (stop, len (gpx))):
-            fields [i] [key] = value
+    range_set = fields.set
 
     if stop_indices and stop_data:
         field.update ({
@@ -662,7 +1016,11 @@ def SimpleTextDisplay (
             "tpov.next_stop": "\u200c",
             "tpov.transfers": "\u200c"
         })
-        fields = tuple ((field.copy () for _ in gpx))
+    for k, v in field.items ():
+        fields.add (k, v)
+
+    if stop_indices and stop_data:
+        fields.add_number ("tpov.stop_bar")
         stops = stop_data.pop ("__stops__")
         metadata.update ({f"tpov.{k}": v for k, v in stop_data.items ()})
         for j, i in enumerate (stops):
@@ -675,7 +1033,7 @@ def SimpleTextDisplay (
         stop_indices = [i + 1 for i in stop_indices] # Use the first point after the stop
         # Using references in the gpx allows for easier editing but slower processing
         reference = lambda string: string if params ["use_reference"] else metadata [string]
-        for k, (j, i) in enumerate (zip ([0] + stop_indices, stop_indices + [len (gpx)])):
+        for k, (j, i) in enumerate (zip ([0] + stop_indices, stop_indices + [len (track)])):
             if 0 <= k - 1 < len (stops):
                 range_set (j, i, "tpov.prev_stop", reference (f"tpov.stop.{k - 1}"))
             else:
@@ -686,46 +1044,43 @@ def SimpleTextDisplay (
             else:
                 range_set (j, i, "tpov.next_stop", "\u200c")
                 range_set (j, i, "tpov.transfers", "\u200c")
-            
-            if i == j + 1: # Single point between stops
-                fields [j] ["tpov.stop_bar"] = "0" # No stop bar
-            elif params ["bar_reverse"]:
-                for m in range (j, i):
-                    fields [m] ["tpov.stop_bar"] = str ((i - 1 - m) / (i - 1 - j))
-            else:
-                for m in range (j, i):
-                    fields [m] ["tpov.stop_bar"] = str ((m - j) / (i - 1 - j))
-    else:
-        fields = tuple ((field.copy () for _ in range (len (gpx))))
+
+            if i == j + 1: # Single point between stops, no stop bar (NaN is written as 0)
+                fields.set_numbers (j, i, "tpov.stop_bar", np.nan)
+            elif i > j:
+                progress = np.arange (j, i) - j if not params ["bar_reverse"] else i - 1 - np.arange (j, i)
+                fields.set_numbers (j, i, "tpov.stop_bar", progress / (i - 1 - j))
+
+    # Intersections are displayed for `duration_s` seconds before reaching them, the first point of each window is found with a binary search on the times
+    elapsed = track.search_times ()
+    duration = round (params ["duration_s"] * 1e6) # Microseconds
 
     for j, i in enumerate (dirs):
         # Set current road name for all points in the segment
-        range_set (i [0], dirs [j + 1] [0] if j + 1 < len (dirs) else len (gpx), "tpov.current", i [2])
+        range_set (i [0], dirs [j + 1] [0] if j + 1 < len (dirs) else len (track), "tpov.current", i [2])
         if i [6]: # Intersection
+            start = int (np.searchsorted (elapsed, elapsed [i [0]] - duration, side = "left"))
             for k, l in zip (("left", "forward", "right"), i [3 : 6]):
                 if k == i [6]:
-                    range_set (i [0] - params ["duration"], i [0], f"tpov.{k}_exit", l)
-                    range_set (i [0] - params ["duration"], i [0], f"tpov.{k}", "\u200c") # Clear non-exit
+                    range_set (start, i [0], f"tpov.{k}_exit", l)
+                    range_set (start, i [0], f"tpov.{k}", "\u200c") # Clear non-exit
                 elif l: # Allow for close intersection exits to overlap (useful for dual carriageways)
-                    range_set (i [0] - params ["duration"], i [0], f"tpov.{k}", l)
-                    range_set (i [0] - params ["duration"], i [0], f"tpov.{k}_exit", "\u200c") # Clear exit
+                    range_set (start, i [0], f"tpov.{k}", l)
+                    range_set (start, i [0], f"tpov.{k}_exit", "\u200c") # Clear exit
                 else:
                     # Only show the most recent exit for close intersections
-                    range_set (i [0] - params ["duration"], i [0], f"tpov.{k}_exit", "\u200c")
-                range_set (i [0] - params ["duration"], i [0], "tpov.inter_dash", "1") # Display transparent overlay
+                    range_set (start, i [0], f"tpov.{k}_exit", "\u200c")
+                range_set (start, i [0], "tpov.inter_dash", "1") # Display transparent overlay
 
     return metadata, fields
 
-def NaiveStopMatcher (gpx_path, stop_data, lattice_best = None, map_con = None):
+def NaiveStopMatcher (track, stop_data, path = None, map_con = None, params = {}):
     # This is a naive implementation that matches stops to the nearest point in the GPX file
     # It is known to fail with lines which visit geographically close stops multiple times.
     # A better implementation would be to use a map-matching algorithm on the stop data.
-    # That is why lattice_best and map_con are included as arguments, but they are not used in this function.
-
-    with open (gpx_path, "r") as f:
-        gpx = gpxpy.parse (f)
-        points = tuple (gpx.walk (True))
+    # That is why path (MatchedPath) and map_con are included as arguments, but they are not used in this function, neither is params (stop_params).
 
+    points = track.points
     indices = [
         min (range (len (points)),
         key = lambda x: points [x].distance_2d (gpxpy.geo.Location (float (i ["stop_lat"]), float (i ["stop_lon"])))) 
@@ -738,68 +1093,196 @@ def NaiveStopMatcher (gpx_path, stop_data, lattice_best = None, map_con = None):
     print (f"NaiveStopMatcher: Matched {len (indices)} stops successfully.")
     return indices
 
-def gpx_snap (gpx, map_con, lattice_best, distance):
+# Closest point of each pass of the track within `radius` metres of a stop (or twice its closest distance if further)
+# dist is the distance of each point from the stop
+def closest_passes (dist, radius):
+    near = np.concatenate (([False], dist <= max (radius, 2 * dist.min ()), [False]))
+    starts, ends = np.flatnonzero (near [1 : ] & ~near [ : -1]), np.flatnonzero (near [ : -1] & ~near [1 : ]) # Runs of nearby points
+    return np.array ([j + int (dist [j : k].argmin ()) for j, k in zip (starts.tolist (), ends.tolist ())], dtype = np.int64)
+
+# Scheduled time of a stop in seconds after midnight (GTFS times can be after 24:00:00), NaN if unknown
+def schedule_seconds (stop):
+    for i in ("departure_time", "startTime", "arrival_time", "arriveTime"):
+        try:
+            h, m, s = (int (j) for j in str (stop [i]).split (":"))
+            return h * 3600 + m * 60 + s
+        except (KeyError, ValueError):
+            continue
+    return np.nan
+
+def OrderedStopMatcher (track, stop_data, path = None, map_con = None, params = {}):
+    # This matcher matches stops in order, which also works on routes passing the same place several times (e.g. loops).
+    # Each time the track passes within `radius` metres of a stop (or twice its closest distance if further) is a candidate,
+    # matched at its closest point. The candidates of all stops are chosen in increasing order with the smallest total distance.
+    # path and map_con are not used.
+
+    radius = params.get ("radius", 100)
+    candidates = [] # (point indices, distances) of each stop, in track order
+    for i in tqdm (stop_data ["__stops__"], desc = "OrderedStopMatcher: Finding candidates"):
+        dist = distance_2d (track.lat, track.lon, float (i ["stop_lat"]), float (i ["stop_lon"]))
+        indices = closest_passes (dist, radius)
+        candidates.append ((indices, dist [indices]))
+
+    if not candidates:
+        return []
+    # Dynamic programming over the candidates, each stop takes the best total of the previous stop at or before its point
+    cost, back = candidates [0] [1], []
+    for (prev, _), (indices, dist) in zip (candidates, candidates [1 : ]):
+        best = np.minimum.accumulate (cost) # Best total at or before each previous candidate
+        best_index = np.maximum.accumulate (np.where (cost == best, np.arange (len (cost)), 0))
+        before = np.searchsorted (prev, indices, side = "right") - 1 # Last previous candidate at or before each candidate
+        cost = np.where (before >= 0, best [before] + dist, np.inf)
+        back.append (best_index [before])
+
+    if not np.isfinite (cost).any ():
+        nearest = [int (j [np.argmin (k)]) for j, k in candidates]
+        if nearest == sorted (nearest, reverse = True):
+            raise SystemExit ("OrderedStopMatcher: OrderedStopMatcher failed to match stops. You likely extracted stop data for the other direction of travel.")
+        raise SystemExit ("OrderedStopMatcher failed to match stops. Try using a different stop matcher.")
+    choice = [int (np.argmin (cost))]
+    for i in reversed (back):
+        choice.append (int (i [choice [-1]]))
+    indices = [int (j [0] [k]) for j, k in zip (candidates, reversed (choice))]
+    print (f"OrderedStopMatcher: Matched {len (indices)} stops successfully.")
+    return indices
+
+# Node coordinates (lat1, lon1, lat2, lon2) of the segments of a matched path, which are its distinct edges (runs)
+def path_segments (map_con, path):
+    lat1, lon1 = np.array ([map_con.graph [i] [0] for i in path.l1 [path.run_start].tolist ()]).reshape (-1, 2).T
+    lat2, lon2 = np.array ([map_con.graph [i] [0] for i in path.l2 [path.run_start].tolist ()]).reshape (-1, 2).T
+    return lat1, lon1, lat2, lon2
+
+# Project points onto segments, arrays are broadcast against each other
+# Returns the closest points on the segments (lat, lon) and their position along the segments (0 to 1)
+# References: https://stackoverflow.com/a/6853926
+def project (lat, lon, y1, x1, y2, x2):
+    scale = np.cos (np.radians (y2)) # Latitude correction (assume spherical Earth)
+    y, y1, y2 = lat * scale, y1 * scale, y2 * scale
+    a, b, c, d = lon - x1, y - y1, x2 - x1, y2 - y1
+    dot, len_sq = a * c + b * d, c * c + d * d
+    with np.errstate (divide = "ignore", invalid = "ignore"):
+        param = np.where (len_sq == 0, -1, dot / len_sq) # Use (x1, y1) as closest point of zero-length segments
+    # Closest point in segment is (x1, y1) if param < 0, (x2, y2) if param > 1, on the segment otherwise
+    xx = np.where (param < 0, x1, np.where (param > 1, x2, x1 + param * c))
+    yy = np.where (param < 0, y1, np.where (param > 1, y2, y1 + param * d)) / scale
+    return yy, xx, np.clip (param, 0, 1)
+
+def ScheduleStopMatcher (track, stop_data, path = None, map_con = None, params = {}):
+    # This matcher uses the scheduled times of the stops (departure_time from GTFS, startTime from 12306) to only search part of the track for each stop.
+    # The first stop is matched to the first time the track passes it. Each following stop is searched from the previous matched point
+    # until twice the scheduled time between the two stops plus `slack` seconds later, and matched to the first pass in this window.
+    # If no point in the window is within `radius` metres of the stop (e.g. the vehicle is late), the rest of the track is searched instead.
+    # path and map_con are not used.
+
+    radius, slack = params.get ("radius", 100), params.get ("slack", 300)
+    stops = stop_data ["__stops__"]
+    if not stops:
+        return []
+    if np.isnat (track.time).all ():
+        raise SystemExit ("ScheduleStopMatcher requires a track with times. Try using a different stop matcher.")
+    schedule = np.array ([schedule_seconds (i) for i in stops], dtype = float)
+    known = np.flatnonzero (~np.isnan (schedule))
+    if not len (known):
+        raise SystemExit ("ScheduleStopMatcher requires stop data with departure times. Try using a different stop matcher.")
+    days = np.concatenate (([0], np.cumsum (np.diff (schedule [known]) < -43200))) # Trips running past midnight (12306)
+    schedule = np.interp (np.arange (len (stops)), known, schedule [known] + 86400 * days) # Fill in missing times
+    times = track.search_times ()
+
+    indices = []
+    for j, i in enumerate (stops):
+        lat, lon = float (i ["stop_lat"]), float (i ["stop_lon"])
+        start = indices [-1] if indices else 0
+        end = len (track) if not indices else int (np.searchsorted (
+            times, times [start] + round ((2 * (schedule [j] - schedule [j - 1]) + slack) * 1e6), side = "right"))
+        end = max (end, start + 1) # The schedule may go backwards with out of order or wrong times
+        dist = distance_2d (track.lat [start : end], track.lon [start : end], lat, lon)
+        if dist.min () > radius and end < len (track): # Not in the window
+            dist = distance_2d (track.lat [start : ], track.lon [start : ], lat, lon)
+        indices.append (start + int (closest_passes (dist, radius) [0]))
+
+    print (f"ScheduleStopMatcher: Matched {len (indices)} stops successfully.")
+    return indices
+
+def PathStopMatcher (track, stop_data, path = None, map_con = None, params = {}):
+    # This matcher projects stops onto the matched path and matches them in order along it, which works on routes passing the same stop several times.
+    # Positions on the path are the distance along it from its start. Each stop is matched to the first time the path passes within
+    # `radius` metres of it (or twice its closest distance if further) after the previous stop, at the closest position of that pass.
+    # Only the segments from the previous stop onward are searched, found with a binary search on the segment end positions.
+    # The GPX point closest to this position is then found with a binary search.
+
+    if path is None or not len (path):
+        raise SystemExit ("PathStopMatcher requires the matched path. Use --map or try using a different stop matcher.")
+    radius = params.get ("radius", 50)
+    y1, x1, y2, x2 = path_segments (map_con, path)
+    seg_len = distance_2d (y1, x1, y2, x2)
+    seg_pos = np.concatenate (([0], np.cumsum (seg_len))) [ : -1] # Position of the start of each segment
+
+    # Position of each matched GPX point, made non-decreasing for the search
+    seg_index = np.repeat (np.arange (len (y1)), path.run_end - path.run_start) [path.emitting]
+    obs = path.obs [path.emitting]
+    _, _, param = project (track.lat [obs], track.lon [obs], y1 [seg_index], x1 [seg_index], y2 [seg_index], x2 [seg_index])
+    obs_pos = np.maximum.accumulate (seg_pos [seg_index] + param * seg_len [seg_index])
+
+    seg_end = seg_pos + seg_len
+    indices, current = [], 0
+    for i in stop_data ["__stops__"]:
+        lat, lon = float (i ["stop_lat"]), float (i ["stop_lon"])
+        start = int (np.searchsorted (seg_end, current)) # Segments ending before the previous stop cannot be ahead of it
+        yy, xx, param = project (lat, lon, y1 [start : ], x1 [start : ], y2 [start : ], x2 [start : ])
+        pos = seg_pos [start : ] + param * seg_len [start : ]
+        ahead = np.where (pos >= current, distance_2d (lat, lon, yy, xx), np.inf)
+        if not np.isfinite (ahead).any ():
+            raise SystemExit ("PathStopMatcher failed to match stops. Try using a different stop matcher.")
+        near = ahead <= max (radius, 2 * ahead.min ())
+        first = int (np.argmax (near))
+        last = first + int (np.argmin (near [first : ])) if not near [first : ].all () else len (near) # End of the first pass
+        current = pos [first + int (np.argmin (ahead [first : last]))]
+        j = int (np.searchsorted (obs_pos, current))
+        if j == len (obs_pos) or (j > 0 and current - obs_pos [j - 1] < obs_pos [j] - current):
+            j -= 1 # Previous point is closer
+        indices.append (int (obs [j]))
+
+    print (f"PathStopMatcher: Matched {len (indices)} stops successfully.")
+    return indices
+
+def gpx_snap (track, map_con, path, distance):
     # This is a simple function which snaps GPX points to the nearest point on the matched path.
     # It tries to snap a point to its matched path segment, and `distance` segments ahead and behind.
     # It chooses the segment which results in the smallest distance between the original and snapped points.
-    # References: https://stackoverflow.com/a/6853926, gpxpy.geo.Location.distance
+    # All points of a chunk are projected onto all segments of their windows at once with NumPy.
+    # References: gpxpy.geo.Location.distance
 
     # TODO: fix sporadic snapping errors where the path suddenly jumps to a different road and back
 
-    def intersection (point, y1, x1, y2, x2): # Returns matched point and distance from original point
-        y, x = point.latitude, point.longitude
-        scale = math.cos (math.radians (y2)) # Latitude correction (assume spherical Earth)
-        y, y1, y2 = y * scale, y1 * scale, y2 * scale
-
-        a, b, c, d = x - x1, y - y1, x2 - x1, y2 - y1
-        dot, len_sq = a * c + b * d, c * c + d * d
-        if len_sq == 0: # Zero-length segment
-            param = -1 # Use (x1, y1) as closest point
-        else:
-            param = dot / len_sq
-
-        if param < 0: # Closest point in segment is (x1, y1)
-            xx, yy = x1, y1 / scale
-        elif param > 1: # Closest point in segment is (x2, y2)
-            xx, yy = x2, y2 / scale
-        else: # Closest point is on the segment
-            xx, yy = x1 + param * c, (y1 + param * d) / scale
-        
-        return yy, xx, gpxpy.geo.Location (yy, xx).distance_2d (point)
-
-    segments, k = [lattice_best [0].edge_m], 1
-    seg_equal = lambda i, j: i.l1 == j.l1 and i.l2 == j.l2
-    def inc_k ():
-        nonlocal k, segments, lattice_best
-        if k >= len (lattice_best):
-            return True
-        if not seg_equal (lattice_best [k].edge_m, segments [-1]):
-            segments.append (lattice_best [k].edge_m)
-        k += 1
-        return False
-
-    while len (segments) < distance + 1:
-        if inc_k ():
-            return # Matched path is too short to snap
-
-    gpx_points = tuple (gpx.walk (True))
-    for i in (m for m in lattice_best if m.is_emitting ()):
-        point = gpx_points [i.obs]
-        while not seg_equal (segments [- distance - 1], i.edge_m):
-            if inc_k ():
-                break
-        while len (segments) > distance * 2 + 1:
-            segments.pop (0)
-        
-        snaps = tuple (intersection (point, *map_con.graph [k.l1] [0], *map_con.graph [k.l2] [0]) for k in segments)
-        point.latitude, point.longitude, _ = min (snaps, key = lambda x: x [2])
+    if len (path.run_start) < distance + 1:
+        return # Matched path is too short to snap
+    seg_y1, seg_x1, seg_y2, seg_x2 = path_segments (map_con, path) # Windows are indices into the segments
+    last_seg = len (seg_y1) - 1
+    seg_index = np.repeat (np.arange (len (seg_y1)), path.run_end - path.run_start) # Segment of each entry
+    obs, seg = path.obs [path.emitting], seg_index [path.emitting]
+
+    for chunk in range (0, len (obs), chunk_size):
+        indices, j = obs [chunk : chunk + chunk_size], seg [chunk : chunk + chunk_size]
+        end = np.minimum (j + distance, last_seg) # Window is `distance` segments behind and ahead, shifted at the ends
+        window = np.maximum (0, end - 2 * distance) [:, None] + np.arange (2 * distance + 1) # Points x segments
+        valid = window <= end [:, None] # Windows are shorter if the path has less than 2 * distance + 1 segments
+        window = np.minimum (window, last_seg)
+        lat, lon = track.lat [indices] [:, None], track.lon [indices] [:, None]
+        yy, xx, _ = project (lat, lon, seg_y1 [window], seg_x1 [window], seg_y2 [window], seg_x2 [window])
+        dist = distance_2d (yy, xx, lat, lon) # Distance from the original point
+        best = np.where (valid, dist, np.inf).argmin (axis = 1)
+        rows = np.arange (len (indices))
+        track.set_points (indices, yy [rows, best], xx [rows, best])
 
 map_matchers = {
     "SimpleMatcher": SimpleMatcher,
     "DistanceMatcher": DistanceMatcher
 }
 stop_matchers = {
-    "NaiveStopMatcher": NaiveStopMatcher
+    "NaiveStopMatcher": NaiveStopMatcher,
+    "OrderedStopMatcher": OrderedStopMatcher,
+    "PathStopMatcher": PathStopMatcher,
+    "ScheduleStopMatcher": ScheduleStopMatcher
 }
 displays = {
     "SimpleTextDisplay": SimpleTextDisplay
@@ -819,11 +1302,25 @@ parser.add_argument ("gpx", help = "Path to .gpx track file")
 parser.add_argument ("--map", metavar = "file", help = "Path to .o5m map file")
 parser.add_argument ("--stop", metavar = "JSON", help = "Path to stop data")
 parser.add_argument ("--start", metavar = "ID", help = "Manually set start way of track")
+parser.add_argument ("--prior", metavar = "file", help = "Match cache (.match.pkl) or stop data with __shape__ of the same route, used to only match in a corridor around it")
+parser.add_argument ("--full-map", action = "store_true", help = "Do not restrict matching to a corridor around the __shape__ of the stop data")
+parser.add_argument ("--delta", action = "store_true", help = "Only write tpov.* fields at points where they change (expand with tpov_expand.py)")
+parser.add_argument ("--rematch", action = "store_true", help = "Ignore the cached match result and match the track again")
+parser.add_argument ("--profile", action = "store_true", help = "Record the time and memory used by each step and save them next to the output (slows down processing)")
+
+# Validate matching parameters against match_schema.json
+def validate_params (params):
+    if "duration" in params.get ("display_params", {}): # Was a number of points, which only equals seconds at 1 Hz
+        raise ValueError ("display_params.duration was renamed to duration_s and is now in seconds instead of points. "
+                          "Divide the old value by the number of points per second of the track.")
+    schema = json.load (open (proj_path ("match_schema.json"), "r"))
+    jsonschema.validate (instance = params, schema = schema)
 
 def main (args):
+    if args.profile:
+        profiler.enable ()
     params = json.load (open (args.params, "r"))
-    schema = json.load (open (proj_path ("match_schema.json"), "r"))
-    jsonschema.validate (instance = params, schema = schema)
+    validate_params (params)
 
     map_matcher = map_matchers [params ["map_matcher"]]
     stop_matcher = stop_matchers [params ["stop_matcher"]]
@@ -836,37 +1333,64 @@ def main (args):
     process_divided = params ["process_divided"]
     hw_priority = params ["hw_priority"]
     matcher_params = params ["matcher_params"]
+    stop_params = params.get ("stop_params", {})
     display_params = params ["display_params"]
     display = displays [display_params ["display"]]
     visualize = params ["visu_params"]
 
+    if args.stop:
+        with open (args.stop, "r") as f:
+            stop_data = json.load (f)
+    else:
+        stop_data = {}
+
+    if args.prior:
+        prior = load_prior (args.prior)
+    elif stop_data.get ("__shape__") and not args.full_map: # Route shape from tpov_extract
+        print (f"Using __shape__ of {args.stop} as the matching corridor (use --full-map to disable)")
+        prior = load_prior (args.stop)
+    else:
+        prior = None
+
+    with profiler.phase ("Load track"):
+        track = Track.load (args.gpx) # Shared by all steps below
+    profiler.set ("Track points", len (track))
     if args.map:
-        dirs, lattice_best, map_con, visualizer = match_gpx (
-            gpx_path = args.gpx,
-            map_path = args.map,
-            start_id = args.start,
-            matcher_cls = map_matcher,
-            use_rtree = use_rtree,
-            exit_filter = exit_filter,
-            default_name = default_name,
-            forward_angle = forward_angle,
-            follow_link = follow_link,
-            process_divided = process_divided,
-            hw_priority = hw_priority,
-            matcher_params = matcher_params,
-            visualize = visualize)
+        with profiler.phase ("match_gpx"):
+            dirs, path, map_con, visualizer = match_gpx (
+                track = track,
+                map_path = args.map,
+                start_id = args.start,
+                matcher_cls = map_matcher,
+                use_rtree = use_rtree,
+                exit_filter = exit_filter,
+                default_name = default_name,
+                forward_angle = forward_angle,
+                follow_link = follow_link,
+                process_divided = process_divided,
+                hw_priority = hw_priority,
+                matcher_params = matcher_params,
+                visualize = visualize,
+                prior = prior,
+                corridor = params.get ("corridor", 150),
+                cache_path = os.path.abspath (args.gpx) + ".match.pkl",
+                # Display, stop and visualization parameters do not affect the match result
+                cache_params = {k: params [k] for k in (
+                    "map_matcher", "use_rtree", "exit_filter", "corridor", "default_name", "forward_angle",
+                    "follow_link", "process_divided", "hw_priority", "matcher_params") if k in params},
+                rematch = args.rematch)
     else:
-        dirs, lattice_best, map_con, visualizer = [], [], None, None
+        dirs, path, map_con, visualizer = [], None, None, None
 
     if args.stop:
-        with open (args.stop, "r") as f:
-            stop_data = json.load (f)
-        stop_indices = stop_matcher (args.gpx, stop_data, lattice_best, map_con)
+        with profiler.phase ("Stop matching"):
+            stop_indices = stop_matcher (track, stop_data, path, map_con, stop_params)
+        profiler.set ("Stops", len (stop_indices))
         if visualizer:
             for i in stop_data ["__stops__"]:
                 visualizer.add_marker (object (), i ["stop_lat"], i ["stop_lon"], f"<b>Matched stop:</b> {i ['stop_name']}")
     else:
-        stop_data, stop_indices = {}, []
+        stop_indices = []
 
     if dirs:
         table = Texttable (max_width = shutil.get_terminal_size ().columns)
@@ -880,16 +1404,19 @@ def main (args):
     gpx_out = os.path.abspath (os.path.splitext (args.gpx) [0] + ".matched.gpx")
     if input (f"Write stop and intersection data to {gpx_out} (Y/n)? ").lower () != "y":
         raise SystemExit ("Write cancelled.")
-    with open (args.gpx, "r") as f:
-        gpx = gpxpy.parse (f)
-
-    metadata, fields = display (
-        gpx = tuple (gpx.walk (True)),
-        dirs = dirs,
-        params = display_params,
-        stop_indices = stop_indices,
-        stop_data = stop_data
-    )
+    with profiler.phase ("Parse document"):
+        gpx = track.document ()
+
+    with profiler.phase ("Display"):
+        metadata, fields = display (
+            track = track,
+            dirs = dirs,
+            params = display_params,
+            stop_indices = stop_indices,
+            stop_data = stop_data
+        )
+    if args.delta:
+        metadata ["tpov.__encoding__"] = "delta" # Read by tpov_expand.py
     if not gpx.name:
         gpx.name = "tpov" # gpxpy does not write extensions without a normal tag
 
@@ -897,30 +1424,28 @@ def main (args):
         for i in stop_data ["__stops__"]:
             gpx.waypoints.append (gpxpy.gpx.GPXWaypoint (latitude = i ["stop_lat"], longitude = i ["stop_lon"], name = i ["stop_name"]))
     if (not snap_gpx is False) and args.map: # Snap GPX points to the matched path
-        gpx_snap (gpx, map_con, lattice_best, snap_gpx)
+        with profiler.phase ("Snap"):
+            gpx_snap (track, map_con, path, snap_gpx)
             
     for k, v in metadata.items ():
         ext = etree.Element (k)
         ext.text = str (v)
         gpx.metadata_extensions.append (ext)
-    for i, j in zip (gpx.walk (True), fields):
-        for k, v in j.items ():
-            ext = etree.Element (k)
-            ext.text = v
-            i.extensions.append (ext)
-
-    with open (gpx_out, "w") as f:
-        f.write (gpx.to_xml (version = "1.1"))
-        print ("Saved data to", gpx_out)
+    with profiler.phase ("Write GPX"):
+        track.write (gpx_out, gpx, fields, delta = args.delta)
+    print ("Saved data to", gpx_out)
     
     if visualizer:
-        fp = next (gpx.walk (True))
-        visualizer.add_marker (object (), fp.latitude, fp.longitude, f"<b>Origin</b><br>Latitude: {fp.latitude}<br>Longitude: {fp.longitude}")
-        for i in gpx.walk (True):
-            lp = i
-            visualizer.add_point (i.latitude, i.longitude)
-        visualizer.add_marker (object (), lp.latitude, lp.longitude, f"<b>Destination</b><br>Latitude: {lp.latitude}<br>Longitude: {lp.longitude}")
-        visualizer.write ()
+        with profiler.phase ("Visualization"):
+            lat, lon = track.lat [[0, -1]].tolist (), track.lon [[0, -1]].tolist () # Origin and destination
+            visualizer.add_marker (object (), lat [0], lon [0], f"<b>Origin</b><br>Latitude: {lat [0]}<br>Longitude: {lon [0]}")
+            visualizer.add_points (track.lat, track.lon)
+            visualizer.add_marker (object (), lat [-1], lon [-1], f"<b>Destination</b><br>Latitude: {lat [-1]}<br>Longitude: {lon [-1]}")
+            visualizer.write ()
+
+    if args.profile:
+        print (profiler.table ())
+        profiler.save (os.path.splitext (gpx_out) [0] + ".profile.json")
 
 def script (args):
     import shlex
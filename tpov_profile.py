@@ -0,0 +1,124 @@
+# This file contains functions used by other programs. It should not be run directly.
+
+# Built-in modules
+import os, json, time, tracemalloc, shutil, contextlib
+try:
+    import resource # Not available on Windows
+except ImportError:
+    resource = None
+
+# Third-party modules
+from texttable import Texttable
+
+# Records the wall time, CPU time and memory of named phases of a program, and counters such as the number of items processed
+# Phases can be nested, a phase includes the time and memory of the phases inside it
+# Phases can be saved as a summary (save) or as Chrome trace events to view them on a timeline (save_trace)
+# Does nothing until enabled, so that calls can be left in the code
+class Profiler:
+    def __init__ (self):
+        self.enabled, self.memory = False, False
+        self.phases, self.counters, self.stack = [], {}, []
+        self.origin = time.perf_counter ()
+
+    def enable (self, memory = True):
+        self.enabled = True
+        if memory and not self.memory:
+            self.memory = True
+            tracemalloc.start () # Slows down allocations, only times relative to each other are meaningful
+
+    def start (self, name, category = "phase", **args): # Start a phase, must be followed by stop. args are saved with the phase
+        if not self.enabled:
+            return
+        phase = {"name": name, "category": category, "depth": len (self.stack), "start": 0, "wall": 0, "cpu": 0}
+        if self.memory:
+            if self.stack: # Keep the peak of the enclosing phase before resetting it for this phase
+                self.stack [-1] ["peak"] = max (self.stack [-1] ["peak"], tracemalloc.get_traced_memory () [1])
+            tracemalloc.reset_peak ()
+            phase ["peak"], phase ["memory"] = 0, tracemalloc.get_traced_memory () [0]
+        phase ["args"] = args
+        self.phases.append (phase)
+        self.stack.append (phase)
+        phase ["cpu"], phase ["wall"] = time.process_time (), time.perf_counter ()
+        phase ["start"] = phase ["wall"] - self.origin
+
+    def stop (self): # Stop the last started phase
+        if not self.enabled:
+            return
+        wall, cpu = time.perf_counter (), time.process_time ()
+        phase = self.stack.pop ()
+        phase ["wall"], phase ["cpu"] = wall - phase ["wall"], cpu - phase ["cpu"]
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory ()
+            phase ["peak"] = max (phase ["peak"], peak) # Peak of memory allocated by Python (bytes)
+            phase ["memory"] = current - phase ["memory"] # Memory still allocated at the end of the phase (bytes)
+            if self.stack:
+                self.stack [-1] ["peak"] = max (self.stack [-1] ["peak"], phase ["peak"])
+            tracemalloc.reset_peak ()
+        if resource:
+            phase ["max_rss"] = resource.getrusage (resource.RUSAGE_SELF).ru_maxrss # Peak RSS of the process so far
+
+    @contextlib.contextmanager
+    def phase (self, name, category = "phase", **args):
+        self.start (name, category, **args)
+        try:
+            yield
+        finally:
+            self.stop ()
+
+    def count (self, name, value = 1): # Add to a counter
+        if self.enabled:
+            self.counters [name] = self.counters.get (name, 0) + value
+
+    def set (self, name, value): # Set a counter
+        if self.enabled:
+            self.counters [name] = value
+
+    def report (self):
+        return {"phases": self.phases, "counters": self.counters}
+
+    def save (self, path):
+        with open (path, "w") as f:
+            json.dump (self.report (), f, indent = 2)
+        print ("Saved profile to", path)
+
+    # Phases as complete events in the Chrome trace event format, which can be opened in chrome://tracing or https://ui.perfetto.dev
+    # References: https://docs.google.com/document/d/1CvAClvFfyA5R-PhYUmn5OOQtYMH4h6I0nSsKchNAySU
+    def trace (self):
+        pid = os.getpid ()
+        events = [{"name": "process_name", "ph": "M", "pid": pid, "tid": 0, "args": {"name": "tpov"}}]
+        for i in self.phases:
+            args = {k: v for k, v in i.items () if k in ("cpu", "peak", "memory", "max_rss")}
+            events.append ({"name": i ["name"], "cat": i ["category"], "ph": "X", "ts": round (i ["start"] * 1e6), "dur": round (i ["wall"] * 1e6),
+                            "pid": pid, "tid": 0, "args": {**i ["args"], **args}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"counters": self.counters}}
+
+    def save_trace (self, path):
+        while self.stack: # Phases left running by an error end now
+            self.stop ()
+        with open (path, "w") as f:
+            json.dump (self.trace (), f)
+        print ("Saved trace to", path)
+
+    def table (self):
+        table = Texttable (max_width = shutil.get_terminal_size ().columns)
+        table.set_deco (Texttable.HEADER)
+        table.set_cols_align (["l", "r", "r", "r", "r"])
+        table.set_cols_dtype (["t", "t", "t", "t", "t"])
+        table.header (["Phase", "Wall (s)", "CPU (s)", "Peak (MB)", "Retained (MB)"])
+        for i in self.phases:
+            table.add_row (["  " * i ["depth"] + i ["name"], f"{i ['wall']:.3f}", f"{i ['cpu']:.3f}",
+                            f"{i ['peak'] / 1e6:.1f}" if "peak" in i else "", f"{i ['memory'] / 1e6:.1f}" if "memory" in i else ""])
+        result = table.draw ()
+        if self.counters:
+            counters = Texttable (max_width = shutil.get_terminal_size ().columns)
+            counters.set_deco (Texttable.HEADER)
+            counters.set_cols_dtype (["t", "t"])
+            counters.header (["Counter", "Value"])
+            counters.add_rows ([[k, str (v)] for k, v in self.counters.items ()], header = False)
+            result += "\n\n" + counters.draw ()
+        return result
+
+profiler = Profiler () # Shared by all modules of a program
+
+if __name__ == "__main__":
+    raise SystemExit ("This file contains functions used by other programs. It should not be run directly.")
@@ -0,0 +1,143 @@
+# Built-in modules
+import os, json, argparse, itertools, multiprocessing, shutil, time, tracemalloc
+
+# Third-party modules
+import numpy as np
+from texttable import Texttable
+
+from tpov_functions import *
+from tpov_gpx import Track
+from tpov_match import map_matchers, validate_params, MatchedPath, find_map, load_map, load_prior, CorridorArea, corridor_nodes, sub_map
+
+# Shared with the workers, which are forked after the map is loaded so it is only loaded once
+map_con, points, base_params, trace_memory = None, None, None, True
+
+# Parameter sets from a grid file, either a list of sets or an object of parameter names and lists of values to combine
+def grid_sets (grid):
+    if isinstance (grid, list):
+        return [dict (i) for i in grid]
+    if not isinstance (grid, dict) or not all (isinstance (i, list) and i for i in grid.values ()):
+        raise ValueError ("Parameter grid must be a list of parameter sets or an object with non-empty lists of values")
+    return [dict (zip (grid.keys (), i)) for i in itertools.product (*grid.values ())]
+
+# Length of the matched path in metres
+def path_length (map_con, path):
+    if not len (path):
+        return 0
+    coords = np.array ([(map_con.graph [i] [0], map_con.graph [j] [0]) for i, j in zip (path.l1 [path.run_start].tolist (), path.l2 [path.run_start].tolist ())])
+    lat1, lon1, lat2, lon2 = np.radians (coords.reshape (-1, 4)).T
+    a = np.sin ((lat2 - lat1) / 2) ** 2 + np.cos (lat1) * np.cos (lat2) * np.sin ((lon2 - lon1) / 2) ** 2
+    return float (2 * 6371000 * np.arcsin (np.sqrt (a)).sum ())
+
+# Match the track with one parameter set, returning the result row
+def sweep_one (param_set):
+    param_set = dict (param_set)
+    matcher_cls = map_matchers [param_set.pop ("map_matcher", base_params ["map_matcher"])]
+    matcher_params = {**base_params ["matcher_params"], **param_set}
+    result = {"params": param_set, "map_matcher": matcher_cls.__name__}
+
+    if trace_memory:
+        tracemalloc.start ()
+    start = time.perf_counter ()
+    try:
+        matcher = matcher_cls (map_con, **matcher_params)
+        _, lastidx = matcher.match (points)
+    except Exception as e: # Invalid parameter values should not stop the sweep
+        tracemalloc.stop () # Does nothing if not tracing
+        result ["error"] = f"{type (e).__name__}: {e}"
+        return result
+    result ["runtime"] = time.perf_counter () - start
+    if trace_memory:
+        result ["memory"] = tracemalloc.get_traced_memory () [1] # Peak of memory allocated while matching
+        tracemalloc.stop ()
+
+    path = MatchedPath.from_lattice (matcher.lattice_best)
+    result ["matched"] = lastidx + 1 if len (path) else 0
+    result ["completeness"] = result ["matched"] / len (points)
+    result ["length"] = path_length (map_con, path)
+    return result
+
+parser = argparse.ArgumentParser (
+    description = "Compare map matching parameters on a track",
+    formatter_class = argparse.RawDescriptionHelpFormatter,
+    epilog = """\
+This program matches a track with every parameter set in a grid file and reports
+how much of the track was matched, the length of the matched path, the runtime and
+the peak memory used for each set. The map is loaded once and shared by all workers.
+
+The grid file is a JSON object of matcher_params names (and optionally "map_matcher")
+with lists of values, in which case every combination is tried, e.g.
+  {"max_dist": [50, 100], "obs_noise": [25, 50], "max_lattice_width": [5, 10]}
+or a JSON list of parameter sets, e.g.
+  [{"max_dist": 50}, {"max_dist": 100, "obs_noise": 25}]
+Parameters not in a set are taken from matcher_params in the parameter file.
+
+Tracing memory slows matching down. Runtimes can still be compared between parameter
+sets, use --no-memory to measure the actual runtime.
+"""
+)
+parser.add_argument ("params", help = "Path to JSON parameter file")
+parser.add_argument ("grid", help = "Path to JSON parameter grid file")
+parser.add_argument ("gpx", help = "Path to .gpx track file")
+parser.add_argument ("--map", metavar = "file", required = True, help = "Path to .o5m map file")
+parser.add_argument ("--prior", metavar = "file", help = "Match cache (.match.pkl) or stop data with __shape__ of the same route, used to only match in a corridor around it")
+parser.add_argument ("--no-memory", action = "store_true", help = "Do not trace memory use")
+parser.add_argument ("-j", "--workers", type = int, default = os.cpu_count (), help = "Number of parallel workers")
+
+def main (args):
+    global map_con, points, base_params, trace_memory
+    trace_memory = not args.no_memory
+    base_params = json.load (open (args.params, "r"))
+    validate_params (base_params)
+    with open (args.grid, "r") as f:
+        param_sets = grid_sets (json.load (f))
+    for i in param_sets:
+        if i.get ("map_matcher", base_params ["map_matcher"]) not in map_matchers:
+            raise ValueError (f"Unknown map matcher {i ['map_matcher']}")
+
+    track = Track.load (args.gpx)
+    points = track.coords ()
+    if args.prior: # Only load the map in the corridor
+        prior, track_coords, width = load_prior (args.prior), np.column_stack ((track.lat, track.lon)), base_params.get ("corridor", 150)
+        map_con, tags = load_map (find_map (args.map), base_params ["use_rtree"], [CorridorArea (prior, track_coords, width)])
+        map_con = sub_map (map_con, corridor_nodes (map_con, prior, track_coords, width) [0]) # Without the neighbours outside the corridor
+    else:
+        map_con, tags = load_map (find_map (args.map), base_params ["use_rtree"])
+    del tags # Not needed for matching
+
+    print (f"Matching {len (points)} points with {len (param_sets)} parameter set(s)...")
+    workers = max (1, min (args.workers, len (param_sets)))
+    if workers > 1 and "fork" in multiprocessing.get_all_start_methods ():
+        with multiprocessing.get_context ("fork").Pool (workers) as pool:
+            results = []
+            for i in pool.imap (sweep_one, param_sets):
+                results.append (i)
+                print (f"Finished {len (results)}/{len (param_sets)}", end = "\r", flush = True)
+            print ()
+    else: # Without fork every worker would need its own copy of the map
+        results = [sweep_one (i) for i in param_sets]
+
+    table = Texttable (max_width = shutil.get_terminal_size ().columns)
+    table.set_deco (Texttable.HEADER)
+    table.set_cols_align (["l", "l", "r", "r", "r", "r", "r"])
+    table.set_cols_dtype (["i", "t", "t", "t", "t", "t", "t"])
+    table.header (["#", "Parameters", "Matched", "Completeness", "Length (m)", "Runtime (s)", "Memory (MB)"])
+    for j, i in enumerate (results):
+        name = ", ".join ([i ["map_matcher"]] + [f"{k}={v}" for k, v in i ["params"].items ()])
+        if "error" in i:
+            table.add_row ([j, name, i ["error"], "", "", "", ""])
+        else:
+            table.add_row ([j, name, f"{i ['matched']}/{len (points)}", f"{i ['completeness']:.1%}", f"{i ['length']:.0f}", f"{i ['runtime']:.2f}", f"{i ['memory'] / 1e6:.1f}" if trace_memory else ""])
+    print (table.draw ())
+
+    results_out = os.path.abspath (os.path.splitext (args.gpx) [0] + ".sweep.json")
+    with open (results_out, "w") as f:
+        json.dump (results, f, indent = 2)
+        print ("Saved results to", results_out)
+
+def script (args):
+    import shlex
+    main (parser.parse_args (shlex.split (args)))
+
+if __name__ == "__main__":
+    main (parser.parse_args ())
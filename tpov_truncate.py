@@ -2,56 +2,79 @@
 import os, argparse, copy
 
 # Third-party modules
-import gpxpy
+import numpy as np
 
 from tpov_functions import *
+from tpov_gpx import Track, utc_time
 
 # Truncates or extend a gpx file to match a start and end time
+# The track is read once into columns and written from them, unless its points have content which is only kept by gpxpy
 def truncate (gpx_path, start, end):
     start_time = dateutil.parser.isoparse (start) if start else None
     end_time = dateutil.parser.isoparse (end) if end else None
-    with open (gpx_path, "r") as gpx_file:
-        gpx = gpxpy.parse (gpx_file)
-        try:
-            first_seg = gpx.tracks [0].segments [0]
-            last_seg = gpx.tracks [-1].segments [-1]
-        except IndexError:
-            raise ValueError ("No track segment found in the gpx file")
-        first_time = first_seg.points [0].time
-        last_time = last_seg.points [-1].time
-    
+    track = Track.load (gpx_path)
+    if not len (track):
+        raise ValueError ("No track segment found in the gpx file")
+    first_time, last_time = track.time_at (0), track.time_at (-1)
+    # Times of the points in the first and last segments
+    first_times = track.time [ : track.seg_start [1] if len (track.seg_start) > 1 else len (track)]
+    last_times = track.time [track.seg_start [-1] : ]
+
+    head, tail = 0, 0 # Points removed from the beginning of the first and the end of the last segment
     if start_time and start_time > first_time: # Truncate the beginning
-        count = 0
-        while first_seg.points [0].time < start_time:
-            first_seg.points.pop (0)
-            count += 1
-            if not first_seg.points:
-                raise ValueError ("gpx file does not overlap with start time")
-        first_time = first_seg.points [0].time
-        print (f"Truncated {count} point(s) from the beginning")
+        kept = np.flatnonzero (first_times >= utc_time (start_time))
+        if not len (kept):
+            raise ValueError ("gpx file does not overlap with start time")
+        head = int (kept [0]) # Points before the first point at or after the start time
+        if len (track.seg_start) == 1:
+            last_times = last_times [head : ]
+        first_time = track.time_at (head)
+        print (f"Truncated {head} point(s) from the beginning")
     if end_time and end_time < last_time: # Truncate the end
-        count = 0
-        while last_seg.points [-1].time > end_time:
-            last_seg.points.pop ()
-            count += 1
-            if not last_seg.points:
-                raise ValueError ("gpx file does not overlap with end time")
-        last_time = last_seg.points [-1].time
-        print (f"Truncated {count} point(s) from the end")
-
-    if start_time and start_time < first_time: # Extend the beginning
-        first_seg.points.insert (0, copy.copy (first_seg.points [0]))
-        first_seg.points [0].time = start_time
+        kept = np.flatnonzero (last_times <= utc_time (end_time))
+        if not len (kept):
+            raise ValueError ("gpx file does not overlap with end time")
+        tail = len (last_times) - 1 - int (kept [-1]) # Points after the last point at or before the end time
+        last_time = track.time_at (len (track) - 1 - tail)
+        print (f"Truncated {tail} point(s) from the end")
+    extend_start = bool (start_time and start_time < first_time)
+    extend_end = bool (end_time and end_time > last_time)
+    if extend_start:
         print ("Extended the beginning")
-    if end_time and end_time > last_time: # Extend the end
-        last_seg.points.append (copy.copy (last_seg.points [-1]))
-        last_seg.points [-1].time = end_time
+    if extend_end:
         print ("Extended the end")
-    
+
     gpx_out = os.path.abspath (os.path.splitext (gpx_path) [0] + ".truncated.gpx")
-    with open (gpx_out, "w") as gpx_file:
-        gpx_file.write (gpx.to_xml ())
-        print (f"Saved truncated/extended file to", gpx_out)
+    if track.skeleton is None: # Edit the gpxpy document
+        gpx = track.gpx
+        first_seg, last_seg = gpx.tracks [0].segments [0], gpx.tracks [-1].segments [-1]
+        del first_seg.points [ : head]
+        del last_seg.points [len (last_seg.points) - tail : ]
+        if extend_start:
+            first_seg.points.insert (0, copy.copy (first_seg.points [0]))
+            first_seg.points [0].time = start_time
+        if extend_end:
+            last_seg.points.append (copy.copy (last_seg.points [-1]))
+            last_seg.points [-1].time = end_time
+        with open (gpx_out, "w") as gpx_file:
+            gpx_file.write (gpx.to_xml ())
+    else: # Select the points in the columns, extended points are copies of the first or last point
+        index = np.arange (head, len (track) - tail)
+        seg_start = np.maximum (track.seg_start - head, 0)
+        if extend_start:
+            index = np.concatenate ((index [ : 1], index))
+            seg_start [1 : ] += 1
+        if extend_end:
+            index = np.append (index, index [-1])
+        time = track.time [index]
+        if extend_start:
+            time [0] = utc_time (start_time)
+        if extend_end:
+            time [-1] = utc_time (end_time)
+        extensions = {i: track.extensions [j] for i, j in enumerate (index.tolist ()) if j in track.extensions}
+        truncated = Track (track.lat [index], track.lon [index], track.ele [index], time, seg_start, track.skeleton, extensions, gpx_path)
+        truncated.write (gpx_out, truncated.document (), [{}] * len (truncated))
+    print (f"Saved truncated/extended file to", gpx_out)
 
 parser = argparse.ArgumentParser (
     description = "Truncate/Extend gpx files to match a video",
@@ -81,7 +104,8 @@ def main (args):
         raise SystemExit ("No action requested: Use -t or -e to specify the start and end time.")
 
     if input (f"Start time: {start}  End time: {end}\nProceed (Y/n)? ").lower () == "y":
-        truncate (args.gpx, start, end)
+        with profiler.phase ("Truncate"):
+            truncate (args.gpx, start, end)
 
 def script (args):
     import shlex